@@ -266,7 +266,7 @@ async function logEmbeddingUsage(orgId, response, startTime) {
 // 7. CHAT HANDLER (OpenAI Only — supports tools/MCP)
 // ==========================================
 
-async function handleOpenAI(
+function buildOpenAIChatBody(
   messages,
   files = [],
   temperature = 0.7,
@@ -327,6 +327,25 @@ async function handleOpenAI(
     if (tool_choice) requestBody.tool_choice = tool_choice;
   }
 
+  return requestBody;
+}
+
+async function handleOpenAI(
+  messages,
+  files = [],
+  temperature = 0.7,
+  tools = null,
+  tool_choice = null,
+) {
+  const config = API_CONFIGS.openai;
+  const requestBody = buildOpenAIChatBody(
+    messages,
+    files,
+    temperature,
+    tools,
+    tool_choice,
+  );
+
   const response = await axios.post(
     `${config.baseUrl}/chat/completions`,
     requestBody,
@@ -338,6 +357,166 @@ async function handleOpenAI(
   return response.data;
 }
 
+// Rough token count (~4 chars/token) for streams that end before OpenAI sends usage
+function estimateTokens(value) {
+  const text = typeof value === "string" ? value : JSON.stringify(value || "");
+  return Math.ceil(text.length / 4);
+}
+
+// Streaming variant of /chat: forwards OpenAI SSE chunks as they arrive, then a
+// final chunk carrying usage + metadata (same fields as the queued response).
+// Admission goes through the per-org queue like any chat (see the /chat route);
+// onFinish releases the org's slot once the stream is over, however it ends.
+async function streamOpenAIChat(req, res, { requestId, startTime, onFinish }) {
+  const config = API_CONFIGS.openai;
+  const {
+    messages,
+    files = [],
+    temperature = 0.7,
+    organization_id,
+    category,
+    nameUser,
+    ticket_id,
+    ticket_categories = [],
+  } = req.body;
+
+  const requestBody = {
+    ...buildOpenAIChatBody(
+      messages,
+      files,
+      temperature,
+      req.body.tools || null,
+      req.body.tool_choice || null,
+    ),
+    stream: true,
+    stream_options: { include_usage: true },
+  };
+
+  const llmStart = Date.now();
+  const upstream = await axios.post(
+    `${config.baseUrl}/chat/completions`,
+    requestBody,
+    {
+      headers: { Authorization: `Bearer ${getApiKey()}` },
+      responseType: "stream",
+      timeout: 180000,
+    },
+  );
+
+  res.setHeader("Content-Type", "text/event-stream");
+  res.setHeader("Cache-Control", "no-cache");
+  res.setHeader("Connection", "keep-alive");
+  res.flushHeaders();
+
+  let buffer = "";
+  let usage = null;
+  let content = "";
+  let finished = false;
+
+  // Single exit for every way a stream can end (done, upstream error, client
+  // disconnect): bill exactly once, with OpenAI's usage or an estimate of what
+  // was generated so far, then release the org's queue slot.
+  const finish = async (status, errorMessage = null) => {
+    if (finished) return;
+    finished = true;
+
+    try {
+      const estimated = !usage;
+      const response = {
+        usage: usage || {
+          prompt_tokens: estimateTokens(messages),
+          completion_tokens: estimateTokens(content),
+        },
+      };
+      const queryType = detectQueryType(messages, files);
+      const creditUsage = await logCreditUsage(
+        organization_id,
+        queryType,
+        response,
+        startTime,
+        category,
+      );
+      creditUsage.status = status;
+
+      if (!res.writableEnded && !res.destroyed) {
+        if (errorMessage) {
+          res.write(`data: ${JSON.stringify({ error: errorMessage })}\n\n`);
+        } else {
+          const metadata = {
+            request_id: requestId,
+            provider: "openai",
+            nameUser: nameUser || "Anonymous",
+            hasFiles: files.length > 0,
+            timestamp: new Date().toISOString(),
+            query_type: queryType,
+            priority: category || null,
+            credits_used: creditUsage.credits_used,
+            response_time_ms: creditUsage.response_time_ms,
+            llm_time_ms: Date.now() - llmStart,
+            cost_usd: creditUsage.cost_usd,
+            streamed: true,
+          };
+          res.write(`data: ${JSON.stringify({ usage: response.usage, metadata })}\n\n`);
+          res.write("data: [DONE]\n\n");
+        }
+        res.end();
+      }
+
+      logCost("/chat (stream)", requestId, {
+        orgId: organization_id,
+        queryType: queryType,
+        inputTokens: response.usage?.prompt_tokens || 0,
+        outputTokens: response.usage?.completion_tokens || 0,
+        costUsd: creditUsage.cost_usd,
+        responseMs: creditUsage.response_time_ms,
+        extra: `status=${status} estimated=${estimated} cached=${response.usage?.prompt_tokens_details?.cached_tokens || 0}`,
+      });
+
+      if (status === "completed" && category?.toLowerCase() === "low" && ticket_id && content) {
+        updateTicket(ticket_id, category, ticket_categories, content);
+      }
+    } catch (err) {
+      console.error(`[STREAM] ${requestId}: billing failed: ${err.message}`);
+    } finally {
+      if (onFinish) onFinish();
+    }
+  };
+
+  // Client went away: stop paying for tokens nobody will read (and bill what was used)
+  res.on("close", () => {
+    upstream.data.destroy();
+    finish("cancelled");
+  });
+
+  upstream.data.on("data", (chunk) => {
+    buffer += chunk.toString("utf8");
+    let idx;
+    while ((idx = buffer.indexOf("\n")) >= 0) {
+      const line = buffer.slice(0, idx).trim();
+      buffer = buffer.slice(idx + 1);
+      if (!line.startsWith("data:")) continue;
+
+      const data = line.slice(5).trim();
+      if (data === "[DONE]") continue;
+      try {
+        const parsed = JSON.parse(data);
+        if (parsed.usage) usage = parsed.usage;
+        content += parsed.choices?.[0]?.delta?.content || "";
+      } catch (_) {
+        continue;
+      }
+      res.write(`data: ${data}\n\n`);
+    }
+  });
+
+  upstream.data.on("end", () => finish("completed"));
+
+  upstream.data.on("error", (err) => {
+    console.error(`[STREAM] ${requestId}: ${err.message}`);
+    finish("failed", err.message);
+  });
+}
+
 // ==========================================
 // 8. FILE MANAGER HANDLER (OpenAI — no tools, supports response_format)
 // ==========================================
@@ -430,6 +609,9 @@ async function getOpenAIEmbeddings(texts) {
 // 10. CHAT WORKER SYSTEM
 // ==========================================
 
+// Upper bound on how long a stream may hold its org's worker slot
+const STREAM_SLOT_TIMEOUT_MS = 300000;
+
 async function processUserQueue(userId) {
   const queueKey = `queue:${userId}`;
   const workerId = `${process.env.HOSTNAME || process.env.NODE_NAME || process.env.TASK_SLOT || "unknown"}-${Date.now()}`;
@@ -455,6 +637,23 @@ async function processUserQueue(userId) {
 
       console.log(`[WORKER] [${workerId}] Processing: ${job.requestId}`);
 
+      if (job.stream) {
+        // Admission only: the route handler owns the HTTP response and streams it.
+        // Keep this org's slot until the stream reports done (or the slot times out).
+        await redisClient.setex(
+          `result:${job.jobId}`,
+          300,
+          JSON.stringify({ success: true, admitted: true }),
+        );
+        try {
+          await waitForResult(`${job.jobId}:done`, STREAM_SLOT_TIMEOUT_MS);
+          console.log(`[WORKER] [${workerId}] Stream finished: ${job.requestId}`);
+        } catch (err) {
+          console.error(`[WORKER] [${workerId}] Stream slot expired: ${job.requestId}`);
+        }
+        continue;
+      }
+
       try {
         const llmStart = Date.now();
         const response = await handleOpenAI(
@@ -505,6 +704,7 @@ async function processUserQueue(userId) {
           outputTokens: response.usage?.completion_tokens || 0,
           costUsd: creditUsage.cost_usd,
           responseMs: creditUsage.response_time_ms,
+          extra: `cached=${response.usage?.prompt_tokens_details?.cached_tokens || 0}`,
         });
         console.log(
           `[WORKER] [${workerId}] Completed: ${job.requestId} (${creditUsage.response_time_ms}ms)`,
@@ -672,6 +872,37 @@ router.post("/chat", authenticate, async (req, res) => {
     const userId = organization_id || "default_org";
     const jobId = `${userId}-${Date.now()}-${Math.random().toString(36).substr(2, 9)}`;
 
+    if (req.body.stream === true) {
+      // Same per-org admission as queued chats: the worker admits the stream,
+      // then holds the org's slot until the stream signals it is finished.
+      const releaseSlot = () =>
+        redisClient
+          .setex(`result:${jobId}:done`, 300, JSON.stringify({ success: true }))
+          .catch((err) =>
+            console.error(`[STREAM] ${requestId}: slot release failed: ${err.message}`),
+          );
+
+      await redisClient.rpush(
+        `queue:${userId}`,
+        JSON.stringify({ jobId, requestId, stream: true, organization_id }),
+      );
+      if (!userWorkers[userId]) {
+        userWorkers[userId] = processUserQueue(userId);
+      }
+
+      try {
+        await waitForResult(jobId, 180000);
+        return await streamOpenAIChat(req, res, {
+          requestId,
+          startTime,
+          onFinish: releaseSlot,
+        });
+      } catch (error) {
+        releaseSlot();
+        throw error;
+      }
+    }
+
     const job = {
       jobId,
       requestId,
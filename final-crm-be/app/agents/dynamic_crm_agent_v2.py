@@ -2,21 +2,41 @@ import logging
 import aiohttp
 import asyncio
 import json
+import time
+import hashlib
 import pytz
 
+from collections import OrderedDict
 from datetime import datetime
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Callable, Awaitable, Tuple
 from app.config import settings
 from app.services.mcp_service import get_mcp_service
+from app.services.http_client_service import proxy_session
+from app.services.prompt_packer import CONTEXT_SEPARATOR, pack_prompt, resolve_budget
+from app.services.tracing_service import record_span
 
 logger = logging.getLogger(__name__)
 
+# Vision / transcription verdicts that mean "nothing searchable in this media"
+NO_CONTENT_MARKERS = (
+    "visual content only", "no text detected", "no readable text",
+    "[no_text_detected]", "no spoken words", "instrumental",
+    "error processing image", "error processing audio"
+)
+
 class DynamicCRMAgentV2:
+    PREFIX_CACHE_SIZE = 512
+    TOOL_SEMAPHORE_CACHE_SIZE = 1024
+
     def __init__(self):
         # Ensure URL ends with /chat
         base = settings.PROXY_BASE_URL.rstrip('/')
         self.proxy_url = f"{base}/chat"
         self.mcp_service = get_mcp_service()  
+        # Per (agent, MCP server) cap shared by every chat on this worker
+        self._tool_semaphores: "OrderedDict[tuple, asyncio.Semaphore]" = OrderedDict()
+        # Static system-prompt prefixes by agent version (see _static_prompt)
+        self._prefix_cache: "OrderedDict[str, str]" = OrderedDict()
 
     def _sanitize_text_results(self, text: str) -> str:
         """
@@ -40,19 +60,21 @@ class DynamicCRMAgentV2:
 
         return text.strip()
     
+    @staticmethod
+    def has_searchable_content(vision_context: str) -> bool:
+        """True if the vision output carries text/codes worth searching for (not a no-content verdict)"""
+        if not vision_context or not vision_context.strip():
+            return False
+        lower_ctx = vision_context.lower()
+        return not any(p in lower_ctx for p in NO_CONTENT_MARKERS)
+
     async def reformulate_query(self, user_message: str, vision_context: str, organization_id: str) -> str:
         """Fast LLM call to extract a clean search query from messy user input"""
         combined = user_message.strip()
                 
         # [TRACE] Flag if this looks like a no-content image
         if vision_context:
-            lower_ctx = vision_context.lower()
-            is_no_content = any(p in lower_ctx for p in [
-                "visual content only", "no text detected", "no readable text",
-                "[no_text_detected]", "no spoken words", "instrumental",
-                "error processing image", "error processing audio"
-            ])
-            if is_no_content:
+            if not self.has_searchable_content(vision_context):
                 logger.warning(f"📊 [TRACE:QUERY] ⚠️ IRRELEVANT IMAGE DETECTED — vision has no useful content, but RAG will still run (no gate yet)")
             
             combined = f"{combined}\n[Image Analysis: {vision_context}]"
@@ -78,8 +100,8 @@ class DynamicCRMAgentV2:
         
         try:
             timeout = aiohttp.ClientTimeout(total=10)
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.post(self.proxy_url, json=payload) as resp:
+            async with proxy_session() as session:
+                async with session.post(self.proxy_url, json=payload, timeout=timeout) as resp:
                     if resp.status == 200:
                         res = await resp.json()
                         query = res.get("choices", [{}])[0].get("message", {}).get("content", "").strip()
@@ -104,69 +126,98 @@ class DynamicCRMAgentV2:
                 return {}
         return {}
 
-    def _build_system_prompt(
+    def _static_prompt(self, persona: Dict, advanced: Dict, external_tools: List[Dict] = None) -> Tuple[str, str]:
+        """
+        Byte-stable system prefix for this agent version: persona, rules and tool
+        descriptions only — nothing that changes per request (time, user, RAG).
+        Returns (version, prompt); the version is a digest of everything that
+        went into the prompt, and the prompt is memoised on it.
+        """
+        tools_sig = [
+            (t["function"]["name"], t["function"].get("description", ""))
+            for t in (external_tools or [])
+        ]
+        key_src = json.dumps(
+            [persona, advanced.get("handoffTriggers", {}), tools_sig],
+            sort_keys=True, ensure_ascii=False, default=str
+        )
+        version = hashlib.sha256(key_src.encode("utf-8")).hexdigest()[:16]
+
+        cached = self._prefix_cache.get(version)
+        if cached is not None:
+            self._prefix_cache.move_to_end(version)
+            return version, cached
+
+        name = persona.get("name", "Support Agent")
+        tone = persona.get("tone", "friendly")
+        language = persona.get("language", "english")
+        custom_instructions = persona.get("customInstructions", "").strip()
+        handoff = advanced.get("handoffTriggers", {})
+        lang_instruction = f"Reply ONLY in {language}."
+
+        # ── SWITCH: custom instructions vs default persona ──────────────────────
+        # Placeholders point at the CURRENT CONTEXT section instead of being
+        # substituted inline, so the prefix stays identical across requests.
+        if len(custom_instructions) > 10:
+            prompt = custom_instructions\
+                .replace("{name_user}", "[USER_NAME]")\
+                .replace("{current_time}", "[CURRENT_TIME]")\
+                .replace("{current_date}", "[CURRENT_DATE]")
+        else:
+            prompt = f"""
+                You are {name}. Tone: {tone}. LANGUAGE RULE: {lang_instruction}
+                The user's name and the current time are given in CURRENT CONTEXT at the end.
+                ## CORE INSTRUCTION
+                Please answer the user's questions based on the provided **KNOWLEDGE BASE**. 
+                
+                **Guidelines:**
+                1. Use the information in the Knowledge Base to provide accurate answers.
+                2. If the answer is not found in the Knowledge Base, politely inform the user that you don't have that information.
+                3. Keep the tone natural, helpful, and friendly.
+                """
+        # ────────────────────────────────────────────────────────────────────────
+
+        if handoff.get("enabled"):
+            keywords = handoff.get("keywords", [])
+            triggers = "is angry OR wants human"
+            if keywords:
+                kw_str = " / ".join([f'"{k}"' for k in keywords])
+                triggers += f" OR types {kw_str}"
+            prompt += f"""HANDOFF RULE: If user {triggers} → empathize + say 'Please connect to your engineer!' with keeping using the same {language}"""
+
+        if tools_sig:
+            tool_descriptions = [
+                f"• {tool_name.split('__')[-1].replace('_', ' ')}: {tool_desc}"
+                for tool_name, tool_desc in tools_sig
+            ]
+            prompt += f"""
+                ## AVAILABLE TOOLS
+                You have access to these tools. You MUST use them to answer questions that require real data. Never answer from memory or assumptions.
+                {chr(10).join(tool_descriptions)}
+                """
+
+        self._prefix_cache[version] = prompt
+        while len(self._prefix_cache) > self.PREFIX_CACHE_SIZE:
+            self._prefix_cache.popitem(last=False)
+        return version, prompt
+
+    def _context_prompt(
             self,
             persona: Dict,
-            advanced: Dict,
             rag_context: str,
             name_user: str,
             has_current_image: bool,
-            external_tools: List[Dict] = None,  
+            external_tools: List[Dict] = None,
         ) -> str:
-            name = persona.get("name", "Support Agent")
-            tone = persona.get("tone", "friendly")
-            language = persona.get("language", "english")
-            custom_instructions = persona.get("customInstructions", "").strip()
-            handoff = advanced.get("handoffTriggers", {})
-            lang_instruction = f"Reply ONLY in {language}."    
-
+            """Per-request tail: current user / time, knowledge base and vision note."""
             tz = pytz.timezone("Asia/Jakarta")
             now = datetime.now(tz)
-            current_time = now.strftime("%H:%M")
-            current_date = now.strftime("%Y-%m-%d")        
-
-            use_custom = len(custom_instructions) > 10
-
-            # ── SWITCH: custom instructions vs default persona ──────────────────────
-            match use_custom:
-                case True:
-                    prompt = custom_instructions\
-                        .replace("{name_user}", name_user)\
-                        .replace("{current_time}", current_time)\
-                        .replace("{current_date}", current_date)
-                case False:
-                    prompt = f"""
-                    You are {name}. Tone: {tone}. User: {name_user}. LANGUAGE RULE: {lang_instruction}
-                    Current time: {current_time}. Current date: {current_date}.
-                    ## CORE INSTRUCTION
-                    Please answer the user's questions based on the provided **KNOWLEDGE BASE**. 
-                    
-                    **Guidelines:**
-                    1. Use the information in the Knowledge Base to provide accurate answers.
-                    2. If the answer is not found in the Knowledge Base, politely inform the user that you don't have that information.
-                    3. Keep the tone natural, helpful, and friendly.
-                    """
-            # ────────────────────────────────────────────────────────────────────────
-
-            if handoff.get("enabled"):
-                keywords = handoff.get("keywords", [])
-                triggers = "is angry OR wants human"
-                if keywords:
-                    kw_str = " / ".join([f'"{k}"' for k in keywords])
-                    triggers += f" OR types {kw_str}"
-                prompt += f"""HANDOFF RULE: If user {triggers} → empathize + say 'Please connect to your engineer!' with keeping using the same {language}"""
-
-            if external_tools and len(external_tools) > 0:
-                tool_descriptions = []
-                for tool in external_tools:
-                    tool_name = tool['function']['name'].split('__')[-1].replace('_', ' ')
-                    tool_desc = tool['function'].get('description', '')
-                    tool_descriptions.append(f"• {tool_name}: {tool_desc}")
-                
-                prompt += f"""
-                ## AVAILABLE TOOLS
-                You have access to these tools. You MUST use them to answer questions that require real data. Never answer from memory or assumptions.
-                {chr(10).join(tool_descriptions)}
+            use_custom = len(persona.get("customInstructions", "").strip()) > 10
+
+            prompt = f"""## CURRENT CONTEXT
+                USER_NAME: {name_user}
+                CURRENT_TIME: {now.strftime("%H:%M")}
+                CURRENT_DATE: {now.strftime("%Y-%m-%d")}
                 """
 
             if not use_custom:
@@ -199,7 +250,7 @@ class DynamicCRMAgentV2:
                 prompt += """## VISION UPDATE
             User sent an image. Extract codes/text and search the Knowledge Base for matches.
             """
-                
+
             return prompt
     
     def _build_messages(
@@ -207,10 +258,14 @@ class DynamicCRMAgentV2:
         system_prompt: str,
         chat_history: List[Dict[str, Any]],
         customer_message: str,
-        image_urls: List[str] = None 
+        image_urls: List[str] = None,
+        context_prompt: str = ""
     ) -> List[Dict[str, Any]]:
         """
         Build message chain (Multimodal support)
+        Layout is cache-friendly: [static system] [history...] [context system] [user].
+        The static prefix and the (append-only) history form a prefix the provider
+        can reuse between turns; everything that changes per request comes last.
         """
         messages = [{"role": "system", "content": system_prompt}]
         
@@ -227,6 +282,9 @@ class DynamicCRMAgentV2:
             
             if content_text.strip():
                 messages.append({"role": role, "content": content_text})
+
+        if context_prompt:
+            messages.append({"role": "system", "content": context_prompt})
         
         # Add current message
         if image_urls and len(image_urls) > 0:
@@ -273,14 +331,122 @@ class DynamicCRMAgentV2:
                 "temperature": 0.1 
             }
             timeout = aiohttp.ClientTimeout(total=60)
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.post(self.proxy_url, json=payload) as resp:
+            async with proxy_session() as session:
+                async with session.post(self.proxy_url, json=payload, timeout=timeout) as resp:
                     if resp.status == 200:
                         res = await resp.json()
                         return res.get("choices", [{}])[0].get("message", {}).get("content", "")
             return ""
         except Exception: return ""
 
+    async def _read_sse_completion(self, response: aiohttp.ClientResponse, on_delta: Callable[[str], Awaitable[None]]) -> Dict[str, Any]:
+        """Reassemble a streamed chat completion into the non-streaming response shape"""
+        content_parts: List[str] = []
+        tool_calls: Dict[int, Dict[str, Any]] = {}
+        usage: Dict[str, Any] = {}
+        metadata: Dict[str, Any] = {}
+
+        async for raw_line in response.content:
+            line = raw_line.decode("utf-8", errors="ignore").strip()
+            if not line.startswith("data:"):
+                continue
+            data = line[5:].strip()
+            if data == "[DONE]":
+                break
+            try:
+                chunk = json.loads(data)
+            except ValueError:
+                continue
+
+            if chunk.get("error"):
+                raise Exception(f"Proxy stream error: {chunk['error']}")
+            if chunk.get("usage"):
+                usage = chunk["usage"]
+            if chunk.get("metadata"):
+                metadata = chunk["metadata"]
+
+            for choice in chunk.get("choices") or []:
+                delta = choice.get("delta") or {}
+                if delta.get("content"):
+                    content_parts.append(delta["content"])
+                    await on_delta(delta["content"])
+                # Tool calls arrive as fragments keyed by index; arguments are concatenated
+                for tc in delta.get("tool_calls") or []:
+                    slot = tool_calls.setdefault(tc.get("index", 0), {"id": None, "type": "function", "function": {"name": "", "arguments": ""}})
+                    if tc.get("id"):
+                        slot["id"] = tc["id"]
+                    fn = tc.get("function") or {}
+                    slot["function"]["name"] += fn.get("name") or ""
+                    slot["function"]["arguments"] += fn.get("arguments") or ""
+
+        message: Dict[str, Any] = {"role": "assistant", "content": "".join(content_parts) or None}
+        if tool_calls:
+            message["tool_calls"] = [tool_calls[i] for i in sorted(tool_calls)]
+        return {"choices": [{"message": message}], "usage": usage, "metadata": metadata}
+
+    def _tool_semaphore(self, agent_id: str, func_name: str) -> asyncio.Semaphore:
+        key = (agent_id, func_name.split("__", 1)[0])
+        sem = self._tool_semaphores.get(key)
+        if sem is not None:
+            self._tool_semaphores.move_to_end(key)
+            return sem
+
+        cap = settings.MCP_TOOL_CONCURRENCY_PER_SERVER
+        sem = asyncio.Semaphore(cap)
+        self._tool_semaphores[key] = sem
+        # LRU across tenants; a semaphore still in use is kept, or its cap would reset
+        for old_key in list(self._tool_semaphores):
+            if len(self._tool_semaphores) <= self.TOOL_SEMAPHORE_CACHE_SIZE:
+                break
+            if old_key != key and self._tool_semaphores[old_key]._value == cap:
+                del self._tool_semaphores[old_key]
+        return sem
+
+    async def _run_tool_call(self, tool: Dict, agent_id: str, supabase: Any) -> Dict[str, Any]:
+        """One tool call under its server's concurrency cap and the per-call timeout"""
+        func_name = tool["function"]["name"]
+        started = time.perf_counter()
+        status = "success"
+        try:
+            func_args = json.loads(tool["function"].get("arguments") or "{}")
+            async with self._tool_semaphore(agent_id, func_name):
+                tool_result = await asyncio.wait_for(
+                    self.mcp_service.execute_mcp_tool(
+                        supabase=supabase,
+                        agent_id=agent_id,
+                        tool_call_name=func_name,
+                        arguments=func_args
+                    ),
+                    timeout=settings.MCP_TOOL_CALL_TIMEOUT
+                )
+            status = tool_result.get("status", "success")
+            tool_output = tool_result.get("output", "Error executing tool")
+        except asyncio.TimeoutError:
+            status = "timeout"
+            tool_output = f"Tool '{func_name}' timed out after {settings.MCP_TOOL_CALL_TIMEOUT}s"
+        except json.JSONDecodeError as e:
+            status = "error"
+            tool_output = f"Invalid tool arguments: {e}"
+        except Exception as e:
+            status = "error"
+            tool_output = f"Error executing tool: {e}"
+
+        record_span("tool.call", started, tool=func_name, status=status)
+        return {
+            "message": {
+                "role": "tool",
+                "tool_call_id": tool["id"],
+                "name": func_name,
+                "content": tool_output
+            },
+            "timing": {
+                "tool": func_name,
+                "tool_call_id": tool["id"],
+                "status": status,
+                "latency_ms": round((time.perf_counter() - started) * 1000, 1)
+            }
+        }
+
     async def process_message(
         self,
         chat_id: str,
@@ -289,16 +455,22 @@ class DynamicCRMAgentV2:
         agent_settings: Dict[str, Any],
         organization_id: str,
         rag_context: str = "",
+        rag_blocks: Optional[List[Dict[str, Any]]] = None,
         category: str = "general",
         name_user: str = "Customer",
         image_urls: List[str] = None,
         ticket_categories: List[str] = None,
         ticket_id: str = "",
         external_tools: List[Dict] = None,
-        supabase: Any = None
+        supabase: Any = None,
+        on_delta: Optional[Callable[[str], Awaitable[None]]] = None
     ) -> Dict[str, Any]:
         """
         Generate AI response with robust error handling (The 3 Safety Blocks)
+        If on_delta is given the proxy is asked to stream (SSE) and every content
+        fragment is passed to it as it arrives; the return value is unchanged.
+        rag_blocks ({"text", "rank"}, from query_context_blocks) take precedence
+        over rag_context and let prompt packing keep the best-ranked chunks.
         """
         try:
             # === 1. PARSE SETTINGS ===
@@ -308,28 +480,46 @@ class DynamicCRMAgentV2:
             temp_map = {"consistent": 0.3, "balanced": 0.7, "creative": 1}
             temperature = temp_map.get(advanced.get("temperature", "balanced").lower(), 0.7)
 
-            # === 2. BUILD SYSTEM PROMPT ===
-            system_prompt = self._build_system_prompt(
+            # === 2. PACK RAG + HISTORY INTO THE AGENT'S TOKEN BUDGET ===
+            packing_report = None
+            if rag_blocks is None:
+                rag_blocks = [{"text": rag_context, "rank": 0}] if rag_context and rag_context.strip() else []
+            prefix_version, system_prompt = self._static_prompt(persona, advanced, external_tools)
+            if settings.AI_PROMPT_PACKING_ENABLED:
+                base_prompt = system_prompt + self._context_prompt(
+                    persona=persona, rag_context="", name_user=name_user,
+                    has_current_image=bool(image_urls), external_tools=external_tools,
+                )
+                packed = pack_prompt(
+                    base_prompt, customer_message, rag_blocks, chat_history,
+                    budget=resolve_budget(advanced), tools=external_tools,
+                )
+                rag_blocks, chat_history, packing_report = packed.rag_blocks, packed.history, packed.report
+            rag_context = CONTEXT_SEPARATOR.join(b["text"] for b in rag_blocks)
+
+            # === 3. BUILD PER-REQUEST CONTEXT (static prefix comes from step 2) ===
+            context_prompt = self._context_prompt(
                 persona=persona,
-                advanced=advanced,
                 rag_context=rag_context,
                 name_user=name_user,
                 has_current_image=bool(image_urls),
-                external_tools=external_tools,  
+                external_tools=external_tools,
             )
 
-            # === 3. BUILD MESSAGES ===
+            # === 4. BUILD MESSAGES ===
             messages = self._build_messages(
                 system_prompt=system_prompt,
                 chat_history=chat_history,
                 customer_message=customer_message,
-                image_urls=image_urls
+                image_urls=image_urls,
+                context_prompt=context_prompt
             )
             
-            # === 4. EXECUTION LOOP (MCP SUPPORT) ===
+            # === 5. EXECUTION LOOP (MCP SUPPORT) ===
             current_turn = 0
             max_turns = 10  
-            final_usage = {"total_tokens": 0}
+            final_usage = {"total_tokens": 0, "prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0}
+            tool_timings: List[Dict[str, Any]] = []
             timeout = aiohttp.ClientTimeout(total=300)
 
             while current_turn < max_turns:
@@ -352,14 +542,19 @@ class DynamicCRMAgentV2:
                     payload["tools"] = external_tools
                     payload["tool_choice"] = "auto"
 
+                if on_delta:
+                    payload["stream"] = True
+
                 # logger.info(f"🚀 AI Payload (Turn {current_turn}):\n{json.dumps(payload, indent=2, default=str)}")
                 
-                # === 5. CALL PROXY ===
-                async with aiohttp.ClientSession(timeout=timeout) as session:
+                # === 6. CALL PROXY ===
+                turn_started = time.perf_counter()
+                async with proxy_session() as session:
                     async with session.post(
                         self.proxy_url,
                         json=payload,
-                        headers={"Content-Type": "application/json"}
+                        headers={"Content-Type": "application/json"},
+                        timeout=timeout
                     ) as response:
                         
                         if response.status == 429:
@@ -377,17 +572,30 @@ class DynamicCRMAgentV2:
                                 "usage": final_usage
                             }
                         
-                        result = await response.json()
+                        # Older proxies ignore "stream" and answer with plain JSON
+                        if on_delta and response.content_type == "text/event-stream":
+                            result = await self._read_sse_completion(response, on_delta)
+                        else:
+                            result = await response.json()
                         
                         # Handle varied proxy response structures
                         choice = result.get("choices", [{}])[0]
                         message = choice.get("message", {})
                         
                         # Accumulate usage
-                        u = result.get("usage", {})
+                        u = result.get("usage", {}) or {}
                         final_usage["total_tokens"] += u.get("total_tokens", 0)
-
-                        # === 6. HANDLE TOOL CALLS ===
+                        final_usage["prompt_tokens"] += u.get("prompt_tokens", 0)
+                        final_usage["completion_tokens"] += u.get("completion_tokens", 0)
+                        # Provider prompt-cache hits, passed through by the proxy (OpenAI usage shape)
+                        final_usage["cached_tokens"] += (u.get("prompt_tokens_details") or {}).get("cached_tokens", 0) or 0
+                        record_span(
+                            "llm.turn", turn_started, turn=current_turn,
+                            prompt_tokens=u.get("prompt_tokens", 0), completion_tokens=u.get("completion_tokens", 0),
+                            tool_calls=len(message.get("tool_calls") or [])
+                        )
+
+                        # === 7. HANDLE TOOL CALLS ===
                         tool_calls = message.get("tool_calls")
                         
                         if tool_calls:
@@ -395,34 +603,22 @@ class DynamicCRMAgentV2:
                             # A. Append AI's intent to history
                             messages.append(message) 
                             
-                            # B. Execute Tools
-                            for tool in tool_calls:
-                                func_name = tool["function"]["name"]
-                                func_args = json.loads(tool["function"]["arguments"])
-                                call_id = tool["id"]
-                                                                
-                                # Execute via MCP Service
-                                tool_result = await self.mcp_service.execute_mcp_tool(
-                                    supabase=supabase,
-                                    agent_id=agent_settings.get("agent_id"),
-                                    tool_call_name=func_name,
-                                    arguments=func_args
-                                )
-
-                                tool_output = tool_result.get("output", "Error executing tool")
-                                
-                                # C. Append Result to history
-                                messages.append({
-                                    "role": "tool",
-                                    "tool_call_id": call_id,
-                                    "name": func_name,
-                                    "content": tool_output
-                                })
+                            # B. Execute Tools concurrently (capped per MCP server, bounded per call)
+                            results = await asyncio.gather(*[
+                                self._run_tool_call(tool, agent_settings.get("agent_id"), supabase)
+                                for tool in tool_calls
+                            ])
+
+                            # C. Append Results to history: gather keeps each result paired with its
+                            # tool_call_id, in the order the model issued the calls
+                            for r in results:
+                                messages.append(r["message"])
+                                tool_timings.append({**r["timing"], "turn": current_turn})
 
                             # D. Loop again!
                             continue 
                         
-                        # === 7. FINAL TEXT RESPONSE ===
+                        # === 8. FINAL TEXT RESPONSE ===
                         content = ""
                         try:
                             content = message["content"]
@@ -436,9 +632,26 @@ class DynamicCRMAgentV2:
                         # Apply Cleaner
                         clean_content = self._sanitize_text_results(content)
 
+                        response_metadata = result.get("metadata", {}) or {}
+                        if not message.get("content") and not (result.get("reply") or result.get("content")):
+                            # Canned apology above: never worth caching or reusing
+                            response_metadata = {**response_metadata, "is_fallback": True}
+                        if tool_timings:
+                            response_metadata = {**response_metadata, "tool_calls": tool_timings}
+                        if packing_report:
+                            response_metadata = {**response_metadata, "prompt_packing": packing_report}
+                        response_metadata = {
+                            **response_metadata,
+                            "prompt_cache": {
+                                "prefix_version": prefix_version,
+                                "prompt_tokens": final_usage["prompt_tokens"],
+                                "cached_tokens": final_usage["cached_tokens"],
+                            }
+                        }
+
                         return {
                             "content": clean_content, 
-                            "metadata": result.get("metadata", {}),
+                            "metadata": response_metadata,
                             "usage": final_usage
                         }
 
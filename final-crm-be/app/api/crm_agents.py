@@ -26,6 +26,7 @@ from app.models.user import User
 from app.services.organization_service import get_organization_service
 from app.config import settings as app_settings
 from app.services.mcp_service import get_mcp_service
+from app.services.faq_cache_service import invalidate_faq_cache
 from pydantic import BaseModel
 
 logger = logging.getLogger(__name__)
@@ -659,6 +660,9 @@ async def update_agent_settings(
 				detail="Failed to update agent settings"
 			)
 
+		# Persona / advanced / ticketing edits change the answers: retire cached FAQ replies
+		await invalidate_faq_cache(agent_id)
+
 		logger.info(f"Agent settings updated: {agent_id} by user {current_user.user_id}")
 
 		return AgentSettings(**response.data[0])
@@ -672,6 +676,31 @@ async def update_agent_settings(
 			detail="Failed to update agent settings"
 		)
 
+@router.delete(
+    "/{agent_id}/faq-cache",
+    status_code=status.HTTP_204_NO_CONTENT,
+    summary="Clear FAQ reply cache",
+    description="Retire every cached FAQ reply for the agent (e.g. after prices change outside the knowledge base)."
+)
+async def clear_agent_faq_cache(
+    agent_id: str,
+    current_user: User = Depends(get_current_user)
+):
+    organization_id = await get_user_organization_id(current_user)
+    supabase = get_supabase_client()
+
+    agent_check = supabase.table("agents").select("id").eq("id", agent_id).eq("organization_id", organization_id).execute()
+    if not agent_check.data:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Agent with ID {agent_id} not found"
+        )
+
+    await invalidate_faq_cache(agent_id)
+    logger.info(f"FAQ cache cleared: {agent_id} by user {current_user.user_id}")
+    return None
+
+
 # ============================================
 # KNOWLEDGE DOCUMENTS ENDPOINTS
 # ============================================
@@ -1151,6 +1180,9 @@ async def update_agent_integration(
         # 🧹 MCP REGISTRY CLEANUP LOGIC
         # =========================================================
         if channel == "mcp":
+            # Servers / API keys may have changed: drop cached schemas on every worker
+            await get_mcp_service().invalidate_agent(agent_id)
+
             # Check if frontend is sending a disconnect or disable command
             is_disconnected = update_data.get("status") == "disconnected"
             is_disabled = update_data.get("enabled") is False
@@ -1266,7 +1298,7 @@ async def init_mcp_tools(
             
         # 2. Trigger the schema translator
         service = get_mcp_service()
-        tools = await service.get_all_tools_schema(supabase, agent_id)
+        tools = await service.get_all_tools_schema(supabase, agent_id, force_refresh=True)
         
         if not tools:
             return {"success": False, "message": "No tables found to synchronize.", "tools_count": 0, "tools": []}
@@ -30,6 +30,7 @@ from app.config import settings as app_settings
 from app.services.webhook_callback_service import get_webhook_callback_service
 from app.services.ticket_service import get_ticket_service
 from app.services.redis_service import acquire_lock
+from app.services.chat_window_service import record_message, invalidate_window
 
 logger = logging.getLogger(__name__)
 
@@ -49,8 +50,8 @@ async def get_user_organization_id(user: User) -> str:
     return user_org.id
 
 def get_supabase_client():
-    """Get Supabase client from settings"""
-    from supabase import create_client
+    """Get the shared (pooled) service-role Supabase client"""
+    from app.services.supabase_client_service import get_shared_supabase
 
     if not app_settings.is_supabase_configured:
         raise HTTPException(
@@ -58,7 +59,7 @@ def get_supabase_client():
             detail="Supabase is not configured"
         )
 
-    return create_client(app_settings.SUPABASE_URL, app_settings.SUPABASE_SERVICE_KEY)
+    return get_shared_supabase()
 
 async def get_default_ai_agent(organization_id: str, supabase) -> Optional[str]:
     """
@@ -236,6 +237,7 @@ async def create_message_internal(chat_data: dict, content: str, user_id: str, s
         raise HTTPException(500, "Failed to insert message")
     
     new_message_id = res.data[0]["id"]
+    await record_message(chat_data["id"], res.data[0])
     
     # 2. Get Customer Data
     cust_res = supabase.table("customers").select("*").eq("id", chat_data["customer_id"]).single().execute()
@@ -250,6 +252,7 @@ async def create_message_internal(chat_data: dict, content: str, user_id: str, s
             
             # [FIX] DELETE the message we just inserted so it doesn't stay in DB
             supabase.table("messages").delete().eq("id", new_message_id).execute()
+            await invalidate_window(chat_data["id"])
             
             raise HTTPException(400, f"Message Failed: {error_msg}")
         
@@ -1903,6 +1906,7 @@ async def create_message(
         if not response.data: raise HTTPException(500, "Failed to create message")
         
         created_message = response.data[0]
+        await record_message(chat_id, created_message)
         supabase.table("chats").update({"last_message_at": datetime.utcnow().isoformat()}).eq("id", chat_id).execute()
 
         # ============================================
@@ -7,6 +7,7 @@ from supabase import create_client
 
 from app.config import settings
 from app.services.ticket_service import get_ticket_service
+from app.services.chat_window_service import record_message
 from app.models.ticket import TicketUpdate, TicketStatus, ActorType
 from app.services.whatsapp_service import get_whatsapp_service 
 from app.services.telegram_service import get_telegram_service 
@@ -192,6 +193,9 @@ async def auto_close_stale_tickets(api_key: str = Depends(verify_internal_secret
                                     "metadata": msg_meta_payload 
                                 }).execute()
 
+                                if msg_insert.data:
+                                    await record_message(t["chat_id"], msg_insert.data[0])
+
                                 if msg_insert.data and getattr(settings, "WEBSOCKET_ENABLED", True):
                                     created_msg = msg_insert.data[0]
                                     try:
@@ -27,6 +27,7 @@ from app.models.webhook import (
 )
 from app.middleware.webhook_auth import get_webhook_secret
 from app.services.message_router_service import get_message_router_service
+from app.services.chat_window_service import record_message, invalidate_window
 from app.services.agent_finder_service import get_agent_finder_service
 from app.services.websocket_service import get_connection_manager
 
@@ -94,6 +95,8 @@ async def save_and_broadcast_system_message(supabase, chat_id, agent_id, org_id,
             "metadata": metadata or {"type": "auto_reply"}
         }
         res = supabase.table("messages").insert(msg_data).execute()
+        if res.data:
+            await record_message(chat_id, res.data[0])
         
         if res.data and app_settings.WEBSOCKET_ENABLED:
             new_msg = res.data[0]
@@ -256,10 +259,10 @@ async def is_duplicate_message(dedup_key: str, ttl: int = 300) -> bool:
 # ============================================
 
 def get_supabase_client():
-    from supabase import create_client
+    from app.services.supabase_client_service import get_shared_supabase
     if not app_settings.is_supabase_configured:
         raise HTTPException(status.HTTP_503_SERVICE_UNAVAILABLE, "Supabase is not configured")
-    return create_client(app_settings.SUPABASE_URL, app_settings.SUPABASE_SERVICE_KEY)
+    return get_shared_supabase()
 
 # ============================================
 # EMAIL WEBHOOK
@@ -709,7 +712,9 @@ async def process_webhook_message_v2(
     is_within, _ = is_within_schedule(schedule, datetime.now(ZoneInfo("UTC")))
     if not is_within:
         msg = "Maaf kami sedang tutup saat ini."
-        try: supabase.table("messages").update({"metadata": {**message_metadata, "out_of_schedule": True}}).eq("id", msg_id).execute()
+        try:
+            supabase.table("messages").update({"metadata": {**message_metadata, "out_of_schedule": True}}).eq("id", msg_id).execute()
+            await invalidate_window(chat_id)
         except: pass
         await send_message_via_channel({"id": chat_id, "channel": channel, "sender_agent_id": agent_id}, {"phone": contact}, msg, supabase)
         await save_and_broadcast_system_message(supabase, chat_id, agent_id, org_id, msg, channel, agent_name=agent["name"])
@@ -815,7 +820,8 @@ async def process_webhook_message_v2(
             message_id=msg_id, 
             supabase_client=supabase, 
             priority=ai_priority,
-            ticket_id=target_ticket_id 
+            ticket_id=target_ticket_id,
+            organization_id=org_id
         )
         return {**res, "handled_by": "ai_v2_queued"}
     else:
@@ -24,6 +24,30 @@ class Settings:
     LAYOUT_MODEL_PATH: Optional[str] = os.getenv("LAYOUT_MODEL_PATH", "./models/layout")
     TABLE_MODEL_PATH: Optional[str] = os.getenv("TABLE_MODEL_PATH", "./models/table")
 
+    # Reranker engine: "torch" (fp32) or "onnx" (int8 quantized, falls back to torch)
+    RERANKER_BACKEND: str = os.getenv("RERANKER_BACKEND", "torch").lower()
+    RERANKER_ONNX_THREADS: int = int(os.getenv("RERANKER_ONNX_THREADS", max(1, (os.cpu_count() or 2) // 2)))
+    RERANKER_ONNX_PARITY_TOLERANCE: float = float(os.getenv("RERANKER_ONNX_PARITY_TOLERANCE", "0.05"))
+    # After a failed model load, queries skip reranking for this long before the load is retried
+    RERANKER_LOAD_RETRY_SECONDS: float = float(os.getenv("RERANKER_LOAD_RETRY_SECONDS", "300"))
+    # Re-run the parity check on every load (tests/test_reranker_parity.py covers it offline)
+    RERANKER_ONNX_PARITY_CHECK: bool = os.getenv("RERANKER_ONNX_PARITY_CHECK", "false").lower() == "true"
+
+    # Cross-request reranker micro-batching
+    RERANKER_BATCH_ENABLED: bool = os.getenv("RERANKER_BATCH_ENABLED", "true").lower() == "true"
+    RERANKER_MAX_BATCH_SIZE: int = int(os.getenv("RERANKER_MAX_BATCH_SIZE", "64"))
+    RERANKER_MAX_WAIT_MS: float = float(os.getenv("RERANKER_MAX_WAIT_MS", "5"))
+
+    # RAG retrieval stage executors (max concurrent blocking calls per stage)
+    RAG_CHROMA_CONCURRENCY: int = int(os.getenv("RAG_CHROMA_CONCURRENCY", "8"))
+    RAG_EMBEDDING_CONCURRENCY: int = int(os.getenv("RAG_EMBEDDING_CONCURRENCY", "8"))
+    RAG_KEYWORD_CONCURRENCY: int = int(os.getenv("RAG_KEYWORD_CONCURRENCY", "4"))
+    RAG_RERANK_CONCURRENCY: int = int(os.getenv("RAG_RERANK_CONCURRENCY", "1"))
+
+    # Keyword (BM25) index for hybrid RAG: "redis" (shared) or "local" (disk snapshots)
+    KEYWORD_INDEX_BACKEND: str = os.getenv("KEYWORD_INDEX_BACKEND", "redis").lower()
+    KEYWORD_INDEX_PATH: str = os.getenv("KEYWORD_INDEX_PATH", "./models/keyword_index")
+
     # Invitation org link
     INVITATION_URL: str = os.getenv("INVITATION_URL", "https://stgconsole.syntra.id")
 
@@ -36,6 +60,111 @@ class Settings:
     # Centralized URL for the Local V2 Proxy Service
     PROXY_BASE_URL: str = os.getenv("PROXY_BASE_URL", "http://localhost:6657/v2")
 
+    # Embedding model served by the proxy (namespaces embedding cache keys)
+    EMBEDDING_MODEL: str = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
+
+    # Ingestion embedding batches (add_documents)
+    EMBEDDING_BATCH_MAX_TOKENS: int = int(os.getenv("EMBEDDING_BATCH_MAX_TOKENS", "20000"))
+    EMBEDDING_BATCH_MAX_ITEMS: int = int(os.getenv("EMBEDDING_BATCH_MAX_ITEMS", "128"))
+    EMBEDDING_BATCH_CONCURRENCY: int = int(os.getenv("EMBEDDING_BATCH_CONCURRENCY", "4"))
+    EMBEDDING_BATCH_RETRIES: int = int(os.getenv("EMBEDDING_BATCH_RETRIES", "3"))
+    EMBEDDING_BATCH_TIMEOUT: float = float(os.getenv("EMBEDDING_BATCH_TIMEOUT", "60"))
+    EMBEDDING_HTTP_POOL_SIZE: int = int(os.getenv("EMBEDDING_HTTP_POOL_SIZE", "16"))
+
+    # Query embedding cache (in-process LRU + shared Redis)
+    EMBEDDING_CACHE_ENABLED: bool = os.getenv("EMBEDDING_CACHE_ENABLED", "true").lower() == "true"
+    EMBEDDING_CACHE_LRU_SIZE: int = int(os.getenv("EMBEDDING_CACHE_LRU_SIZE", "2048"))
+    EMBEDDING_CACHE_TTL: int = int(os.getenv("EMBEDDING_CACHE_TTL", "604800"))
+
+    # Content-hash reuse of chunk embeddings across files / agents (ingestion)
+    EMBEDDING_REUSE_ENABLED: bool = os.getenv("EMBEDDING_REUSE_ENABLED", "true").lower() == "true"
+    EMBEDDING_REUSE_TTL: int = int(os.getenv("EMBEDDING_REUSE_TTL", "7776000"))
+
+    # Versioned RAG answer-context cache (query_context results)
+    RAG_CONTEXT_CACHE_ENABLED: bool = os.getenv("RAG_CONTEXT_CACHE_ENABLED", "true").lower() == "true"
+    RAG_CONTEXT_CACHE_TTL: int = int(os.getenv("RAG_CONTEXT_CACHE_TTL", "1800"))
+
+    # AI reply pipeline (DynamicAIServiceV2)
+    # History is read speculatively in parallel with the chat row; refetched only if historyLimit is larger
+    AI_HISTORY_PREFETCH_LIMIT: int = int(os.getenv("AI_HISTORY_PREFETCH_LIMIT", "20"))
+    # Pipelined mode: MCP discovery + text-only reformulation start while vision is still running
+    AI_PIPELINED_MODE: bool = os.getenv("AI_PIPELINED_MODE", "true").lower() == "true"
+    # Per-branch timeouts (seconds); a timed-out branch degrades instead of failing the reply
+    AI_VISION_TIMEOUT: float = float(os.getenv("AI_VISION_TIMEOUT", "30"))
+    AI_REFORMULATE_TIMEOUT: float = float(os.getenv("AI_REFORMULATE_TIMEOUT", "10"))
+    AI_RAG_TIMEOUT: float = float(os.getenv("AI_RAG_TIMEOUT", "20"))
+    AI_MCP_DISCOVERY_TIMEOUT: float = float(os.getenv("AI_MCP_DISCOVERY_TIMEOUT", "10"))
+    # Stream reply tokens to the web console as ai_message_delta events (flushed every N ms)
+    AI_STREAMING_ENABLED: bool = os.getenv("AI_STREAMING_ENABLED", "false").lower() == "true"
+    AI_STREAM_FLUSH_MS: int = int(os.getenv("AI_STREAM_FLUSH_MS", "50"))
+
+    # MCP tool schema cache (per agent + server URL, revalidated with ETag after the TTL)
+    MCP_SCHEMA_CACHE_TTL: int = int(os.getenv("MCP_SCHEMA_CACHE_TTL", "300"))
+    # Tool calls from one LLM turn run concurrently, capped per MCP server
+    MCP_TOOL_CONCURRENCY_PER_SERVER: int = int(os.getenv("MCP_TOOL_CONCURRENCY_PER_SERVER", "4"))
+    MCP_TOOL_CALL_TIMEOUT: float = float(os.getenv("MCP_TOOL_CALL_TIMEOUT", "30"))
+
+    # Application-lifetime HTTP pools (LLM proxy via aiohttp, MCP servers via httpx)
+    HTTP_POOL_MAX_CONNECTIONS: int = int(os.getenv("HTTP_POOL_MAX_CONNECTIONS", "100"))
+    HTTP_POOL_MAX_PER_HOST: int = int(os.getenv("HTTP_POOL_MAX_PER_HOST", "32"))
+    HTTP_POOL_KEEPALIVE_SECONDS: float = float(os.getenv("HTTP_POOL_KEEPALIVE_SECONDS", "30"))
+
+    # LLM queue scheduler (Redis ZSET of debounce deadlines, one scheduler + bounded worker pool per process)
+    LLM_QUEUE_DEBOUNCE_SECONDS: float = float(os.getenv("LLM_QUEUE_DEBOUNCE_SECONDS", "5"))
+    LLM_QUEUE_WORKERS: int = int(os.getenv("LLM_QUEUE_WORKERS", "16"))
+    LLM_QUEUE_LEASE_SECONDS: float = float(os.getenv("LLM_QUEUE_LEASE_SECONDS", "120"))
+    LLM_QUEUE_POLL_INTERVAL: float = float(os.getenv("LLM_QUEUE_POLL_INTERVAL", "0.5"))
+    # Due chats examined per claim (lane ordering / skipping orgs at their cap happens within this window)
+    LLM_QUEUE_CLAIM_SCAN: int = int(os.getenv("LLM_QUEUE_CLAIM_SCAN", "500"))
+
+    # AI execution admission: global + per-org slots per process, priority lanes, overflow "delay" or "shed"
+    AI_EXEC_GLOBAL_CONCURRENCY: int = int(os.getenv("AI_EXEC_GLOBAL_CONCURRENCY", "12"))
+    AI_EXEC_PER_ORG_CONCURRENCY: int = int(os.getenv("AI_EXEC_PER_ORG_CONCURRENCY", "4"))
+    AI_EXEC_MAX_QUEUE_WAIT: float = float(os.getenv("AI_EXEC_MAX_QUEUE_WAIT", "20"))
+    AI_EXEC_OVERFLOW_POLICY: str = os.getenv("AI_EXEC_OVERFLOW_POLICY", "delay")
+    AI_EXEC_OVERFLOW_DELAY: float = float(os.getenv("AI_EXEC_OVERFLOW_DELAY", "5"))
+
+    # Shared service-role Supabase client (PostgREST connection pool per process)
+    SUPABASE_POOL_MAX_CONNECTIONS: int = int(os.getenv("SUPABASE_POOL_MAX_CONNECTIONS", "50"))
+    SUPABASE_POOL_MAX_KEEPALIVE: int = int(os.getenv("SUPABASE_POOL_MAX_KEEPALIVE", "20"))
+    SUPABASE_POOL_KEEPALIVE_SECONDS: float = float(os.getenv("SUPABASE_POOL_KEEPALIVE_SECONDS", "60"))
+    SUPABASE_POOL_TIMEOUT: float = float(os.getenv("SUPABASE_POOL_TIMEOUT", "120"))
+
+    # Rolling per-chat message window in Redis (history for AI replies without a DB read)
+    CHAT_WINDOW_ENABLED: bool = os.getenv("CHAT_WINDOW_ENABLED", "true").lower() == "true"
+    CHAT_WINDOW_SIZE: int = int(os.getenv("CHAT_WINDOW_SIZE", "50"))
+    CHAT_WINDOW_TTL: int = int(os.getenv("CHAT_WINDOW_TTL", "86400"))
+
+    # Token-budgeted prompt packing (per-agent override: advanced_config.promptTokenBudget)
+    AI_PROMPT_PACKING_ENABLED: bool = os.getenv("AI_PROMPT_PACKING_ENABLED", "true").lower() == "true"
+    AI_PROMPT_TOKEN_BUDGET: int = int(os.getenv("AI_PROMPT_TOKEN_BUDGET", "6000"))
+    AI_PROMPT_RAG_SHARE: float = float(os.getenv("AI_PROMPT_RAG_SHARE", "0.6"))
+    AI_PROMPT_MAX_MESSAGE_TOKENS: int = int(os.getenv("AI_PROMPT_MAX_MESSAGE_TOKENS", "400"))
+    # History + RAG always get at least this much, even when the fixed cost (system prompt, tools) eats the budget
+    AI_PROMPT_MIN_CONTEXT_TOKENS: int = int(os.getenv("AI_PROMPT_MIN_CONTEXT_TOKENS", "1500"))
+
+    # Vision result cache (by media_url and image bytes hash, scoped by prompt + model)
+    VISION_CACHE_ENABLED: bool = os.getenv("VISION_CACHE_ENABLED", "true").lower() == "true"
+    VISION_CACHE_TTL: int = int(os.getenv("VISION_CACHE_TTL", "604800"))
+    VISION_CACHE_HASH_CONTENT: bool = os.getenv("VISION_CACHE_HASH_CONTENT", "true").lower() == "true"
+    VISION_CACHE_MAX_BYTES: int = int(os.getenv("VISION_CACHE_MAX_BYTES", str(10 * 1024 * 1024)))
+    # Must match the proxy's visionModel; part of the cache key so a model switch starts fresh
+    VISION_MODEL: str = os.getenv("VISION_MODEL", "gpt-4o-mini")
+
+    # Semantic FAQ reply cache (agents opt in via advanced_config.faqCacheEnabled / faqCacheThreshold)
+    FAQ_CACHE_ENABLED: bool = os.getenv("FAQ_CACHE_ENABLED", "true").lower() == "true"
+    FAQ_CACHE_TTL: int = int(os.getenv("FAQ_CACHE_TTL", "86400"))
+    FAQ_CACHE_MAX_ENTRIES: int = int(os.getenv("FAQ_CACHE_MAX_ENTRIES", "500"))
+    FAQ_CACHE_DEFAULT_THRESHOLD: float = float(os.getenv("FAQ_CACHE_DEFAULT_THRESHOLD", "0.93"))
+
+    # AI pipeline tracing: per-stage spans on the AI message (metadata.trace), optional OTLP/HTTP export
+    AI_TRACING_ENABLED: bool = os.getenv("AI_TRACING_ENABLED", "true").lower() == "true"
+    # Rewrite metadata.trace once the outbound callback has finished (one extra update per reply)
+    AI_TRACING_PERSIST_FINAL: bool = os.getenv("AI_TRACING_PERSIST_FINAL", "true").lower() == "true"
+    OTEL_TRACES_ENABLED: bool = os.getenv("OTEL_TRACES_ENABLED", "false").lower() == "true"
+    OTEL_EXPORTER_OTLP_ENDPOINT: str = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+    OTEL_SERVICE_NAME: str = os.getenv("OTEL_SERVICE_NAME", "final-crm-be")
+
     # Whisper Configuration (deprecated - now using external API)
     WHISPER_MODEL_NAME: str = os.getenv("WHISPER_MODEL_NAME", "large-v3")
 
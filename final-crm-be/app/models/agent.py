@@ -288,12 +288,16 @@ class AdvancedConfig(BaseModel):
     temperature: TemperatureSetting = Field(default=TemperatureSetting.BALANCED, description="AI temperature")
     historyLimit: int = Field(default=10, ge=5, le=50, description="Conversation history limit")
     handoffTriggers: HandoffTriggers = Field(default_factory=HandoffTriggers, description="Handoff triggers")
+    faqCacheEnabled: bool = Field(default=False, description="Reuse replies to near-duplicate questions")
+    faqCacheThreshold: float = Field(default=0.93, ge=0.8, le=1.0, description="Minimum cosine similarity for a cached reply")
 
     class Config:
         json_schema_extra = {
             "example": {
                 "temperature": "balanced",
                 "historyLimit": 10,
+                "faqCacheEnabled": False,
+                "faqCacheThreshold": 0.93,
                 "handoffTriggers": {
                     "enabled": True,
                     "keywords": ["speak to human"],
@@ -0,0 +1,229 @@
+"""
+AI Execution Limiter - Global + Per-Organization Admission for AI Replies
+
+WHY THIS EXISTS:
+Nothing bounded how many `_execute_ai_logic` calls ran at once. A broadcast
+campaign that triggers hundreds of replies in the same second flooded the LLM
+proxy and starved the event loop for every other tenant on the worker.
+
+SOLUTION:
+- A global slot limit plus a per-organization slot limit (per worker process,
+  like the stage executors).
+- Waiters are served by priority lane (the ticket priority already passed to
+  enqueue: urgent > high > medium > low), FIFO inside a lane. A waiter whose
+  org is at its cap doesn't block other orgs behind it.
+- A turn that can't get a slot within AI_EXEC_MAX_QUEUE_WAIT overflows:
+    "delay" → handed back to the scheduler to run again later
+    "shed"  → low / medium turns are dropped (high / urgent are still delayed)
+- Queue-wait percentiles, shed / delayed counts per lane for /health/pipeline.
+
+The LLM queue admits *before* claiming (headroom() → claim → try_acquire()),
+so turns waiting for a slot stay on queue:due instead of occupying a worker
+slot; acquire() is the blocking path for anything that did not.
+
+USAGE:
+    slot = await limiter.acquire(org_id, priority)
+    if slot is None: ...overflow...
+    try: ... finally: limiter.release(slot)
+"""
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+from collections import defaultdict, deque
+from dataclasses import dataclass, field
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+LANES = ("urgent", "high", "medium", "low")
+_LANE_RANK = {lane: rank for rank, lane in enumerate(LANES)}
+SHEDDABLE_LANES = ("medium", "low")
+
+OVERFLOW_DELAY = "delay"
+OVERFLOW_SHED = "shed"
+
+
+def lane_for(priority: Optional[str]) -> str:
+    lane = str(priority or "").lower()
+    return lane if lane in _LANE_RANK else "low"
+
+
+@dataclass(order=True)
+class _Waiter:
+    rank: int
+    seq: int
+    org_id: str = field(compare=False)
+    lane: str = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+    enqueued_at: float = field(compare=False)
+
+
+@dataclass
+class Slot:
+    org_id: str
+    lane: str
+    wait_ms: float
+
+
+class AIExecutionLimiter:
+    WAIT_SAMPLES = 500
+
+    def __init__(self, global_limit: int, per_org_limit: int, max_queue_wait: float, overflow_policy: str):
+        self.global_limit = global_limit
+        self.per_org_limit = per_org_limit
+        self.max_queue_wait = max_queue_wait
+        self.overflow_policy = overflow_policy if overflow_policy in (OVERFLOW_DELAY, OVERFLOW_SHED) else OVERFLOW_DELAY
+
+        self._active = 0
+        self._org_active: Dict[str, int] = defaultdict(int)
+        self._waiters: List[_Waiter] = []
+        self._seq = itertools.count()
+
+        self._waits: Dict[str, Deque[float]] = {lane: deque(maxlen=self.WAIT_SAMPLES) for lane in LANES}
+        self.stats: Dict[str, Dict[str, int]] = {
+            lane: {"admitted": 0, "queued": 0, "delayed": 0, "shed": 0} for lane in LANES
+        }
+        self.max_waiting = 0
+
+    def _has_capacity(self, org_id: str) -> bool:
+        return self._active < self.global_limit and self._org_active.get(org_id, 0) < self.per_org_limit
+
+    def _grant(self, org_id: str):
+        self._active += 1
+        self._org_active[org_id] += 1
+
+    def _dispatch(self):
+        """Hand free slots to waiters in (lane, arrival) order, skipping orgs that are at their cap."""
+        if not self._waiters or self._active >= self.global_limit:
+            return
+        remaining = []
+        for waiter in sorted(self._waiters):
+            if waiter.future.done():
+                continue
+            if self._has_capacity(waiter.org_id):
+                self._grant(waiter.org_id)
+                waiter.future.set_result(True)
+            else:
+                remaining.append(waiter)
+        heapq.heapify(remaining)
+        self._waiters = remaining
+
+    async def acquire(self, org_id: Optional[str], priority: Optional[str]) -> Optional[Slot]:
+        """Wait for a slot. Returns None if none freed up within max_queue_wait (overflow)."""
+        org_id = org_id or ""
+        lane = lane_for(priority)
+        started = time.perf_counter()
+
+        # Anyone still waiting while this org has capacity is blocked by their own org's cap
+        if self._has_capacity(org_id):
+            self._grant(org_id)
+            return self._admitted(org_id, lane, started)
+
+        waiter = _Waiter(_LANE_RANK[lane], next(self._seq), org_id, lane, asyncio.get_running_loop().create_future(), started)
+        heapq.heappush(self._waiters, waiter)
+        self.stats[lane]["queued"] += 1
+        self.max_waiting = max(self.max_waiting, len(self._waiters))
+
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), timeout=self.max_queue_wait)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            self._abandon(waiter)
+            raise
+
+        if waiter.future.done() and not waiter.future.cancelled():
+            return self._admitted(org_id, lane, started)
+        self._abandon(waiter)
+        return None
+
+    def try_acquire(self, org_id: Optional[str], priority: Optional[str], queued_for: float = 0.0) -> Optional[Slot]:
+        """Non-blocking acquire. queued_for: seconds the turn already waited elsewhere (queue:due)."""
+        org_id = org_id or ""
+        if not self._has_capacity(org_id):
+            return None
+        self._grant(org_id)
+        return self._admitted(org_id, lane_for(priority), time.perf_counter() - max(0.0, queued_for))
+
+    def headroom(self) -> Tuple[int, Dict[str, int]]:
+        """Free global slots, and the slots left for orgs already running (any other org has per_org_limit)."""
+        return (
+            max(0, self.global_limit - self._active),
+            {org: max(0, self.per_org_limit - n) for org, n in self._org_active.items()},
+        )
+
+    def _abandon(self, waiter: _Waiter):
+        if waiter.future.done() and not waiter.future.cancelled():
+            # Granted at the same moment we gave up: give the slot back
+            self._release(waiter.org_id)
+        else:
+            waiter.future.cancel()
+        self._waiters = [w for w in self._waiters if w is not waiter]
+        heapq.heapify(self._waiters)
+
+    def _admitted(self, org_id: str, lane: str, started: float) -> Slot:
+        wait_ms = (time.perf_counter() - started) * 1000
+        self.stats[lane]["admitted"] += 1
+        self._waits[lane].append(wait_ms)
+        return Slot(org_id=org_id, lane=lane, wait_ms=round(wait_ms, 1))
+
+    def _release(self, org_id: str):
+        self._active -= 1
+        self._org_active[org_id] -= 1
+        if self._org_active[org_id] <= 0:
+            del self._org_active[org_id]
+        self._dispatch()
+
+    def release(self, slot: Slot):
+        self._release(slot.org_id)
+
+    def overflow_action(self, priority: Optional[str]) -> str:
+        """What to do with a turn that overflowed: OVERFLOW_SHED or OVERFLOW_DELAY (counted per lane)."""
+        lane = lane_for(priority)
+        if self.overflow_policy == OVERFLOW_SHED and lane in SHEDDABLE_LANES:
+            self.stats[lane]["shed"] += 1
+            return OVERFLOW_SHED
+        self.stats[lane]["delayed"] += 1
+        return OVERFLOW_DELAY
+
+    def get_stats(self) -> Dict[str, Any]:
+        lanes = {}
+        for lane in LANES:
+            samples = sorted(self._waits[lane])
+            lanes[lane] = {
+                **self.stats[lane],
+                "wait_p50_ms": round(samples[len(samples) // 2], 1) if samples else 0.0,
+                "wait_p95_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 1) if samples else 0.0,
+                "wait_max_ms": round(samples[-1], 1) if samples else 0.0,
+            }
+        busiest = sorted(self._org_active.items(), key=lambda kv: kv[1], reverse=True)[:10]
+        return {
+            "global_limit": self.global_limit,
+            "per_org_limit": self.per_org_limit,
+            "overflow_policy": self.overflow_policy,
+            "max_queue_wait": self.max_queue_wait,
+            "active": self._active,
+            "waiting": len(self._waiters),
+            "max_waiting": self.max_waiting,
+            "busiest_orgs": dict(busiest),
+            "lanes": lanes,
+        }
+
+
+_limiter: Optional[AIExecutionLimiter] = None
+
+
+def get_ai_execution_limiter() -> AIExecutionLimiter:
+    global _limiter
+    if _limiter is None:
+        _limiter = AIExecutionLimiter(
+            global_limit=settings.AI_EXEC_GLOBAL_CONCURRENCY,
+            per_org_limit=settings.AI_EXEC_PER_ORG_CONCURRENCY,
+            max_queue_wait=settings.AI_EXEC_MAX_QUEUE_WAIT,
+            overflow_policy=settings.AI_EXEC_OVERFLOW_POLICY,
+        )
+    return _limiter
@@ -0,0 +1,201 @@
+"""
+Chat Window Service - Rolling Per-Chat Conversation Window in Redis
+
+WHY THIS EXISTS:
+Every AI reply re-queried `messages` (created_at desc, limit historyLimit)
+for the chat, moments after the router had written those very rows.
+
+SOLUTION:
+- chatwin:{chat_id}      LIST  newest-first, capped at CHAT_WINDOW_SIZE
+- chatwin:{chat_id}:ver  INT   bumped by every write, guards seeding
+Each entry is the normalised row the AI pipeline needs: id, sender_type,
+content, created_at and a small metadata subset (media fields).
+
+Writers append only to an existing window, so nothing is written until it has
+been seeded. The first reader misses, reads the DB and seeds the window — but
+only if no write happened in between (version check in Lua), otherwise a
+message inserted during the DB read could be missing from the window forever.
+The version is bumped after the DB insert commits, so a seed can already
+contain the row being appended: the append skips ids already in the window.
+Edits and deletes of existing rows drop the window; the next read re-seeds.
+
+Redis errors always degrade to the DB path.
+"""
+import json
+import logging
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.config import settings
+from app.services.redis_service import get_redis
+
+logger = logging.getLogger(__name__)
+
+METADATA_KEYS = ("media_url", "media_type", "filename", "type")
+
+# KEYS: list, ver | ARGV: expected_ver, size, ttl, entries...
+_SEED_LUA = """
+if tostring(redis.call('GET', KEYS[2]) or '0') ~= ARGV[1] or redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+if #ARGV > 3 then
+    redis.call('RPUSH', KEYS[1], unpack(ARGV, 4))
+    redis.call('LTRIM', KEYS[1], 0, tonumber(ARGV[2]) - 1)
+    redis.call('EXPIRE', KEYS[1], ARGV[3])
+end
+return 1
+"""
+
+# KEYS: list, ver | ARGV: entry, id, size, ttl
+_APPEND_LUA = """
+redis.call('INCR', KEYS[2])
+redis.call('EXPIRE', KEYS[2], ARGV[4])
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+if ARGV[2] ~= '' then
+    for _, raw in ipairs(redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[3]) - 1)) do
+        local ok, row = pcall(cjson.decode, raw)
+        if ok and row['id'] ~= nil and tostring(row['id']) == ARGV[2] then
+            return 0
+        end
+    end
+end
+redis.call('LPUSH', KEYS[1], ARGV[1])
+redis.call('LTRIM', KEYS[1], 0, tonumber(ARGV[3]) - 1)
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+return 1
+"""
+
+
+def normalize_message(row: Dict[str, Any]) -> Dict[str, Any]:
+    meta = row.get("metadata") or {}
+    if isinstance(meta, str):
+        try: meta = json.loads(meta)
+        except ValueError: meta = {}
+    return {
+        "id": row.get("id"),
+        "sender_type": row.get("sender_type"),
+        "content": row.get("content") or "",
+        "created_at": row.get("created_at"),
+        "metadata": {k: meta[k] for k in METADATA_KEYS if k in meta},
+    }
+
+
+class ChatWindow:
+    def __init__(self, size: int, ttl: int):
+        self.size = size
+        self.ttl = ttl
+        self.redis = get_redis()
+        self._seed = self.redis.register_script(_SEED_LUA)
+        self._append = self.redis.register_script(_APPEND_LUA)
+        self._lock = threading.Lock()
+        self.stats: Dict[str, int] = {"hits": 0, "misses": 0, "seeds": 0, "seed_skipped": 0, "appends": 0, "invalidations": 0, "redis_errors": 0}
+
+    def _count(self, field: str, n: int = 1):
+        with self._lock:
+            self.stats[field] += n
+
+    @staticmethod
+    def _keys(chat_id: str) -> Tuple[str, str]:
+        return f"chatwin:{chat_id}", f"chatwin:{chat_id}:ver"
+
+    async def read(self, chat_id: str, limit: int) -> Tuple[Optional[List[Dict]], Optional[str]]:
+        """
+        Return (messages newest-first, None) on a hit, or (None, version) on a
+        miss; pass that version to seed() after reading the DB.
+        """
+        list_key, ver_key = self._keys(chat_id)
+        try:
+            pipe = self.redis.pipeline(transaction=True)
+            pipe.lrange(list_key, 0, max(0, min(limit, self.size) - 1))
+            pipe.exists(list_key)
+            pipe.get(ver_key)
+            rows, exists, version = await pipe.execute()
+        except Exception as e:
+            logger.warning(f"⚠️ [ChatWindow] Redis read failed: {e}")
+            self._count("redis_errors")
+            return None, None
+
+        if not exists:
+            self._count("misses")
+            return None, version or "0"
+        self._count("hits")
+        return [json.loads(r) for r in rows], None
+
+    async def seed(self, chat_id: str, version: Optional[str], rows: List[Dict]):
+        """Fill an empty window from a DB read (rows newest-first), unless a write raced it."""
+        if version is None:
+            return
+        list_key, ver_key = self._keys(chat_id)
+        entries = [json.dumps(normalize_message(r), ensure_ascii=False) for r in rows[:self.size]]
+        try:
+            seeded = await self._seed(keys=[list_key, ver_key], args=[version, self.size, self.ttl, *entries])
+            self._count("seeds" if seeded else "seed_skipped")
+        except Exception as e:
+            logger.warning(f"⚠️ [ChatWindow] Seed failed: {e}")
+            self._count("redis_errors")
+
+    async def append(self, chat_id: str, row: Dict[str, Any]):
+        """Write-through for a newly inserted message row (no-op if a racing seed already has it)."""
+        if not chat_id or not row:
+            return
+        list_key, ver_key = self._keys(chat_id)
+        entry = normalize_message(row)
+        try:
+            await self._append(
+                keys=[list_key, ver_key],
+                args=[json.dumps(entry, ensure_ascii=False), str(entry["id"] or ""), self.size, self.ttl],
+            )
+            self._count("appends")
+        except Exception as e:
+            logger.warning(f"⚠️ [ChatWindow] Append failed for {chat_id}: {e}")
+            self._count("redis_errors")
+
+    async def invalidate(self, chat_id: str):
+        """Drop the window after an edit / delete of an existing row."""
+        if not chat_id:
+            return
+        list_key, ver_key = self._keys(chat_id)
+        try:
+            pipe = self.redis.pipeline(transaction=True)
+            pipe.incr(ver_key)
+            pipe.expire(ver_key, self.ttl)
+            pipe.delete(list_key)
+            await pipe.execute()
+            self._count("invalidations")
+        except Exception as e:
+            logger.warning(f"⚠️ [ChatWindow] Invalidate failed for {chat_id}: {e}")
+            self._count("redis_errors")
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return {
+                **self.stats,
+                "size": self.size,
+                "hit_rate": round(self.stats["hits"] / lookups, 4) if lookups else 0.0,
+            }
+
+
+_chat_window: Optional[ChatWindow] = None
+
+
+def get_chat_window() -> Optional[ChatWindow]:
+    """Shared rolling window (None when CHAT_WINDOW_ENABLED is off)."""
+    global _chat_window
+    if _chat_window is None and settings.CHAT_WINDOW_ENABLED:
+        _chat_window = ChatWindow(size=settings.CHAT_WINDOW_SIZE, ttl=settings.CHAT_WINDOW_TTL)
+    return _chat_window
+
+
+async def record_message(chat_id: str, row: Optional[Dict[str, Any]]):
+    window = get_chat_window()
+    if window and row:
+        await window.append(chat_id, row)
+
+
+async def invalidate_window(chat_id: str):
+    window = get_chat_window()
+    if window:
+        await window.invalidate(chat_id)
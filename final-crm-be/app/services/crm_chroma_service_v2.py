@@ -1,68 +1,111 @@
+import json
 import logging
+import asyncio
+import random
+import time
 import requests
 import chromadb
-import torch
+import tiktoken
 import os
 import warnings
 
 import math
+from array import array
 from app.services.credit_service import get_credit_service
 from app.services.subscription_service import get_subscription_service
 from app.models.credit import CreditUsageCreate, QueryType, QueryStatus
+from app.services.keyword_index_service import get_keyword_index
+from app.services.reranker_service import get_reranker_engine, get_reranker_batcher, peek_reranker_batcher
+from app.services.stage_executor import run_in_stage
+from app.services.embedding_cache_service import get_query_embedding_cache, get_chunk_embedding_store
+from app.services.rag_context_cache_service import get_rag_context_cache, bump_collection_version
+from app.services.tracing_service import span, traced
+from app.services.prompt_packer import CONTEXT_SEPARATOR
 
 from chromadb import Settings
+from requests.adapters import HTTPAdapter
 from typing import List, Any, Dict, Tuple
 from app.config import settings
-from transformers import AutoTokenizer, AutoModelForSequenceClassification
 
 
 from langchain_core.documents import Document
-from langchain_community.retrievers import BM25Retriever
-from langchain_chroma import Chroma
-
-from langchain.retrievers import EnsembleRetriever
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
 from langchain_core.embeddings import Embeddings
 
 warnings.filterwarnings("ignore", message=".*copying from a non-meta parameter.*")
 warnings.filterwarnings("ignore", message=".*max_size.*parameter is deprecated.*")
 logger = logging.getLogger(__name__)
 
+_token_encoder = None
+
+def _get_token_encoder():
+    global _token_encoder
+    if _token_encoder is None:
+        _token_encoder = tiktoken.get_encoding("cl100k_base")
+    return _token_encoder
+
+
 class LocalProxyEmbeddingFunction(chromadb.EmbeddingFunction):
     def __init__(self, base_url: str):
         self.base_url = base_url.rstrip("/")
         self.api_key = "proxy-managed"
 
-    def _call_api(self, input: List[str]) -> Tuple[List[List[float]], Dict[str, Any]]:
+        # Pooled keep-alive session shared by every embedding call (thread-safe for POSTs)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.EMBEDDING_HTTP_POOL_SIZE)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _post(self, input: List[str], timeout: float = 120) -> Tuple[List[List[float]], Dict[str, Any]]:
+        """Raw proxy call. Raises on any failure so callers can decide to retry."""
         payload = { "input": input }
         headers = { "Content-Type": "application/json", "Authorization": f"Bearer {self.api_key}" }
 
-        try:
-            response = requests.post(self.base_url, json=payload, headers=headers, timeout=120)
-            if response.status_code != 200:
-                logger.error(f"❌ Proxy Error {response.status_code}")
-                return [], {}
-
-            data = response.json()
-            usage = data.get("usage", {})
-            metadata = data.get("metadata", {})
-            
-            if "cost_usd" in metadata:
-                usage["cost_usd"] = metadata["cost_usd"]
-            if "cost_idr" in metadata:
-                usage["cost_idr"] = metadata["cost_idr"]
-
-            embeddings = []
-            if isinstance(data, dict) and "data" in data:
-                embeddings = [item["embedding"] for item in data["data"]]
-            elif isinstance(data, list):
-                embeddings = data
-            
-            return embeddings, usage
+        response = self.session.post(self.base_url, json=payload, headers=headers, timeout=timeout)
+        if response.status_code != 200:
+            raise RuntimeError(f"Proxy Error {response.status_code}")
+
+        data = response.json()
+        usage = data.get("usage", {})
+        metadata = data.get("metadata", {})
+
+        if "cost_usd" in metadata:
+            usage["cost_usd"] = metadata["cost_usd"]
+        if "cost_idr" in metadata:
+            usage["cost_idr"] = metadata["cost_idr"]
 
+        embeddings = []
+        if isinstance(data, dict) and "data" in data:
+            embeddings = [item["embedding"] for item in data["data"]]
+        elif isinstance(data, list):
+            embeddings = data
+
+        return embeddings, usage
+
+    def _call_api(self, input: List[str]) -> Tuple[List[List[float]], Dict[str, Any]]:
+        try:
+            return self._post(input)
         except Exception as e:
             logger.error(f"❌ Embedding API Crash: {e}")
             return [], {}
 
+    def embed_with_retry(self, input: List[str]) -> Tuple[List[List[float]], Dict[str, Any]]:
+        """Embed one ingestion batch, retrying with exponential backoff. Raises after the last attempt."""
+        attempts = settings.EMBEDDING_BATCH_RETRIES
+        for attempt in range(1, attempts + 1):
+            try:
+                embeddings, usage = self._post(input, timeout=settings.EMBEDDING_BATCH_TIMEOUT)
+                if len(embeddings) != len(input):
+                    raise RuntimeError(f"Expected {len(input)} embeddings, got {len(embeddings)}")
+                return embeddings, usage
+            except Exception as e:
+                if attempt >= attempts:
+                    raise
+                delay = (2 ** (attempt - 1)) + random.uniform(0, 0.5)
+                logger.warning(f"⚠️ Embedding batch ({len(input)} chunks) failed [{attempt}/{attempts}]: {e}. Retrying in {delay:.1f}s")
+                time.sleep(delay)
+
     def __call__(self, input: Any) -> List[List[float]]:
         if isinstance(input, str): input = [input]
         embeddings, _ = self._call_api(input)
@@ -71,6 +114,21 @@ class LocalProxyEmbeddingFunction(chromadb.EmbeddingFunction):
     def embed_with_usage(self, input: List[str]) -> Tuple[List[List[float]], Dict[str, Any]]:
         return self._call_api(input)
 
+    def embed_query(self, text: str) -> List[float]:
+        """Single query embedding through the LRU + Redis cache (hits skip the proxy entirely)"""
+        cache = get_query_embedding_cache()
+        if cache:
+            cached = cache.get_many([text])[0]
+            if cached is not None:
+                return cached
+
+        embeddings, _ = self._call_api([text])
+        if not embeddings:
+            return []
+        if cache:
+            cache.set_many([text], embeddings[:1])
+        return embeddings[0]
+
 
 class LangChainProxyEmbedding(Embeddings):
     def __init__(self, proxy_fn: LocalProxyEmbeddingFunction):
@@ -80,8 +138,29 @@ class LangChainProxyEmbedding(Embeddings):
         return self.proxy_fn(texts)
 
     def embed_query(self, text: str) -> List[float]:
-        result = self.proxy_fn([text])
-        return result[0] if result else []
+        return self.proxy_fn.embed_query(text)
+
+
+class KeywordIndexRetriever(BaseRetriever):
+    """BM25 retriever backed by the persistent keyword index (scores IDs, hydrates top-k only)"""
+    index: Any
+    collection: Any
+    collection_name: str
+    k: int = 100
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        hits = self.index.search(self.collection_name, query, k=self.k)
+        if not hits:
+            return []
+
+        ids = [chunk_id for chunk_id, _ in hits]
+        data = self.collection.get(ids=ids, include=['documents', 'metadatas'])
+        by_id = {
+            cid: Document(page_content=doc, metadata=meta or {})
+            for cid, doc, meta in zip(data['ids'], data['documents'], data['metadatas'])
+        }
+        # Keep BM25 rank order (Chroma returns IDs in storage order)
+        return [by_id[cid] for cid in ids if cid in by_id]
 
 # 2. SERVICE CLASS (With Transformer Reranking)
 class CRMChromaServiceV2:
@@ -105,56 +184,15 @@ class CRMChromaServiceV2:
         self.embedding_fn = LocalProxyEmbeddingFunction(base_url=proxy_url)
         
         self.credit_service = get_credit_service()
-        
-        # Lazy load reranker
-        self._reranker_model = None
-        self._reranker_tokenizer = None
-        self._reranker_loaded = False
+        self.keyword_index = get_keyword_index()
 
     def _get_reranker(self):
-        if not self._reranker_loaded:
-            try:
-                # 1. Path Configuration
-                model_path = settings.RERANKER_MODEL_PATH
-                model_name = "cross-encoder/ms-marco-MiniLM-L-6-v2"
-                
-                # 2. Check Existence & Define Source
-                if os.path.exists(os.path.join(model_path, "config.json")):
-                    logger.info(f"🔄 Loading reranker from {model_path}...")
-                    source = model_path
-                else:
-                    logger.info(f"🔄 Downloading reranker (source: {model_name})...")
-                    source = model_name
-                
-                # 3. Load Model & Tokenizer
-                self._reranker_tokenizer = AutoTokenizer.from_pretrained(source)
-                self._reranker_model = AutoModelForSequenceClassification.from_pretrained(source)
-                
-                # 4. Save if downloaded
-                if source == model_name:
-                    try:
-                        os.makedirs(model_path, exist_ok=True)
-                        self._reranker_tokenizer.save_pretrained(model_path)
-                        self._reranker_model.save_pretrained(model_path)
-                        logger.info(f"💾 Model saved to: {model_path}")
-                    except Exception as save_err:
-                        logger.warning(f"⚠️ Could not save model to {model_path}: {save_err}")
-                
-                # 5. Device Setup Force to use cpu       
-                device = torch.device("cpu")
-                
-                self._reranker_model = self._reranker_model.to(device)
-                self._reranker_model.eval()
-                self._reranker_loaded = True
-                
-                logger.info(f"✅ Reranker loaded on {device} (Forced CPU)")
-                
-            except Exception as e:
-                logger.error(f"❌ Failed to load reranker: {e}")
-                self._reranker_loaded = False
-                return None, None
-        
-        return self._reranker_model, self._reranker_tokenizer
+        """Lazy-load the reranker engine (torch or int8 ONNX, see RERANKER_BACKEND)"""
+        return get_reranker_engine()
+
+    def _get_rerank_backend(self):
+        """(engine, batcher). Blocking: may load the model, so async callers use the rerank stage"""
+        return self._get_reranker(), get_reranker_batcher()
 
     def preload_pdf_models(self):
         """Download and cache layout + table models to local volume"""
@@ -207,217 +245,440 @@ class CRMChromaServiceV2:
             embedding_function=self.embedding_fn
         )
 
+    def _ensure_keyword_index(self, collection) -> None:
+        """One-time backfill for collections created before the keyword index existed"""
+        if self.keyword_index.exists(collection.name):
+            return
+
+        with self.keyword_index.backfill_lock(collection.name):
+            # Another worker may have finished the backfill while we waited
+            if self.keyword_index.exists(collection.name):
+                return
+
+            logger.info(f"🔤 Building keyword index for '{collection.name}' (one-time backfill)...")
+            ids, texts = [], []
+            page_size = 1000
+            while True:
+                page = collection.get(include=['documents'], limit=page_size, offset=len(ids))
+                if not page['ids']:
+                    break
+                ids.extend(page['ids'])
+                texts.extend(page['documents'])
+
+            # Persisted even when empty so we don't rescan an empty collection every query
+            self.keyword_index.add(collection.name, ids, texts)
+
+    def _plan_embedding_batches(self, texts: List[str]) -> List[Tuple[int, int]]:
+        """Split texts into [start, end) slices bounded by EMBEDDING_BATCH_MAX_TOKENS / _MAX_ITEMS"""
+        max_tokens = settings.EMBEDDING_BATCH_MAX_TOKENS
+        max_items = settings.EMBEDDING_BATCH_MAX_ITEMS
+        encoder = _get_token_encoder()
+
+        batches = []
+        start, budget = 0, 0
+        for i, text in enumerate(texts):
+            n_tokens = len(encoder.encode(text, disallowed_special=()))
+            if i > start and (budget + n_tokens > max_tokens or i - start >= max_items):
+                batches.append((start, i))
+                start, budget = i, 0
+            budget += n_tokens
+        batches.append((start, len(texts)))
+        return batches
+
+    @staticmethod
+    def _merge_usage(total: Dict[str, Any], usage: Dict[str, Any]) -> None:
+        for key, value in (usage or {}).items():
+            if isinstance(value, (int, float)):
+                total[key] = total.get(key, 0) + value
+
+    async def _bill_embedding_usage(self, agent_id: str, organization_id: str, filename: str, n_chunks: int, usage: Dict[str, Any], status: QueryStatus = QueryStatus.COMPLETED):
+        # 💰 BILLING LOGIC
+        try:
+            cost_idr = 0.0
+            total_tokens = usage.get("total_tokens", 0)
+
+            if "cost_idr" in usage:
+                # Proxy returns real cost in IDR based on actual model + live rate
+                cost_idr = float(usage["cost_idr"])
+            elif "cost_usd" in usage:
+                # Fallback: proxy returned USD only, convert with default rate
+                cost_idr = float(usage["cost_usd"]) * 16900
+            elif total_tokens > 0:
+                # Fallback: no cost from proxy, estimate (text-embedding-3-small rate)
+                cost_idr = total_tokens * 0.0000002 * 16900
+
+            # Failsafe: If proxy only returned cost but no token count
+            if total_tokens == 0 and cost_idr > 0:
+                total_tokens = int((cost_idr / 16900) / 0.0000002)
+
+            if total_tokens > 0:
+                credits_to_deduct = math.ceil(total_tokens / 250)
+
+                logger.info(f"💸 Cost: Rp{cost_idr:.2f} | Tokens: {total_tokens} | Deducting {credits_to_deduct} credits for Org {organization_id}...")
+
+                # 1. Write immutable record to the Ledger
+                tx_result = await self.credit_service.log_usage(CreditUsageCreate(
+                    organization_id=organization_id,
+                    query_type=QueryType.UPLOAD_FILE,
+                    query_text=f"training file {filename} with {n_chunks} total chunk",
+                    credits_used=credits_to_deduct,
+                    status=status,
+                    input_tokens=total_tokens,
+                    output_tokens=0, # Embeddings are purely input
+                    cost=cost_idr,
+                    metadata={"agent_id": agent_id if agent_id != "file_manager" else None}
+                ))
+                
+                # 2. Enforce the limit against the Subscription
+                if credits_to_deduct > 0:
+                    sub_service = get_subscription_service()
+                    await sub_service.increment_usage(organization_id, credits_to_deduct, cost=cost_idr)
+            else:
+                logger.info("🆓 Cost/Tokens were 0. No deduction made.")
+                
+        except Exception as billing_err:
+            logger.error(f"🚨 BILLING CRASHED (Money saved, but logic failed): {billing_err}")
+
     async def add_documents(self, agent_id: str, texts: List[str], metadatas: List[Dict], organization_id: str = None, filename: str = ""):
+        """
+        Embed + store chunks in token-budgeted batches.
+        Chunks whose exact content was already embedded (any file, any agent) reuse the
+        stored vector; only unique misses go to the proxy. Miss batches are embedded
+        concurrently (bounded by EMBEDDING_BATCH_CONCURRENCY), retried individually with
+        backoff, and written to Chroma as soon as each returns. Usage only covers the
+        tokens actually embedded and is billed once, also when the file fails (batches that
+        did embed were paid for). If any batch ultimately fails, chunks already written for
+        this file are rolled back.
+        """
+        collection = None
+        written_ids: List[str] = []
+        total_usage: Dict[str, Any] = {}
         try:
             if not texts: return False
 
-            embeddings, usage = self.embedding_fn.embed_with_usage(texts)
+            # 💾 STORAGE TARGET
+            collection = self.get_or_create_collection(f"org_{organization_id}" if agent_id == "file_manager" else agent_id)
+            ids = [f"{m.get('doc_id')}_{i}" for i, m in enumerate(metadatas)]
 
-            if not embeddings: raise Exception("Embedding failed")
+            documents = texts
+            if agent_id == "file_manager":
+                prefix_name = metadatas[0].get("filename", "unknown.docx")
+                # Buat prefixed texts (stored docs only; embeddings use the raw chunk)
+                documents = [f"[File: {prefix_name}]\n\n{text}" for text in texts]
+
+            # ♻️ CONTENT-HASH REUSE: check which chunks are stored (no vectors yet), group misses by exact text.
+            # Reused vectors are only fetched per write batch; new ones are kept packed until the store write.
+            store = get_chunk_embedding_store()
+            stored = await asyncio.to_thread(store.contains_many, texts) if store else [False] * len(texts)
+            pending: Dict[str, List[int]] = {}
+            for i, (text, hit) in enumerate(zip(texts, stored)):
+                if not hit:
+                    pending.setdefault(text, []).append(i)
+            miss_texts = list(pending)
+            reused = [i for i, hit in enumerate(stored) if hit]
+
+            semaphore = asyncio.Semaphore(settings.EMBEDDING_BATCH_CONCURRENCY)
+            # New vectors reach the content-hash store only once the whole file succeeded (packed
+            # float32 until then): a rolled-back file must not leave chunks that look "reused".
+            to_store: List[Tuple[List[str], List[array]]] = []
+
+            async def write_rows(rows: List[int], vectors: List[List[float]]):
+                await asyncio.to_thread(
+                    collection.add,
+                    embeddings=vectors, documents=[documents[i] for i in rows],
+                    metadatas=[metadatas[i] for i in rows], ids=[ids[i] for i in rows]
+                )
+                written_ids.extend(ids[i] for i in rows)
+
+            async def run_batch(start: int, end: int):
+                async with semaphore:
+                    batch_texts = miss_texts[start:end]
+                    vectors, usage = await asyncio.to_thread(self.embedding_fn.embed_with_retry, batch_texts)
+                    rows, row_vectors = [], []
+                    for text, vec in zip(batch_texts, vectors):
+                        for i in pending[text]:
+                            rows.append(i)
+                            row_vectors.append(vec)
+                    await write_rows(rows, row_vectors)
+                    self._merge_usage(total_usage, usage)
+                    if store:
+                        to_store.append((batch_texts, [array("f", vec) for vec in vectors]))
+
+            async def write_reused(start: int, end: int):
+                async with semaphore:
+                    rows = reused[start:end]
+                    vectors = await asyncio.to_thread(store.get_many, [texts[i] for i in rows])
+                    # Entries can expire between the existence check and this read: embed those now
+                    lost = [k for k, vec in enumerate(vectors) if vec is None]
+                    if lost:
+                        fresh, usage = await asyncio.to_thread(self.embedding_fn.embed_with_retry, [texts[rows[k]] for k in lost])
+                        for k, vec in zip(lost, fresh):
+                            vectors[k] = vec
+                        self._merge_usage(total_usage, usage)
+                    await write_rows(rows, vectors)
+
+            jobs = []
+            batches = self._plan_embedding_batches(miss_texts) if miss_texts else []
+            jobs.extend(run_batch(s, e) for s, e in batches)
+            step = settings.EMBEDDING_BATCH_MAX_ITEMS
+            jobs.extend(write_reused(s, s + step) for s in range(0, len(reused), step))
+
+            logger.info(
+                f"🧩 '{collection.name}': {len(texts)} chunks → {len(reused)} reused, "
+                f"{len(miss_texts)} unique to embed in {len(batches)} batch(es)"
+            )
+            results = await asyncio.gather(*jobs, return_exceptions=True)
+            failures = [r for r in results if isinstance(r, Exception)]
+            if failures:
+                raise Exception(f"Embedding failed for {len(failures)}/{len(jobs)} batch(es): {failures[0]}")
+
+            for batch_texts, vectors in to_store:
+                await asyncio.to_thread(store.set_many, batch_texts, vectors)
+            to_store.clear()
 
-            # 💰 BILLING LOGIC
             if organization_id:
-                try:
-                    cost_idr = 0.0
-                    total_tokens = usage.get("total_tokens", 0)
-
-                    if "cost_idr" in usage:
-                        # Proxy returns real cost in IDR based on actual model + live rate
-                        cost_idr = float(usage["cost_idr"])
-                    elif "cost_usd" in usage:
-                        # Fallback: proxy returned USD only, convert with default rate
-                        cost_idr = float(usage["cost_usd"]) * 16900
-                    elif total_tokens > 0:
-                        # Fallback: no cost from proxy, estimate (text-embedding-3-small rate)
-                        cost_idr = total_tokens * 0.0000002 * 16900
-
-                    # Failsafe: If proxy only returned cost but no token count
-                    if total_tokens == 0 and cost_idr > 0:
-                        total_tokens = int((cost_idr / 16900) / 0.0000002)
-
-                    if total_tokens > 0:
-                        credits_to_deduct = math.ceil(total_tokens / 250)
-
-                        logger.info(f"💸 Cost: Rp{cost_idr:.2f} | Tokens: {total_tokens} | Deducting {credits_to_deduct} credits for Org {organization_id}...")
-
-                        # 1. Write immutable record to the Ledger
-                        tx_result = await self.credit_service.log_usage(CreditUsageCreate(
-                            organization_id=organization_id,
-                            query_type=QueryType.UPLOAD_FILE,
-                            query_text=f"training file {filename} with {len(texts)} total chunk",
-                            credits_used=credits_to_deduct,
-                            status=QueryStatus.COMPLETED,
-                            input_tokens=total_tokens,
-                            output_tokens=0, # Embeddings are purely input
-                            cost=cost_idr,
-                            metadata={"agent_id": agent_id if agent_id != "file_manager" else None}
-                        ))
-                        
-                        # 2. Enforce the limit against the Subscription
-                        if credits_to_deduct > 0:
-                            sub_service = get_subscription_service()
-                            await sub_service.increment_usage(organization_id, credits_to_deduct, cost=cost_idr)
-                    else:
-                        logger.info("🆓 Cost/Tokens were 0. No deduction made.")
-                        
-                except Exception as billing_err:
-                    logger.error(f"🚨 BILLING CRASHED (Money saved, but logic failed): {billing_err}")
+                await self._bill_embedding_usage(agent_id, organization_id, filename, len(texts), total_usage)
 
-            # 💾 STORAGE LOGIC
-            collection = self.get_or_create_collection(f"org_{organization_id}" if agent_id == "file_manager" else agent_id)
-            ids = [f"{m.get('doc_id')}_{i}" for i, m in enumerate(metadatas)]
-        
-            if agent_id == "file_manager":
-                filename = metadatas[0].get("filename", "unknown.docx")
-                # Buat prefixed texts
-                prefixed_texts = [f"[File: {filename}]\n\n{text}" for text in texts]
-                # Overwrite texts
-                texts = prefixed_texts
-            collection.add(embeddings=embeddings, documents=texts, metadatas=metadatas, ids=ids)
+            try:
+                if self.keyword_index.exists(collection.name):
+                    self.keyword_index.add(collection.name, ids, documents)
+                else:
+                    # Collection predates the index: a plain add would create an index holding only
+                    # this file. Backfill from Chroma instead (it already contains these chunks).
+                    await asyncio.to_thread(self._ensure_keyword_index, collection)
+            except Exception as idx_err:
+                # Drop the index so the next query rebuilds it instead of serving a partial one
+                logger.warning(f"⚠️ Keyword index update failed for '{collection.name}': {idx_err}")
+                self.keyword_index.drop(collection.name)
             return True
 
         except Exception as e:
             logger.error(f"❌ Failed to add documents: {e}")
+            if collection is not None and written_ids:
+                try:
+                    collection.delete(ids=written_ids)
+                    logger.info(f"↩️ Rolled back {len(written_ids)} partially written chunks")
+                except Exception as rb_err:
+                    logger.error(f"❌ Rollback of partial batches failed: {rb_err}")
+            if organization_id and total_usage:
+                # The proxy already charged for the batches that did embed
+                await self._bill_embedding_usage(agent_id, organization_id, filename, len(texts), total_usage, QueryStatus.FAILED)
             return False
+
+        finally:
+            # Any write (even a rolled-back one) invalidates cached contexts for this collection
+            if collection is not None and written_ids:
+                self._bump_context_version(collection.name)
     
+    async def _vector_search(self, collection, query: str, k: int = 100) -> List[Document]:
+        """Semantic search: embedding stage for the proxy call, chroma stage for the ANN query"""
+        with span("rag.embedding"):
+            embedding = await run_in_stage("embedding", self.embedding_fn.embed_query, query)
+        if not embedding:
+            return []
+
+        with span("rag.ann"):
+            res = await run_in_stage(
+                "chroma", collection.query,
+                query_embeddings=[embedding], n_results=k, include=['documents', 'metadatas']
+            )
+        return [
+            Document(page_content=doc, metadata=meta or {})
+            for doc, meta in zip(res['documents'][0], res['metadatas'][0])
+        ]
+
+    @staticmethod
+    def _weighted_rrf(doc_lists: List[List[Document]], weights: List[float], c: int = 60) -> List[Document]:
+        """Weighted Reciprocal Rank Fusion, deduplicated by content (same as EnsembleRetriever)"""
+        scores: Dict[str, float] = {}
+        first_seen: Dict[str, Document] = {}
+        for docs, weight in zip(doc_lists, weights):
+            for rank, doc in enumerate(docs, start=1):
+                key = doc.page_content
+                scores[key] = scores.get(key, 0.0) + weight / (rank + c)
+                first_seen.setdefault(key, doc)
+        return [first_seen[key] for key in sorted(scores, key=scores.get, reverse=True)]
+
+    @staticmethod
+    def _bump_context_version(collection_name: str):
+        bump_collection_version(collection_name)
+
     async def query_context(self, query: str, agent_id: str, n_results: int = 5) -> str:
+        """Formatted RAG context string (see query_context_blocks)."""
+        blocks = await self.query_context_blocks(query, agent_id, n_results)
+        return CONTEXT_SEPARATOR.join(b["text"] for b in blocks)
+
+    async def query_context_blocks(self, query: str, agent_id: str, n_results: int = 5) -> List[Dict[str, Any]]:
         """
-        Triple-Layer Hybrid RAG + Context Healing
-        Layer 1: BM25 (Keywords) - Crucial for short queries like "01"
-        Layer 2: Vector Search (Semantic)
-        Layer 3: Reranker (Sorting ONLY, No Filtering)
-        Layer 4: Context Healing (Fetch neighbor chunks)
+        Triple-Layer Hybrid RAG + Context Healing, behind a versioned result cache.
+        Identical (normalised) queries against an unchanged collection return the
+        cached blocks without touching retrieval, reranking or healing.
+
+        Returns [{"text": "[Source: ...]\n...", "rank": float}] in document order;
+        rank is the rerank position (healed neighbours get their source's rank + 0.5),
+        so prompt packing can keep the most relevant blocks first.
         """
         try:
             clean_query = query.strip()
             
             # Skip only if empty
-            if not clean_query: return ""
-            
-            collection = self.get_or_create_collection(agent_id)
-            
+            if not clean_query: return []
+
+            cache = get_rag_context_cache()
+            version = None
+            if cache:
+                with span("rag.cache_lookup") as s:
+                    cached, version = await run_in_stage("keyword", cache.get, agent_id, clean_query, n_results)
+                    if s: s.attrs["hit"] = cached is not None
+                if cached is not None:
+                    try:
+                        blocks = json.loads(cached)
+                        logger.info(f"⚡ RAG context cache hit for '{agent_id}' (v{version})")
+                        return blocks
+                    except ValueError:
+                        pass  # pre-blocks entry (plain string): rebuild and overwrite
+
+            blocks = await self._build_context(clean_query, agent_id, n_results)
+
+            # Empty results aren't cached: they're cheap, and may come from a transient backend failure
+            if cache and blocks:
+                await run_in_stage("keyword", cache.set, agent_id, clean_query, n_results, version, json.dumps(blocks, ensure_ascii=False))
+            return blocks
+
+        except Exception as e:
+            logger.error(f"❌ Query context failed: {e}", exc_info=True)
+            return []
+
+    async def _build_context(self, clean_query: str, agent_id: str, n_results: int) -> List[Dict[str, Any]]:
+        """
+        Layer 1: BM25 (Keywords) - Crucial for short queries like "01"
+        Layer 2: Vector Search (Semantic)
+        Layer 3: Reranker (Sorting ONLY, No Filtering)
+        Layer 4: Context Healing (Fetch neighbor chunks)
+        """
+        # Every blocking call below runs on its stage's bounded executor,
+        # never on the event loop (see stage_executor).
+        with span("rag.prepare"):
+            collection = await run_in_stage("chroma", self.get_or_create_collection, agent_id)
+
             # --- LAYERS 1 & 2 (Retrieval) ---
-            all_docs_data = collection.get(include=['documents', 'metadatas'])
-            if not all_docs_data['documents']: return ""
-            
-            documents = [
-                Document(page_content=doc, metadata=meta or {})
-                for doc, meta in zip(all_docs_data['documents'], all_docs_data['metadatas'])
-            ]
-            
-            # Increase candidate pool to catch weak keyword matches
-            bm25_retriever = BM25Retriever.from_documents(documents)
-            bm25_retriever.k = 100
-            
-            vectorstore = Chroma(
-                client=self.client,
-                collection_name=agent_id,
-                embedding_function=LangChainProxyEmbedding(self.embedding_fn)  
-            )
-            vector_retriever = vectorstore.as_retriever(search_type="similarity", search_kwargs={"k": 100})
-            
-            try:
-                # Weighted Ensemble: Boost BM25 (0.5) because "01" is a keyword, not a semantic concept
-                ensemble = EnsembleRetriever(retrievers=[bm25_retriever, vector_retriever], weights=[0.5, 0.5])
-                hybrid_results = ensemble.invoke(clean_query)
-            except Exception:
-                hybrid_results = bm25_retriever.invoke(clean_query)
+            await run_in_stage("keyword", self._ensure_keyword_index, collection)
+
+        # Increase candidate pool to catch weak keyword matches
+        bm25_retriever = KeywordIndexRetriever(
+            index=self.keyword_index,
+            collection=collection,
+            collection_name=collection.name,
+            k=100
+        )
 
-            if not hybrid_results: return ""
-            
-            # --- LAYER 3 (Reranking - SORT ONLY) ---
-            final_docs = []
-            model, tokenizer = self._get_reranker()
-            
-            if model and tokenizer:
-                try:
-                    candidates = [doc.page_content for doc in hybrid_results[:50]]
-                    pairs = [[clean_query, doc] for doc in candidates]
-                    
-                    all_scores = []
-                    batch_size = 16
-                    for i in range(0, len(pairs), batch_size):
-                        batch = pairs[i:i + batch_size]
-                        with torch.no_grad():
-                            inputs = tokenizer(batch, padding=True, truncation=True, return_tensors='pt', max_length=512)
-                            logits = model(**inputs).logits.squeeze(-1)
-                            probs = torch.sigmoid(logits)
-                            if probs.is_cuda: probs = probs.cpu()
-                            all_scores.extend(probs.tolist())
-
-                    scored_results = sorted(zip(hybrid_results[:50], all_scores), key=lambda x: x[1], reverse=True)
-                    
-                    # LOGGING
-                    for i, (doc, score) in enumerate(scored_results[:3]):
-                        logger.info(f"   #{i+1} | {score:.6f} | {doc.metadata.get('section_title', 'No Title')}")
-
-                    # [CRITICAL FIX] REMOVED THRESHOLD GATE.
-                    # We take the Top N results regardless of how low the score is.
-                    # Logic: If BM25 found it, it's relevant enough to show the LLM.
-                    final_docs = [doc for doc, s in scored_results]
-                    final_docs = final_docs[:n_results]
-
-                except Exception as e:
-                    logger.error(f"⚠️ Rerank failed: {e}")
-                    final_docs = hybrid_results[:n_results]
-            else:
-                final_docs = hybrid_results[:n_results]
+        # BM25 and vector search run concurrently
+        bm25_results, vector_results = await asyncio.gather(
+            traced("rag.bm25", run_in_stage("keyword", bm25_retriever.invoke, clean_query)),
+            traced("rag.vector", self._vector_search(collection, clean_query, k=100)),
+            return_exceptions=True
+        )
+        if isinstance(vector_results, Exception):
+            logger.warning(f"⚠️ Vector search failed, using BM25 only: {vector_results}")
+            vector_results = []
+        if isinstance(bm25_results, Exception):
+            logger.warning(f"⚠️ BM25 search failed, using vector only: {bm25_results}")
+            bm25_results = []
 
-            if not final_docs: return ""
+        # Weighted Ensemble: Boost BM25 (0.5) because "01" is a keyword, not a semantic concept
+        hybrid_results = self._weighted_rrf([bm25_results, vector_results], weights=[0.5, 0.5])
 
-            # --- LAYER 4: CONTEXT HEALING ---
-            healed_docs_map = {} 
-            
-            for doc in final_docs:
-                meta = doc.metadata
-                doc_id = meta.get('doc_id') or meta.get('file_id')
-                current_idx = meta.get('chunk_index')
+        if not hybrid_results: return []
+        
+        # --- LAYER 3 (Reranking - SORT ONLY) ---
+        final_docs = []
+        batcher = peek_reranker_batcher()
+        reranker = batcher.engine if batcher else None
+        if reranker is None:
+            # First use (or a retry after a failed load) takes the engine lock: keep it off the event loop
+            reranker, batcher = await run_in_stage("rerank", self._get_rerank_backend)
+        
+        if reranker:
+            try:
+                candidates = [doc.page_content for doc in hybrid_results[:50]]
+                pairs = [[clean_query, doc] for doc in candidates]
+                with span("rag.rerank", candidates=len(pairs)):
+                    if batcher:
+                        all_scores = await batcher.score(pairs)
+                    else:
+                        all_scores = await run_in_stage("rerank", reranker.score, pairs, 16)
+
+                scored_results = sorted(zip(hybrid_results[:50], all_scores), key=lambda x: x[1], reverse=True)
                 
-                # 1. Add Original
-                key = f"{doc_id}_{current_idx}"
-                if key not in healed_docs_map:
-                    healed_docs_map[key] = doc
-
-                # 2. Add Neighbor (Solution)
-                if doc_id is not None and current_idx is not None:
-                    next_idx = int(current_idx) + 1
-                    next_key = f"{doc_id}_{next_idx}"
-                    
-                    if next_key not in healed_docs_map:
-                        neighbor = collection.get(
-                            where={
-                                "$and": [
-                                    {"doc_id": {"$eq": doc_id}},
-                                    {"chunk_index": {"$eq": next_idx}}
-                                ]
-                            }
-                        )
-                        if neighbor and neighbor['documents']:
-                            neighbor_doc = Document(
-                                page_content=neighbor['documents'][0],
-                                metadata=neighbor['metadatas'][0]
-                            )
-                            healed_docs_map[next_key] = neighbor_doc
-
-            sorted_docs = sorted(
-                healed_docs_map.values(), 
-                key=lambda d: (d.metadata.get('doc_id', ''), d.metadata.get('chunk_index', 0))
-            )
+                # LOGGING
+                for i, (doc, score) in enumerate(scored_results[:3]):
+                    logger.info(f"   #{i+1} | {score:.6f} | {doc.metadata.get('section_title', 'No Title')}")
+
+                # [CRITICAL FIX] REMOVED THRESHOLD GATE.
+                # We take the Top N results regardless of how low the score is.
+                # Logic: If BM25 found it, it's relevant enough to show the LLM.
+                final_docs = [doc for doc, s in scored_results]
+                final_docs = final_docs[:n_results]
+
+            except Exception as e:
+                logger.error(f"⚠️ Rerank failed: {e}")
+                final_docs = hybrid_results[:n_results]
+        else:
+            final_docs = hybrid_results[:n_results]
+
+        if not final_docs: return []
 
-            formatted = []
-            for doc in sorted_docs:
-                content = doc.page_content.strip()
-                meta = doc.metadata or {}
-                header = f"Source: {meta.get('filename', 'Unknown')}"
-                if 'section_title' in meta and meta['section_title']:
-                    header += f" | {meta['section_title']}"
-                formatted.append(f"[{header}]\n{content}")
+        # --- LAYER 4: CONTEXT HEALING ---
+        # Neighbor IDs are deterministic ({doc_id}_{chunk_index}, see add_documents),
+        # so every neighbor is fetched in ONE batched get regardless of N.
+        healed_docs_map = {} 
+        rank_map = {}
+        neighbor_ids = []
+        
+        for rank, doc in enumerate(final_docs):
+            meta = doc.metadata
+            doc_id = meta.get('doc_id') or meta.get('file_id')
+            current_idx = meta.get('chunk_index')
             
-            return "\n\n###\n\n".join(formatted)
+            # 1. Add Original
+            key = f"{doc_id}_{current_idx}"
+            if key not in healed_docs_map:
+                healed_docs_map[key] = doc
+            rank_map[key] = min(rank_map.get(key, rank), rank)
+
+            # 2. Queue Neighbor
+            if doc_id is not None and current_idx is not None:
+                next_idx = int(current_idx) + 1
+                total_chunks = meta.get('total_chunks')
+                if total_chunks is not None and next_idx >= int(total_chunks):
+                    continue
+                nid = f"{doc_id}_{next_idx}"
+                neighbor_ids.append(nid)
+                rank_map.setdefault(nid, rank + 0.5)
+
+        neighbor_ids = [nid for nid in dict.fromkeys(neighbor_ids) if nid not in healed_docs_map]
+        if neighbor_ids:
+            with span("rag.heal", neighbors=len(neighbor_ids)):
+                neighbors = await run_in_stage("chroma", collection.get, ids=neighbor_ids, include=['documents', 'metadatas'])
+            for nid, ndoc, nmeta in zip(neighbors['ids'], neighbors['documents'], neighbors['metadatas']):
+                healed_docs_map[nid] = Document(page_content=ndoc, metadata=nmeta or {})
+
+        sorted_keys = sorted(
+            healed_docs_map,
+            key=lambda k: (healed_docs_map[k].metadata.get('doc_id', ''), healed_docs_map[k].metadata.get('chunk_index', 0))
+        )
 
-        except Exception as e:
-            logger.error(f"❌ Query context failed: {e}", exc_info=True)
-            return ""
+        blocks = []
+        for key in sorted_keys:
+            doc = healed_docs_map[key]
+            content = doc.page_content.strip()
+            meta = doc.metadata or {}
+            header = f"Source: {meta.get('filename', 'Unknown')}"
+            if 'section_title' in meta and meta['section_title']:
+                header += f" | {meta['section_title']}"
+            blocks.append({"text": f"[{header}]\n{content}", "rank": rank_map.get(key, len(final_docs))})
+        
+        return blocks
                
     def delete_document(self, agent_id: str, file_id: str):
         """
@@ -433,14 +694,18 @@ class CRMChromaServiceV2:
                 logger.warning(f"⚠️ Collection '{agent_id}' already gone. Skipping.")
                 return True
 
+            chunk_ids = collection.get(where={"file_id": {"$eq": file_id}}, include=[])['ids']
             collection.delete(where={"file_id": {"$eq": file_id}})
             
             remaining_count = collection.count()
+            self._bump_context_version(agent_id)
             
             if remaining_count == 0:
                 self.client.delete_collection(name=agent_id)
+                self.keyword_index.drop(agent_id)
                 logger.info(f"🔥 [Auto-Cleanup] Collection '{agent_id}' is empty. Deleted successfully.")
             else:
+                self.keyword_index.remove(agent_id, chunk_ids)
                 logger.info(f"🗑️ Deleted vectors for file {file_id}. Remaining docs: {remaining_count}")
                 
             return True
@@ -452,6 +717,8 @@ class CRMChromaServiceV2:
     def delete_collection(self, agent_id: str):
         try:
             self.client.delete_collection(name=agent_id)
+            self.keyword_index.drop(agent_id)
+            self._bump_context_version(agent_id)
             logger.info(f"🔥 Deleted collection {agent_id}")
             return True
         except: return False
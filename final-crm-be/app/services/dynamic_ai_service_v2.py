@@ -3,6 +3,7 @@ import asyncio
 import json
 import time
 import math
+import uuid
 
 from typing import Dict, Any, Optional, List
 from app.services.crm_chroma_service_v2 import get_crm_chroma_service_v2
@@ -11,6 +12,11 @@ from app.services.webhook_callback_service import get_webhook_callback_service
 from app.services.websocket_service import get_connection_manager
 from app.services.redis_service import acquire_lock
 from app.services.mcp_service import get_mcp_service
+from app.services.chat_window_service import get_chat_window, record_message
+from app.services.vision_cache_service import get_vision_cache
+from app.services.faq_cache_service import get_faq_cache, is_cacheable_reply
+from app.services.tracing_service import pipeline_trace, span, record_span, create_traced_task, current_trace
+from app.config import settings
 
 from app.services.credit_service import get_credit_service
 from app.services.subscription_service import get_subscription_service
@@ -18,6 +24,48 @@ from app.models.credit import CreditUsageCreate, QueryType, QueryStatus
 
 logger = logging.getLogger(__name__)
 
+class _DeltaStreamer:
+    """Coalesces streamed reply tokens into ai_message_delta events (one per AI_STREAM_FLUSH_MS)"""
+
+    def __init__(self, organization_id: str, chat_id: str):
+        self.organization_id = organization_id
+        self.chat_id = chat_id
+        self.provisional_id = str(uuid.uuid4())
+        self.seq = 0
+        self.started = False
+        self.closed = False
+        self._buffer: List[str] = []
+        self._flush_s = settings.AI_STREAM_FLUSH_MS / 1000
+        self._last_flush = time.perf_counter()
+
+    async def push(self, delta: str):
+        self._buffer.append(delta)
+        if time.perf_counter() - self._last_flush >= self._flush_s:
+            await self.flush()
+
+    async def flush(self, done: bool = False, discarded: bool = False):
+        if self.closed or (not self._buffer and not done):
+            return
+        text = "".join(self._buffer)
+        self._buffer = []
+        self._last_flush = time.perf_counter()
+        self.closed = done
+        try:
+            await get_connection_manager().broadcast_ai_message_delta(
+                organization_id=self.organization_id,
+                chat_id=self.chat_id,
+                provisional_id=self.provisional_id,
+                delta=text,
+                seq=self.seq,
+                done=done,
+                discarded=discarded
+            )
+        except Exception as e:
+            logger.warning(f"⚠️ Delta broadcast failed: {e}")
+        self.seq += 1
+        self.started = True
+
+
 class DynamicAIServiceV2:
     # [STABLE] Class-level tracker for alert rate limiting (In-Memory)
     _alert_tracker: Dict[str, float] = {}
@@ -72,16 +120,25 @@ class DynamicAIServiceV2:
             # 2. Webhook (WhatsApp/Telegram) 
             content = message_db_record.get("content", "")
             if content:
-                asyncio.create_task(
+                create_traced_task(
+                    "callback",
                     self.webhook_service.send_callback(
                         chat=chat,
                         message_content=content,
                         supabase=self.supabase
-                    )
+                    ),
+                    channel=chat.get("channel", "") if chat else ""
                 )
         except Exception as e:
             logger.error(f"⚠️ Broadcast failed: {e}")
             
+    async def _persist_trace(self, message_db_record: Dict, trace):
+        metadata = {**(message_db_record.get("metadata") or {}), "trace": trace.summary()}
+        try:
+            await asyncio.to_thread(lambda: self.supabase.table("messages").update({"metadata": metadata}).eq("id", message_db_record["id"]).execute())
+        except Exception as e:
+            logger.debug(f"Final trace not stored for message {message_db_record.get('id')}: {e}")
+
     def _check_and_update_alert_cooldown(self, chat_id: str) -> bool:
         now = time.time()
         last_time = self._alert_tracker.get(chat_id, 0)
@@ -104,13 +161,159 @@ class DynamicAIServiceV2:
         except:
             return "AI Assistant"
 
+    async def _timed(self, timings: Dict[str, float], stage: str, awaitable):
+        """Await and record wall time (ms) under timings[stage] (and as a trace span)"""
+        started = time.perf_counter()
+        try:
+            with span(stage):
+                return await awaitable
+        finally:
+            timings[stage] = round((time.perf_counter() - started) * 1000, 1)
+
+    async def _bounded(self, branch: str, awaitable, timeout: float, default):
+        """Per-branch timeout: a slow branch returns its default instead of stalling the reply"""
+        try:
+            return await asyncio.wait_for(awaitable, timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"⏳ Branch '{branch}' timed out after {timeout}s, continuing without it")
+            return default
+
+    async def _reformulate(self, text: str, vision_context: str, organization_id: str) -> str:
+        raw = f"{text.strip()}\n[Image Analysis: {vision_context}]" if vision_context else text.strip()
+        return await self._bounded(
+            "reformulate",
+            self.speaker.reformulate_query(user_message=text, vision_context=vision_context, organization_id=organization_id),
+            settings.AI_REFORMULATE_TIMEOUT,
+            raw
+        )
+
+    async def _analyze_image(self, image_url: str, prompt: str, organization_id: str) -> str:
+        try:
+            call = lambda: self.speaker.analyze_image(image_url=image_url, prompt=prompt, organization_id=organization_id)
+            cache = get_vision_cache()
+            vision_desc = await self._bounded(
+                "vision",
+                cache.get_or_analyze(image_url, prompt, settings.VISION_MODEL, call) if cache else call(),
+                settings.AI_VISION_TIMEOUT,
+                ""
+            )
+            return vision_desc.strip() if vision_desc else ""
+        except:
+            return ""
+
+    async def _fetch_chat(self, chat_id: str):
+        """Chat row + customer name in one joined read (falls back to two reads)"""
+        try:
+            res = await asyncio.to_thread(lambda: self.supabase.table("chats").select("*, customers(name)").eq("id", chat_id).execute())
+            if not res.data: return None, "Customer"
+            chat = res.data[0]
+            customer = chat.pop("customers", None)
+            if isinstance(customer, list): customer = customer[0] if customer else None
+            return chat, ((customer or {}).get("name") or "Customer")
+        except Exception as e:
+            logger.debug(f"Joined chat/customer read failed, falling back: {e}")
+
+        res = await asyncio.to_thread(lambda: self.supabase.table("chats").select("*").eq("id", chat_id).execute())
+        if not res.data: return None, "Customer"
+        chat = res.data[0]
+
+        real_customer_name = "Customer"
+        if chat.get("customer_id"):
+            try:
+                cust_res = await asyncio.to_thread(lambda: self.supabase.table("customers").select("name").eq("id", chat.get("customer_id")).single().execute())
+                if cust_res.data: real_customer_name = cust_res.data.get("name", "Customer")
+            except: pass
+        return chat, real_customer_name
+
+    async def _fetch_history(self, chat_id: str, limit: int) -> List[Dict]:
+        """Newest-first history: one Redis read from the rolling chat window, DB (and re-seed) on a miss."""
+        window = get_chat_window()
+        version = None
+        if window and limit <= window.size:
+            rows, version = await window.read(chat_id, limit)
+            if rows is not None:
+                return rows
+
+        # Seed with the full window size so later, larger historyLimits are served from Redis too
+        db_limit = max(limit, window.size) if version is not None else limit
+        res = await asyncio.to_thread(
+            lambda: self.supabase.table("messages")
+            .select("id, content, sender_type, metadata, created_at")
+            .eq("chat_id", chat_id)
+            .order("created_at", desc=True)
+            .limit(db_limit)
+            .execute()
+        )
+        rows = res.data or []
+        if version is not None:
+            await window.seed(chat_id, version, rows)
+        return rows[:limit]
+
+    async def _fetch_agent_name(self, agent_id: str) -> Optional[str]:
+        try:
+            res = await asyncio.to_thread(lambda: self.supabase.table("agents").select("name").eq("id", agent_id).single().execute())
+            return res.data.get("name") if res.data else None
+        except:
+            return None
+
+    async def _fetch_agent_settings(self, agent_id: str) -> Dict:
+        res = await asyncio.to_thread(lambda: self.supabase.table("agent_settings").select("*").eq("agent_id", agent_id).execute())
+        if not res.data: return {}
+        agent_settings = res.data[0]
+        # [CRITICAL FIX] Inject agent_id so the Agent class can use it for tool execution later
+        agent_settings["agent_id"] = agent_id
+        return agent_settings
+
+    async def _resolve_agent(self, chat: Dict):
+        """(agent_id, real_agent_name, agent_settings). Name + settings are read concurrently."""
+        agent_id = chat.get("sender_agent_id")
+        real_agent_name = None
+        agent_settings = {}
+
+        if not agent_id:
+            # Fallback: Get the first agent for the org, and grab both ID and Name
+            agent_res = await asyncio.to_thread(lambda: self.supabase.table("agents").select("id, name").eq("organization_id", chat["organization_id"]).limit(1).execute())
+            if agent_res.data:
+                agent_id = agent_res.data[0]["id"]
+                real_agent_name = agent_res.data[0].get("name")
+            if agent_id:
+                agent_settings = await self._fetch_agent_settings(agent_id)
+        else:
+            real_agent_name, agent_settings = await asyncio.gather(
+                self._fetch_agent_name(agent_id),
+                self._fetch_agent_settings(agent_id),
+            )
+
+        # Provide a safe default if the DB lookup fails entirely
+        return agent_id, real_agent_name or "AI Assistant", agent_settings
+
+    async def _fetch_mcp_tools(self, agent_id: Optional[str]) -> List[Dict]:
+        if not agent_id: return []
+        try:
+            return await self._bounded(
+                "mcp_discovery",
+                self.mcp_service.get_all_tools_schema(self.supabase, agent_id),
+                settings.AI_MCP_DISCOVERY_TIMEOUT,
+                []
+            )
+        except Exception as e:
+            logger.warning(f"MCP Tool Discovery Failed: {e}")
+            return []
+
     async def process_and_respond(self, chat_id: str, msg_id: str, priority: str = "low", ticket_id: str = None) -> Dict[str, Any]:
         """
-        Orchestrate the AI response: History + Vision + RAG + MCP
+        Orchestrate the AI response: History + Vision + RAG + MCP.
+        Runs inside the queue worker's trace, or opens its own for direct calls.
         """
+        async with pipeline_trace("ai_reply", chat_id=chat_id, priority=priority):
+            return await self._respond(chat_id, msg_id, priority, ticket_id)
+
+    async def _respond(self, chat_id: str, msg_id: str, priority: str, ticket_id: Optional[str]) -> Dict[str, Any]:
         lock_key = f"ai_v2_lock:{chat_id}"
-        
+        lock_started = time.perf_counter()
+
         async with acquire_lock(lock_key, expire=30) as acquired:
+            record_span("lock", lock_started, acquired=acquired)
             if not acquired:
                 logger.warning(f"🔒 AI V2 Locked for {chat_id}. Skipping.")
                 return {"success": False, "reason": "locked_rate_limited"}
@@ -119,51 +322,25 @@ class DynamicAIServiceV2:
             agent_id = None
             agent_name = "AI Assistant"
             real_agent_name = None
+            timings: Dict[str, float] = {}
+            pipeline_started = time.perf_counter()
+            background: List[asyncio.Task] = []
+            streamer: Optional[_DeltaStreamer] = None
 
             try:
-                # 1. Fetch Chat Data
-                chat_res = await asyncio.to_thread(lambda: self.supabase.table("chats").select("*").eq("id", chat_id).execute())
-                if not chat_res.data: return {"success": False, "reason": "chat_not_found"}
-                chat = chat_res.data[0]
-
-                # Resolve Customer Name
-                real_customer_name = "Customer"
-                if chat.get("customer_id"):
-                    try:
-                        cust_res = await asyncio.to_thread(lambda: self.supabase.table("customers").select("name").eq("id", chat.get("customer_id")).single().execute())
-                        if cust_res.data: real_customer_name = cust_res.data.get("name", "Customer")
-                    except: pass
+                # 1. FAN-IN: chat row (+customer) and a speculative history read only need chat_id
+                prefetch_limit = settings.AI_HISTORY_PREFETCH_LIMIT
+                history_task = asyncio.create_task(self._timed(timings, "history", self._fetch_history(chat_id, prefetch_limit)))
+                background.append(history_task)
+
+                chat, real_customer_name = await self._timed(timings, "chat", self._fetch_chat(chat_id))
+                if not chat: return {"success": False, "reason": "chat_not_found"}
+
+                # 2. Agent identity + settings (needs the chat row); MCP discovery starts as soon as the ID is known
+                agent_id, real_agent_name, agent_settings = await self._timed(timings, "agent", self._resolve_agent(chat))
+                mcp_task = asyncio.create_task(self._timed(timings, "mcp_discovery", self._fetch_mcp_tools(agent_id)))
+                background.append(mcp_task)
 
-                # 2. Fetch Agent Settings & System Identity
-                agent_id = chat.get("sender_agent_id") 
-                
-                # We need to resolve the real_agent_name from the database
-                if not agent_id:
-                    # Fallback: Get the first agent for the org, and grab both ID and Name
-                    agent_res = await asyncio.to_thread(lambda: self.supabase.table("agents").select("id, name").eq("organization_id", chat["organization_id"]).limit(1).execute())
-                    if agent_res.data: 
-                        agent_id = agent_res.data[0]["id"]
-                        real_agent_name = agent_res.data[0].get("name")
-                else:
-                    # We have the ID from the chat, but we need to fetch the real name
-                    try:
-                        agent_name_res = await asyncio.to_thread(lambda: self.supabase.table("agents").select("name").eq("id", agent_id).single().execute())
-                        if agent_name_res.data:
-                            real_agent_name = agent_name_res.data.get("name")
-                    except: pass
-                
-                # Provide a safe default if the DB lookup fails entirely
-                if not real_agent_name:
-                    real_agent_name = "AI Assistant"
-
-                agent_settings = {}
-                if agent_id:
-                    settings_res = await asyncio.to_thread(lambda: self.supabase.table("agent_settings").select("*").eq("agent_id", agent_id).execute())
-                    if settings_res.data: 
-                        agent_settings = settings_res.data[0]
-                        # [CRITICAL FIX] Inject agent_id so the Agent class can use it for tool execution later
-                        agent_settings["agent_id"] = agent_id
-                
                 def parse_cfg(key):
                     val = agent_settings.get(key, {})
                     if isinstance(val, str):
@@ -177,17 +354,12 @@ class DynamicAIServiceV2:
                 
                 agent_name = persona_config.get("name", "AI Assistant")
 
-                # 3. DYNAMIC SNAPSHOT
+                # 3. DYNAMIC SNAPSHOT (trim the prefetch; refetch only if historyLimit exceeds it)
                 history_limit = int(advanced_config.get("historyLimit", 10))
-                msgs_res = await asyncio.to_thread(
-                    lambda: self.supabase.table("messages")
-                    .select("content, sender_type, metadata")
-                    .eq("chat_id", chat_id)
-                    .order("created_at", desc=True)
-                    .limit(history_limit) 
-                    .execute()
-                )
-                raw_snapshot = msgs_res.data
+                raw_snapshot = await history_task
+                if history_limit > prefetch_limit and len(raw_snapshot) >= prefetch_limit:
+                    raw_snapshot = await self._timed(timings, "history_refetch", self._fetch_history(chat_id, history_limit))
+                raw_snapshot = raw_snapshot[:history_limit]
 
                 # 4. MEMORY RECOVERY
                 pending_user_messages = []
@@ -235,62 +407,91 @@ class DynamicAIServiceV2:
                     if url and ("image" in str(meta.get("media_type", "")).lower() or any(ext in url.lower() for ext in ['.jpg', '.jpeg', '.png', '.webp'])):
                         valid_image_urls.append(url)
                 
+                organization_id = chat.get("organization_id", "")
                 vision_context = ""
                 if valid_image_urls:
                     target_img = valid_image_urls[0] 
                     custom_vision = advanced_config.get("vision_prompt")
                     vision_prompt = custom_vision if custom_vision else "Analyze this image. Extract ALL text/codes. Describe context."
-                    try:
-                        vision_desc = await self.speaker.analyze_image(
-                            image_url=target_img, 
-                            prompt=vision_prompt,
-                            organization_id=chat.get("organization_id", "")
-                        )
-                        vision_context = vision_desc.strip() if vision_desc else ""
-                    except: pass
 
-                # 6. RAG QUERY (Always reformulate for clean search)
-                rag_query = await self.speaker.reformulate_query(
-                    user_message=full_user_prompt_text,
-                    vision_context=vision_context,
-                    organization_id=chat.get("organization_id", "")
-                )
-
-                rag_context = ""
-                if rag_query and self.reader:
+                    if settings.AI_PIPELINED_MODE:
+                        # 6. RAG QUERY, speculative: reformulate the text while vision runs.
+                        # Only re-reformulate if the image actually yields codes / text.
+                        text_query_task = asyncio.create_task(self._timed(
+                            timings, "reformulate", self._reformulate(full_user_prompt_text, "", organization_id)
+                        ))
+                        background.append(text_query_task)
+                        vision_context = await self._timed(timings, "vision", self._analyze_image(target_img, vision_prompt, organization_id))
+
+                        if self.speaker.has_searchable_content(vision_context):
+                            text_query_task.cancel()
+                            rag_query = await self._timed(
+                                timings, "reformulate_vision", self._reformulate(full_user_prompt_text, vision_context, organization_id)
+                            )
+                        else:
+                            rag_query = await text_query_task
+                    else:
+                        vision_context = await self._timed(timings, "vision", self._analyze_image(target_img, vision_prompt, organization_id))
+                        rag_query = await self._timed(
+                            timings, "reformulate", self._reformulate(full_user_prompt_text, vision_context, organization_id)
+                        )
+                else:
+                    # 6. RAG QUERY (Always reformulate for clean search)
+                    rag_query = await self._timed(timings, "reformulate", self._reformulate(full_user_prompt_text, "", organization_id))
+
+                # 6b. FAQ CACHE (opt-in per agent): a near-duplicate question reuses a stored reply,
+                # skipping RAG and the LLM. Tool-enabled agents and image turns always run the pipeline,
+                # so only opted-in agents wait for MCP discovery here; everyone else overlaps it with RAG.
+                # Low-priority ticket turns too: the proxy classifies the ticket on the LLM call.
+                # Entries are keyed by the previous AI turn, since rag_query carries no history.
+                classifies_ticket = bool(ticket_id) and str(priority or "").lower() == "low"
+                previous_reply = clean_history[-1]["content"] if clean_history and clean_history[-1]["role"] == "assistant" else ""
+                faq_cache = get_faq_cache() if advanced_config.get("faqCacheEnabled") and not classifies_ticket else None
+                faq_hit, faq_vector = None, None
+                if faq_cache and rag_query and agent_id and self.reader and not valid_image_urls:
+                    if not await mcp_task:
+                        faq_hit, faq_vector = await self._timed(timings, "faq_cache", faq_cache.lookup(
+                            agent_id, agent_settings, rag_query, self.reader.embedding_fn.embed_query,
+                            faq_cache.threshold(advanced_config), previous_reply
+                        ))
+
+                rag_blocks = []
+                if faq_hit is None and rag_query and self.reader:
                     try:
-                        rag_context = await self.reader.query_context(query=rag_query, agent_id=agent_id)
+                        rag_blocks = await self._timed(timings, "rag", self._bounded(
+                            "rag", self.reader.query_context_blocks(query=rag_query, agent_id=agent_id), settings.AI_RAG_TIMEOUT, []
+                        ))
                     except: pass
 
-                # Combine Contexts
-                final_context = rag_context.strip() if rag_context else ""
-
-                # 7. FETCH MCP TOOLS (SKILLS)
-                mcp_tools = []
-                if agent_id:
-                    try:
-                        mcp_tools = await self.mcp_service.get_all_tools_schema(self.supabase, agent_id)
-                    except Exception as e:
-                        logger.warning(f"MCP Tool Discovery Failed: {e}")
+                # 7. MCP TOOLS (SKILLS) - discovery has been running since step 2
+                mcp_tools = await mcp_task
 
                 # 8. CALL SPEAKER V2 (With TOOLS)
                 ticket_categories = ticketing_config.get("categories", [])
+
+                # Optional token streaming to the console; the committed reply still arrives as new_message
+                if faq_hit is None and settings.AI_STREAMING_ENABLED and chat.get("organization_id"):
+                    streamer = _DeltaStreamer(chat["organization_id"], chat_id)
                 
-                response_data = await self.speaker.process_message(
-                    chat_id=chat_id,
-                    customer_message=full_user_prompt_text, 
-                    chat_history=clean_history,             
-                    agent_settings=agent_settings,
-                    organization_id=chat.get("organization_id", ""), 
-                    rag_context=final_context,  
-                    category=priority, 
-                    name_user=real_customer_name,
-                    image_urls=valid_image_urls,
-                    ticket_categories=ticket_categories,
-                    ticket_id=ticket_id,
-                    external_tools=mcp_tools,    
-                    supabase=self.supabase       
-                )
+                if faq_hit is not None:
+                    response_data = {"content": faq_hit.reply, "usage": {}, "metadata": {"faq_cache": faq_hit.as_metadata()}}
+                else:
+                    response_data = await self._timed(timings, "llm", self.speaker.process_message(
+                        chat_id=chat_id,
+                        customer_message=full_user_prompt_text, 
+                        chat_history=clean_history,             
+                        agent_settings=agent_settings,
+                        organization_id=chat.get("organization_id", ""), 
+                        rag_blocks=rag_blocks,
+                        category=priority, 
+                        name_user=real_customer_name,
+                        image_urls=valid_image_urls,
+                        ticket_categories=ticket_categories,
+                        ticket_id=ticket_id,
+                        external_tools=mcp_tools,    
+                        supabase=self.supabase,
+                        on_delta=streamer.push if streamer else None
+                    ))
                 
                 reply_text = response_data.get("content", "Maaf, saya tidak dapat menjawab saat ini.")
                 detected_category = response_data.get("category", priority) 
@@ -302,6 +503,8 @@ class DynamicAIServiceV2:
                         return {"success": False, "reason": "alert_rate_limit"}
 
                 # 9. Save Response
+                timings["total"] = round((time.perf_counter() - pipeline_started) * 1000, 1)
+                logger.info(f"⏱️ AI V2 stage timings for {chat_id}: {timings}")
                 ai_msg = {
                     "chat_id": chat_id,
                     "sender_type": "ai",
@@ -310,17 +513,39 @@ class DynamicAIServiceV2:
                     "metadata": {
                         "is_internal": False,
                         "model": "v2_proxy_local",
-                        "rag_enabled": bool(final_context),
+                        "rag_enabled": bool(rag_blocks),
                         "mcp_enabled": bool(mcp_tools),
                         "guard_priority": detected_category,
                         "token_usage": usage,
-                        "is_error": metadata.get("is_error", False)
+                        "is_error": metadata.get("is_error", False),
+                        "timings_ms": timings,
+                        "tool_calls": metadata.get("tool_calls", []),
+                        "prompt_packing": metadata.get("prompt_packing"),
+                        "prompt_cache": metadata.get("prompt_cache"),
+                        "faq_cache": metadata.get("faq_cache")
                     }
                 }
-
-                res = await asyncio.to_thread(lambda: self.supabase.table("messages").insert(ai_msg).execute())
+                trace = current_trace()
+                if trace:
+                    ai_msg["metadata"]["trace"] = trace.summary()
+                if streamer and streamer.started:
+                    # Lets the console swap the streamed bubble for the committed message
+                    ai_msg["metadata"]["provisional_id"] = streamer.provisional_id
+
+                with span("db.insert"):
+                    res = await asyncio.to_thread(lambda: self.supabase.table("messages").insert(ai_msg).execute())
                 full_db_record = res.data[0]
-                await self._broadcast_response(chat, full_db_record, agent_name, real_agent_name)
+                await record_message(chat_id, full_db_record)
+                if streamer:
+                    await streamer.flush(done=True)
+                with span("broadcast"):
+                    await self._broadcast_response(chat, full_db_record, agent_name, real_agent_name)
+                if trace and settings.AI_TRACING_PERSIST_FINAL:
+                    # Broadcast + outbound callback finish after the insert: store the full trace once they're done
+                    trace.on_complete(lambda t: self._persist_trace(full_db_record, t))
+
+                if faq_cache and faq_hit is None and faq_vector and is_cacheable_reply(reply_text, metadata, real_customer_name):
+                    await faq_cache.store(agent_id, agent_settings, rag_query, faq_vector, reply_text, previous_reply)
 
                 # ---------------------------------------------------------
                 # Billing & Credit Exchange Rate (1 Sub Credit = 250 Tokens)
@@ -370,6 +595,15 @@ class DynamicAIServiceV2:
             except Exception as e:
                 logger.error(f"❌ Manager V2 Critical Failure: {e}", exc_info=True)
                 return {"success": False, "error": str(e)}
+
+            finally:
+                # Early returns must not leave speculative reads running
+                for task in background:
+                    if not task.done():
+                        task.cancel()
+                # Streamed tokens that will never be committed: tell the console to drop the bubble
+                if streamer and streamer.started and not streamer.closed:
+                    await streamer.flush(done=True, discarded=True)
             
                                                            
 def process_dynamic_ai_response_v2(chat_id: str, msg_id: str, supabase: Any, priority: str = "medium", ticket_id: str = None):
@@ -0,0 +1,215 @@
+"""
+Embedding Cache Service - Two-Level (LRU + Redis) Vector Cache
+
+WHY THIS EXISTS:
+Most inbound questions are short and repetitive ("harga?", "jam buka"), yet
+every query embedding was a fresh requests.post to the embedding proxy.
+
+SOLUTION:
+- L1: in-process LRU (per uvicorn worker), no network at all.
+- L2: shared Redis with TTL, so every worker / pod reuses one embedding.
+- Keys are sha256(model + normalised text); vectors are stored as packed
+  float32 (base64) to keep Redis memory small.
+
+Two namespaces share this class:
+- "q": RAG query embeddings, keyed on the normalised query text.
+- "chunk": ingestion chunk embeddings, keyed on the exact chunk content, so
+  the same catalogue uploaded to many agents / folders is embedded once.
+
+Hit / miss counters are exposed through get_stats() for /health/pipeline.
+"""
+import re
+import base64
+import hashlib
+import logging
+import threading
+import unicodedata
+from array import array
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+
+from app.config import settings
+from app.services.redis_service import get_sync_redis
+
+logger = logging.getLogger(__name__)
+
+_WS_RE = re.compile(r"\s+")
+
+
+def normalize_query(text: str) -> str:
+    """NFKC + casefold + collapsed whitespace: "  Harga?\n" and "harga?" share one entry."""
+    return _WS_RE.sub(" ", unicodedata.normalize("NFKC", text or "")).strip().casefold()
+
+
+def _unpack(data: str) -> "array":
+    vec = array("f")
+    vec.frombytes(base64.b64decode(data))
+    return vec
+
+
+def exact_text(text: str) -> str:
+    return text or ""
+
+
+class EmbeddingCache:
+    MGET_CHUNK = 500
+
+    def __init__(
+        self,
+        namespace: str,
+        model: str,
+        normalize: Callable[[str], str] = normalize_query,
+        lru_size: int = 2048,
+        ttl: int = 604800,
+    ):
+        self.namespace = namespace
+        self.model = model
+        self.normalize = normalize
+        self.lru_size = lru_size
+        self.ttl = ttl
+        # L1 holds packed float32 arrays (~6KB per 1536-d vector instead of ~50KB as a list)
+        self._lru: "OrderedDict[str, array]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._redis = None
+        self.stats: Dict[str, int] = {"l1_hits": 0, "l2_hits": 0, "misses": 0, "redis_errors": 0}
+
+    @property
+    def redis(self):
+        if self._redis is None:
+            self._redis = get_sync_redis()
+        return self._redis
+
+    def key(self, text: str) -> str:
+        digest = hashlib.sha256(f"{self.model}\x00{self.normalize(text)}".encode("utf-8")).hexdigest()
+        return f"emb:{self.namespace}:{digest}"
+
+    def _count(self, field: str, n: int = 1):
+        with self._lock:
+            self.stats[field] += n
+
+    def get_many(self, texts: List[str]) -> List[Optional[List[float]]]:
+        """Return cached vectors aligned with texts (None for misses). L2 hits are promoted to L1."""
+        keys = [self.key(t) for t in texts]
+        results: List[Optional[List[float]]] = [None] * len(texts)
+
+        missing = []
+        with self._lock:
+            for i, k in enumerate(keys):
+                vec = self._lru.get(k)
+                if vec is not None:
+                    self._lru.move_to_end(k)
+                    results[i] = vec.tolist()
+                    self.stats["l1_hits"] += 1
+                else:
+                    missing.append(i)
+
+        for start in range(0, len(missing), self.MGET_CHUNK):
+            chunk = missing[start:start + self.MGET_CHUNK]
+            try:
+                values = self.redis.mget([keys[i] for i in chunk])
+            except Exception as e:
+                logger.warning(f"⚠️ [EmbeddingCache:{self.namespace}] Redis read failed: {e}")
+                self._count("redis_errors")
+                values = [None] * len(chunk)
+
+            for i, raw in zip(chunk, values):
+                if raw:
+                    packed = _unpack(raw)
+                    self._remember(keys[i], packed)
+                    results[i] = packed.tolist()
+                    self._count("l2_hits")
+                else:
+                    self._count("misses")
+
+        return results
+
+    def contains_many(self, texts: List[str]) -> List[bool]:
+        """Which texts have a stored vector, without transferring the vectors (EXISTS only)."""
+        keys = [self.key(t) for t in texts]
+        with self._lock:
+            found = [k in self._lru for k in keys]
+
+        missing = [i for i, hit in enumerate(found) if not hit]
+        for start in range(0, len(missing), self.MGET_CHUNK):
+            chunk = missing[start:start + self.MGET_CHUNK]
+            try:
+                pipe = self.redis.pipeline(transaction=False)
+                for i in chunk:
+                    pipe.exists(keys[i])
+                values = pipe.execute()
+            except Exception as e:
+                logger.warning(f"⚠️ [EmbeddingCache:{self.namespace}] Redis read failed: {e}")
+                self._count("redis_errors")
+                values = [0] * len(chunk)
+            for i, exists in zip(chunk, values):
+                found[i] = bool(exists)
+
+        self._count("misses", found.count(False))
+        return found
+
+    def set_many(self, texts: List[str], vectors: List[List[float]]):
+        if not texts:
+            return
+        keys = [self.key(t) for t in texts]
+        packed = [array("f", vec) for vec in vectors]
+        for k, vec in zip(keys, packed):
+            self._remember(k, vec)
+
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for k, vec in zip(keys, packed):
+                pipe.set(k, base64.b64encode(vec.tobytes()).decode("ascii"), ex=self.ttl)
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"⚠️ [EmbeddingCache:{self.namespace}] Redis write failed: {e}")
+            self._count("redis_errors")
+
+    def _remember(self, key: str, vector: "array"):
+        with self._lock:
+            self._lru[key] = vector
+            self._lru.move_to_end(key)
+            while len(self._lru) > self.lru_size:
+                self._lru.popitem(last=False)
+
+    def get_stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.stats["l1_hits"] + self.stats["l2_hits"] + self.stats["misses"]
+            hits = self.stats["l1_hits"] + self.stats["l2_hits"]
+            return {
+                **self.stats,
+                "l1_size": len(self._lru),
+                "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+_query_cache = None
+
+
+def get_query_embedding_cache() -> Optional[EmbeddingCache]:
+    """Cache for RAG query embeddings (None when EMBEDDING_CACHE_ENABLED is off)."""
+    global _query_cache
+    if _query_cache is None and settings.EMBEDDING_CACHE_ENABLED:
+        _query_cache = EmbeddingCache(
+            namespace="q",
+            model=settings.EMBEDDING_MODEL,
+            lru_size=settings.EMBEDDING_CACHE_LRU_SIZE,
+            ttl=settings.EMBEDDING_CACHE_TTL,
+        )
+    return _query_cache
+
+
+_chunk_cache = None
+
+
+def get_chunk_embedding_store() -> Optional[EmbeddingCache]:
+    """Content-hash store for ingestion chunks (None when EMBEDDING_REUSE_ENABLED is off)."""
+    global _chunk_cache
+    if _chunk_cache is None and settings.EMBEDDING_REUSE_ENABLED:
+        _chunk_cache = EmbeddingCache(
+            namespace="chunk",
+            model=settings.EMBEDDING_MODEL,
+            normalize=exact_text,
+            lru_size=256,
+            ttl=settings.EMBEDDING_REUSE_TTL,
+        )
+    return _chunk_cache
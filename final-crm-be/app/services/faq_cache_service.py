@@ -0,0 +1,248 @@
+"""
+FAQ Cache Service - Semantic Reply Cache per Agent (opt-in)
+
+WHY THIS EXISTS:
+A large share of inbound WhatsApp questions are near-duplicates (opening
+hours, prices, addresses), yet each one paid for RAG retrieval and a full
+LLM turn to produce essentially the same answer.
+
+SOLUTION:
+Agents that opt in (advanced_config.faqCacheEnabled) store
+    (embedding of the reformulated query) → final reply
+and serve the closest stored reply when its cosine similarity is at least
+advanced_config.faqCacheThreshold (else FAQ_CACHE_DEFAULT_THRESHOLD).
+
+- faq:{agent_id}:g{gen}:r{ragver}:p{settings_version}   HASH  sha(query) → entry
+  The bucket key carries every input that could change the answer:
+    gen             – explicit invalidation (settings saved, cache cleared)
+    ragver          – the agent's knowledge collection version (bumped by
+                      every document add / delete, see RAGContextCache)
+    settings_version – digest of persona / advanced / ticketing config
+  so stale replies are never read again and expire with the bucket TTL.
+- Buckets are capped at FAQ_CACHE_MAX_ENTRIES; once full, new replies are
+  simply not stored.
+
+Entries are also scoped by the previous AI turn of the conversation (its
+digest, "" for an opening question): the reformulated query carries no
+history, so a follow-up like "berapa harganya?" only matches replies given
+after the same preceding answer.
+
+Only plain turns are served or stored: no MCP tools, no images, no tool
+calls, no errors, no low-priority ticket turns (the proxy classifies those
+on the LLM call), and no reply that names the customer it was written for.
+"""
+import time
+import json
+import base64
+import hashlib
+import logging
+import threading
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+from app.config import settings
+from app.services.redis_service import get_redis
+from app.services.embedding_cache_service import normalize_query
+from app.services.rag_context_cache_service import RAGContextCache
+from app.services.stage_executor import run_in_stage
+
+logger = logging.getLogger(__name__)
+
+SETTINGS_KEYS = ("persona_config", "advanced_config", "ticketing_config")
+
+
+def settings_version(agent_settings: Dict[str, Any]) -> str:
+    """Digest of the agent config that shapes replies (any edit yields a new bucket)."""
+    src = json.dumps(
+        [agent_settings.get(k) for k in SETTINGS_KEYS],
+        sort_keys=True, ensure_ascii=False, default=str
+    )
+    return hashlib.sha256(src.encode("utf-8")).hexdigest()[:16]
+
+
+def context_digest(previous_reply: Optional[str]) -> str:
+    """Digest of the AI turn the question follows ("" when it opens the conversation)."""
+    text = normalize_query(previous_reply or "")
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16] if text else ""
+
+
+def _pack(vector: List[float]) -> str:
+    return base64.b64encode(np.asarray(vector, dtype=np.float32).tobytes()).decode("ascii")
+
+
+def _unpack(data: str) -> np.ndarray:
+    return np.frombuffer(base64.b64decode(data), dtype=np.float32)
+
+
+@dataclass
+class FAQHit:
+    reply: str
+    similarity: float
+    matched_query: str
+
+    def as_metadata(self) -> Dict[str, Any]:
+        return {"hit": True, "similarity": round(self.similarity, 4), "matched_query": self.matched_query}
+
+
+class FAQCache:
+    GEN_PREFIX = "faq:gen"
+    ENTRY_PREFIX = "faq"
+
+    def __init__(self, ttl: int, max_entries: int, default_threshold: float):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.default_threshold = default_threshold
+        self.redis = get_redis()
+        self._lock = threading.Lock()
+        self.stats: Dict[str, int] = {
+            "hits": 0, "misses": 0, "stores": 0, "store_skipped": 0,
+            "invalidations": 0, "redis_errors": 0,
+        }
+
+    def _count(self, field: str, n: int = 1):
+        with self._lock:
+            self.stats[field] += n
+
+    def threshold(self, advanced_config: Dict[str, Any]) -> float:
+        try:
+            return float(advanced_config.get("faqCacheThreshold") or self.default_threshold)
+        except (TypeError, ValueError):
+            return self.default_threshold
+
+    async def _bucket(self, agent_id: str, agent_settings: Dict[str, Any]) -> str:
+        gen, ragver = await self.redis.mget(
+            f"{self.GEN_PREFIX}:{agent_id}", f"{RAGContextCache.VERSION_PREFIX}:{agent_id}"
+        )
+        return f"{self.ENTRY_PREFIX}:{agent_id}:g{gen or 0}:r{ragver or 0}:p{settings_version(agent_settings)}"
+
+    async def lookup(
+        self,
+        agent_id: str,
+        agent_settings: Dict[str, Any],
+        query: str,
+        embed: Callable[[str], List[float]],
+        threshold: float,
+        previous_reply: str = "",
+    ) -> tuple:
+        """
+        Return (hit, vector): hit is an FAQHit or None; vector is the query
+        embedding, to hand back to store() so a miss isn't embedded twice.
+        Only entries stored after the same previous AI turn are considered.
+        """
+        try:
+            bucket = await self._bucket(agent_id, agent_settings)
+            entries = await self.redis.hvals(bucket)
+        except Exception as e:
+            logger.warning(f"⚠️ [FAQCache] Redis read failed: {e}")
+            self._count("redis_errors")
+            return None, None
+
+        try:
+            vector = await run_in_stage("embedding", embed, query)
+        except Exception as e:
+            logger.warning(f"⚠️ [FAQCache] Query embedding failed: {e}")
+            return None, None
+        ctx = context_digest(previous_reply)
+        rows = [r for r in (json.loads(e) for e in entries) if r.get("c", "") == ctx]
+        if not vector or not rows:
+            self._count("misses")
+            return None, vector
+
+        matrix = np.stack([_unpack(r["v"]) for r in rows])
+        q = np.asarray(vector, dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1) * (np.linalg.norm(q) or 1.0)
+        scores = matrix @ q / np.where(norms == 0, 1.0, norms)
+        best = int(np.argmax(scores))
+
+        if float(scores[best]) < threshold:
+            self._count("misses")
+            return None, vector
+
+        self._count("hits")
+        row = rows[best]
+        logger.info(f"⚡ FAQ cache hit for agent {agent_id} (sim {float(scores[best]):.3f}): '{row['q'][:60]}'")
+        return FAQHit(reply=row["reply"], similarity=float(scores[best]), matched_query=row["q"]), vector
+
+    async def store(
+        self,
+        agent_id: str,
+        agent_settings: Dict[str, Any],
+        query: str,
+        vector: Optional[List[float]],
+        reply: str,
+        previous_reply: str = "",
+    ):
+        if not vector or not reply:
+            return
+        ctx = context_digest(previous_reply)
+        field = hashlib.sha256(f"{ctx}\x00{normalize_query(query)}".encode("utf-8")).hexdigest()
+        entry = json.dumps({
+            "q": query, "c": ctx, "v": _pack(vector), "reply": reply, "created_at": int(time.time()),
+        }, ensure_ascii=False)
+        try:
+            bucket = await self._bucket(agent_id, agent_settings)
+            if await self.redis.hlen(bucket) >= self.max_entries:
+                self._count("store_skipped")
+                return
+            pipe = self.redis.pipeline(transaction=True)
+            pipe.hset(bucket, field, entry)
+            pipe.expire(bucket, self.ttl)
+            await pipe.execute()
+            self._count("stores")
+        except Exception as e:
+            logger.warning(f"⚠️ [FAQCache] Redis write failed: {e}")
+            self._count("redis_errors")
+
+    async def invalidate_agent(self, agent_id: str):
+        """Retire every cached reply for an agent (settings saved, knowledge changed, manual clear)."""
+        try:
+            await self.redis.incr(f"{self.GEN_PREFIX}:{agent_id}")
+            self._count("invalidations")
+            logger.info(f"🧹 [FAQCache] Replies invalidated for Agent {agent_id}")
+        except Exception as e:
+            logger.warning(f"⚠️ [FAQCache] Invalidation failed for {agent_id}: {e}")
+            self._count("redis_errors")
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return {
+                **self.stats,
+                "ttl": self.ttl,
+                "max_entries": self.max_entries,
+                "default_threshold": self.default_threshold,
+                "hit_rate": round(self.stats["hits"] / lookups, 4) if lookups else 0.0,
+            }
+
+
+def is_cacheable_reply(reply: str, metadata: Dict[str, Any], customer_name: str) -> bool:
+    """Replies tied to this turn (tools, errors, the customer's name) must not be served to others."""
+    if not reply or metadata.get("is_error") or metadata.get("is_fallback") or metadata.get("tool_calls"):
+        return False
+    name = (customer_name or "").strip()
+    if name and name != "Customer" and len(name) > 2 and name.casefold() in reply.casefold():
+        return False
+    return True
+
+
+_faq_cache: Optional[FAQCache] = None
+
+
+def get_faq_cache() -> Optional[FAQCache]:
+    """Shared semantic reply cache (None when FAQ_CACHE_ENABLED is off; agents still opt in)."""
+    global _faq_cache
+    if _faq_cache is None and settings.FAQ_CACHE_ENABLED:
+        _faq_cache = FAQCache(
+            ttl=settings.FAQ_CACHE_TTL,
+            max_entries=settings.FAQ_CACHE_MAX_ENTRIES,
+            default_threshold=settings.FAQ_CACHE_DEFAULT_THRESHOLD,
+        )
+    return _faq_cache
+
+
+async def invalidate_faq_cache(agent_id: str):
+    cache = get_faq_cache()
+    if cache and agent_id:
+        await cache.invalidate_agent(agent_id)
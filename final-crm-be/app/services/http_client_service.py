@@ -0,0 +1,173 @@
+"""
+HTTP Client Service - Application-Lifetime Pooled HTTP Clients
+
+WHY THIS EXISTS:
+DynamicCRMAgentV2 opened a new aiohttp.ClientSession for every reformulation,
+vision call and tool-loop turn, and MCPService opened a new httpx.AsyncClient
+per request. Every hop to the local LLM proxy / MCP servers paid TCP (and TLS)
+setup again, and nothing bounded how many sockets one worker could open.
+
+SOLUTION:
+- One aiohttp session (LLM proxy) and one httpx client (MCP servers) per
+  process, created in main.lifespan and closed on shutdown.
+- Per-host connection limits + keep-alive, so connections are reused.
+- Callers use `async with proxy_session()` / `async with mcp_client()`; if the
+  pool isn't running on the current event loop (scripts, worker threads) a
+  short-lived client is used instead, exactly like before.
+- Utilisation (in-flight, active / idle connections) is exposed via get_stats().
+"""
+import asyncio
+import logging
+import threading
+from contextlib import asynccontextmanager
+from typing import Any, Dict, Optional
+
+import aiohttp
+import httpx
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class HTTPClientPool:
+    def __init__(self):
+        self.proxy_session: Optional[aiohttp.ClientSession] = None
+        self.mcp_client: Optional[httpx.AsyncClient] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lock = threading.Lock()
+        self.stats: Dict[str, Dict[str, int]] = {
+            "proxy": {"requests": 0, "in_flight": 0, "max_in_flight": 0, "fallbacks": 0},
+            "mcp": {"requests": 0, "in_flight": 0, "max_in_flight": 0, "fallbacks": 0},
+        }
+
+    async def start(self):
+        if self.proxy_session is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+
+        connector = aiohttp.TCPConnector(
+            limit=settings.HTTP_POOL_MAX_CONNECTIONS,
+            limit_per_host=settings.HTTP_POOL_MAX_PER_HOST,
+            keepalive_timeout=settings.HTTP_POOL_KEEPALIVE_SECONDS,
+            ttl_dns_cache=300,
+        )
+        # No session-wide timeout: every call passes its own (10s reformulation, 300s chat, ...)
+        self.proxy_session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=None))
+
+        self.mcp_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=settings.HTTP_POOL_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.HTTP_POOL_MAX_PER_HOST,
+                keepalive_expiry=settings.HTTP_POOL_KEEPALIVE_SECONDS,
+            ),
+            timeout=10.0,
+        )
+        logger.info(
+            f"🔌 HTTP pools started (max {settings.HTTP_POOL_MAX_CONNECTIONS} conns, "
+            f"{settings.HTTP_POOL_MAX_PER_HOST}/host, keep-alive {settings.HTTP_POOL_KEEPALIVE_SECONDS}s)"
+        )
+
+    async def close(self):
+        if self.proxy_session is not None:
+            await self.proxy_session.close()
+            self.proxy_session = None
+        if self.mcp_client is not None:
+            await self.mcp_client.aclose()
+            self.mcp_client = None
+        self._loop = None
+        logger.info("🔌 HTTP pools closed")
+
+    def _usable(self, client: Any) -> bool:
+        if client is None:
+            return False
+        try:
+            return asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            return False
+
+    @asynccontextmanager
+    async def _track(self, name: str):
+        with self._lock:
+            s = self.stats[name]
+            s["requests"] += 1
+            s["in_flight"] += 1
+            s["max_in_flight"] = max(s["max_in_flight"], s["in_flight"])
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.stats[name]["in_flight"] -= 1
+
+    @asynccontextmanager
+    async def proxy_session(self):
+        async with self._track("proxy"):
+            if self._usable(self.proxy_session):
+                yield self.proxy_session
+                return
+            with self._lock:
+                self.stats["proxy"]["fallbacks"] += 1
+            async with aiohttp.ClientSession() as session:
+                yield session
+
+    @asynccontextmanager
+    async def mcp_client_ctx(self):
+        async with self._track("mcp"):
+            if self._usable(self.mcp_client):
+                yield self.mcp_client
+                return
+            with self._lock:
+                self.stats["mcp"]["fallbacks"] += 1
+            async with httpx.AsyncClient() as client:
+                yield client
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = {name: dict(values) for name, values in self.stats.items()}
+
+        stats["proxy"]["pool"] = None
+        if self.proxy_session is not None:
+            connector = self.proxy_session.connector
+            # aiohttp has no public pool API; these are stable attributes since 3.x
+            acquired = len(getattr(connector, "_acquired", ()))
+            idle = sum(len(v) for v in getattr(connector, "_conns", {}).values())
+            stats["proxy"]["pool"] = {
+                "limit": connector.limit,
+                "limit_per_host": connector.limit_per_host,
+                "active": acquired,
+                "idle": idle,
+                "utilisation": round(acquired / connector.limit, 4) if connector.limit else 0.0,
+            }
+
+        stats["mcp"]["pool"] = None
+        if self.mcp_client is not None:
+            try:
+                connections = self.mcp_client._transport._pool.connections
+                idle = sum(1 for c in connections if c.is_idle())
+                active = len(connections) - idle
+                stats["mcp"]["pool"] = {
+                    "limit": settings.HTTP_POOL_MAX_CONNECTIONS,
+                    "active": active,
+                    "idle": idle,
+                    "utilisation": round(active / settings.HTTP_POOL_MAX_CONNECTIONS, 4),
+                }
+            except AttributeError:
+                pass
+        return stats
+
+
+_http_pool = HTTPClientPool()
+
+
+def get_http_pool() -> HTTPClientPool:
+    return _http_pool
+
+
+def proxy_session():
+    """`async with proxy_session() as session:` — pooled aiohttp session for the LLM proxy"""
+    return _http_pool.proxy_session()
+
+
+def mcp_client():
+    """`async with mcp_client() as client:` — pooled httpx client for MCP servers"""
+    return _http_pool.mcp_client_ctx()
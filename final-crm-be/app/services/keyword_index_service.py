@@ -0,0 +1,490 @@
+"""
+Keyword Index Service - Persistent BM25 Inverted Index per Collection
+
+WHY THIS EXISTS:
+query_context used to run collection.get() on the WHOLE agent collection and
+rebuild a BM25Retriever from scratch on every AI reply. For agents with tens
+of thousands of chunks that was the biggest latency + memory cost per reply.
+
+SOLUTION:
+- add_documents / delete_document update a per-collection inverted index
+  incrementally (postings per term + document lengths).
+- The local backend persists a JSON snapshot plus an append-only delta log
+  (one line per add / remove) with a version sidecar, so every process can
+  detect a stale in-memory copy and catch up by replaying only new records.
+- The query path only scores against the index and returns chunk IDs.
+  Texts are hydrated from Chroma for the top-k IDs only.
+
+ARCHITECTURE:
+  [add_documents] → index.add(ids, texts)  → delta record + version bump
+  [delete_document] → index.remove(ids)    → delta record + version bump
+  [query_context] → index.search(query, k) → [(chunk_id, score), ...]
+
+BACKENDS (KEYWORD_INDEX_BACKEND):
+- "redis" (default): postings + length stats live in Redis under
+  collection-scoped keys, so one ingestion updates the index for every
+  uvicorn worker and pod. Search = two pipelined round-trips.
+- "local": snapshot + delta log on disk, for single-process / dev setups.
+  Writes cost O(changed chunks); the snapshot is rewritten (O(corpus)) only
+  when the log is compacted, and every process holds the full index in memory.
+"""
+import os
+import re
+import json
+import math
+import fcntl
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+from redis.exceptions import LockError
+
+from app.config import settings
+from app.services.redis_service import get_sync_redis
+
+logger = logging.getLogger(__name__)
+
+# BM25 (Okapi) parameters — same defaults as rank_bm25 / BM25Retriever
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased word tokens. Keeps short codes like "01" intact."""
+    if not text:
+        return []
+    return _TOKEN_RE.findall(text.lower())
+
+
+def bm25_idf(n_docs: int, doc_freq: int) -> float:
+    """Non-negative BM25 IDF (Lucene variant), stable under incremental updates."""
+    return math.log(1 + (n_docs - doc_freq + 0.5) / (doc_freq + 0.5))
+
+
+def bm25_term_score(tf: int, doc_len: int, avg_len: float, idf: float) -> float:
+    denom = tf + BM25_K1 * (1 - BM25_B + BM25_B * doc_len / (avg_len or 1.0))
+    return idf * (tf * (BM25_K1 + 1)) / denom
+
+
+class _CollectionIndex:
+    """In-memory inverted index for a single collection."""
+
+    def __init__(self, version: int = 0):
+        self.version = version
+        self.postings: Dict[str, Dict[str, int]] = {}  # term -> {chunk_id: tf}
+        self.doc_terms: Dict[str, Dict[str, int]] = {}  # chunk_id -> {term: tf}
+        self.doc_len: Dict[str, int] = {}
+        self.total_len = 0
+        self.log_records = 0  # delta-log records applied on top of the snapshot
+
+    def add(self, chunk_id: str, text: str):
+        if chunk_id in self.doc_terms:
+            self.remove(chunk_id)
+
+        terms: Dict[str, int] = {}
+        for tok in tokenize(text):
+            terms[tok] = terms.get(tok, 0) + 1
+
+        self._index(chunk_id, terms)
+
+    def _index(self, chunk_id: str, terms: Dict[str, int]):
+        self.doc_terms[chunk_id] = terms
+        self.doc_len[chunk_id] = sum(terms.values())
+        self.total_len += self.doc_len[chunk_id]
+        for term, tf in terms.items():
+            self.postings.setdefault(term, {})[chunk_id] = tf
+
+    def remove(self, chunk_id: str):
+        terms = self.doc_terms.pop(chunk_id, None)
+        if terms is None:
+            return
+        self.total_len -= self.doc_len.pop(chunk_id, 0)
+        for term in terms:
+            plist = self.postings.get(term)
+            if plist is None:
+                continue
+            plist.pop(chunk_id, None)
+            if not plist:
+                del self.postings[term]
+
+    def search(self, query: str, k: int) -> List[Tuple[str, float]]:
+        n_docs = len(self.doc_terms)
+        if n_docs == 0:
+            return []
+
+        avg_len = self.total_len / n_docs
+        scores: Dict[str, float] = {}
+        for term in set(tokenize(query)):
+            plist = self.postings.get(term)
+            if not plist:
+                continue
+            idf = bm25_idf(n_docs, len(plist))
+            for chunk_id, tf in plist.items():
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + bm25_term_score(tf, self.doc_len[chunk_id], avg_len, idf)
+
+        return sorted(scores.items(), key=lambda x: x[1], reverse=True)[:k]
+
+    def apply(self, record: Dict):
+        """Replay one delta-log record ({"v", "add": {chunk_id: terms}} or {"v", "remove": [ids]})."""
+        for chunk_id, terms in (record.get("add") or {}).items():
+            if chunk_id in self.doc_terms:
+                self.remove(chunk_id)
+            self._index(chunk_id, terms)
+        for chunk_id in record.get("remove") or ():
+            self.remove(chunk_id)
+        self.version = int(record["v"])
+        self.log_records += 1
+
+    def to_dict(self) -> Dict:
+        return {"version": self.version, "docs": self.doc_terms}
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "_CollectionIndex":
+        idx = cls(version=int(data.get("version", 0)))
+        for chunk_id, terms in (data.get("docs") or {}).items():
+            idx._index(chunk_id, terms)
+        return idx
+
+
+class LocalKeywordIndex:
+    """
+    Disk-persisted keyword index shared by every thread in this process.
+    Files in KEYWORD_INDEX_PATH per collection:
+      {collection}.json  snapshot at some version
+      {collection}.log   {"base": snapshot version} then one JSON line per write
+      {collection}.ver   current version
+    Writers hold an flock so uvicorn workers on the same volume never clobber
+    each other. The log is folded into a new snapshot every COMPACT_EVERY
+    records (or when one write touches half the collection, e.g. a backfill).
+    """
+
+    MAX_LOADED = 64
+    COMPACT_EVERY = 64
+
+    def __init__(self, base_path: str = None):
+        self.base_path = base_path or settings.KEYWORD_INDEX_PATH
+        os.makedirs(self.base_path, exist_ok=True)
+        self._loaded: "OrderedDict[str, _CollectionIndex]" = OrderedDict()
+        self._lock = threading.RLock()
+
+    # --- Paths & versioning ---
+    def _path(self, collection: str, ext: str) -> str:
+        safe = re.sub(r"[^A-Za-z0-9_.-]", "_", collection)
+        return os.path.join(self.base_path, f"{safe}.{ext}")
+
+    def _read_version(self, collection: str) -> Optional[int]:
+        try:
+            with open(self._path(collection, "ver"), "r") as f:
+                return int(f.read().strip() or 0)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    @contextmanager
+    def _file_lock(self, collection: str, ext: str = "lock"):
+        with open(self._path(collection, ext), "w") as lf:
+            fcntl.flock(lf, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lf, fcntl.LOCK_UN)
+
+    def version(self, collection: str) -> int:
+        return self._read_version(collection) or 0
+
+    @contextmanager
+    def backfill_lock(self, collection: str):
+        """Serialise one-time backfills across workers on this volume (separate from the write lock)."""
+        with self._file_lock(collection, "backfill"):
+            yield True
+
+    def exists(self, collection: str) -> bool:
+        return self._read_version(collection) is not None
+
+    # --- Load / persist ---
+    def _read_log(self, collection: str) -> Tuple[Optional[int], List[Dict]]:
+        """(snapshot version the log starts from, records); None if there is no log."""
+        base, records = None, []
+        try:
+            with open(self._path(collection, "log"), "r") as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        break  # torn tail of an in-progress append (not yet visible in .ver)
+                    if "base" in rec:
+                        base = int(rec["base"])
+                    else:
+                        records.append(rec)
+        except FileNotFoundError:
+            pass
+        return base, records
+
+    def _load(self, collection: str) -> Optional[_CollectionIndex]:
+        """Return the in-memory copy, replaying newer log records if another process wrote."""
+        disk_version = self._read_version(collection)
+        if disk_version is None:
+            self._loaded.pop(collection, None)
+            return None
+
+        idx = self._loaded.get(collection)
+        if idx is not None and idx.version == disk_version:
+            self._loaded.move_to_end(collection)
+            return idx
+
+        base, records = self._read_log(collection)
+        if idx is None or base is None or base > idx.version or idx.version > disk_version:
+            # No usable in-memory copy (or the log was compacted past it): snapshot + full replay
+            try:
+                with open(self._path(collection, "json"), "r") as f:
+                    idx = _CollectionIndex.from_dict(json.load(f))
+            except (FileNotFoundError, json.JSONDecodeError) as e:
+                logger.warning(f"⚠️ [KeywordIndex] Snapshot for '{collection}' unreadable: {e}")
+                return None
+
+        for rec in records:
+            if idx.version < int(rec["v"]) <= disk_version:
+                idx.apply(rec)
+
+        if idx.version != disk_version:
+            logger.debug(f"[KeywordIndex] '{collection}' loaded v{idx.version} != sidecar v{disk_version}")
+
+        self._loaded[collection] = idx
+        self._loaded.move_to_end(collection)
+        while len(self._loaded) > self.MAX_LOADED:
+            self._loaded.popitem(last=False)
+        return idx
+
+    def _write_file(self, path: str, content: str):
+        tmp = f"{path}.tmp"
+        with open(tmp, "w") as f:
+            f.write(content)
+        os.replace(tmp, path)
+
+    def _compact(self, collection: str, idx: _CollectionIndex):
+        """Rewrite the snapshot at idx.version and start an empty log on top of it (O(corpus))."""
+        self._write_file(self._path(collection, "json"), json.dumps(idx.to_dict(), separators=(",", ":")))
+        self._write_file(self._path(collection, "log"), json.dumps({"base": idx.version}) + "\n")
+        idx.log_records = 0
+
+    def _commit(self, collection: str, idx: _CollectionIndex, record: Dict):
+        """Append one delta record (O(changed chunks)), compacting when the log has grown."""
+        idx.version += 1
+        record["v"] = idx.version
+        idx.log_records += 1
+
+        log_path = self._path(collection, "log")
+        big_write = 2 * len(record.get("add") or ()) >= max(1, len(idx.doc_terms))
+        if idx.log_records >= self.COMPACT_EVERY or big_write or not os.path.exists(self._path(collection, "json")):
+            self._compact(collection, idx)
+        else:
+            new_log = not os.path.exists(log_path)
+            with open(log_path, "a") as f:
+                if new_log:
+                    # Snapshot written before delta logs existed: it is at the previous version
+                    f.write(json.dumps({"base": idx.version - 1}) + "\n")
+                f.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+        # Sidecar last: readers only replay records up to the version it announces
+        self._write_file(self._path(collection, "ver"), str(idx.version))
+
+    # --- Public API ---
+    def add(self, collection: str, ids: List[str], texts: List[str]):
+        with self._lock, self._file_lock(collection):
+            idx = self._load(collection) or _CollectionIndex()
+            added: Dict[str, Dict[str, int]] = {}
+            for chunk_id, text in zip(ids, texts):
+                idx.add(chunk_id, text)
+                added[chunk_id] = idx.doc_terms[chunk_id]
+            self._commit(collection, idx, {"add": added})
+            self._loaded[collection] = idx
+        logger.info(f"🔤 [KeywordIndex] '{collection}' +{len(ids)} chunks (v{idx.version}, {len(idx.doc_terms)} total)")
+
+    def remove(self, collection: str, ids: List[str]):
+        with self._lock, self._file_lock(collection):
+            idx = self._load(collection)
+            if idx is None:
+                return
+            for chunk_id in ids:
+                idx.remove(chunk_id)
+            self._commit(collection, idx, {"remove": list(ids)})
+            self._loaded[collection] = idx
+        logger.info(f"🔤 [KeywordIndex] '{collection}' -{len(ids)} chunks (v{idx.version}, {len(idx.doc_terms)} total)")
+
+    def drop(self, collection: str):
+        with self._lock, self._file_lock(collection):
+            self._loaded.pop(collection, None)
+            for ext in ("ver", "json", "log"):
+                try:
+                    os.remove(self._path(collection, ext))
+                except FileNotFoundError:
+                    pass
+        logger.info(f"🔤 [KeywordIndex] Dropped index for '{collection}'")
+
+    def search(self, collection: str, query: str, k: int = 100) -> List[Tuple[str, float]]:
+        with self._lock:
+            idx = self._load(collection)
+            if idx is None:
+                return []
+            return idx.search(query, k)
+
+
+class RedisKeywordIndex:
+    """
+    Shared inverted index in Redis. Keys per collection:
+      kwidx:{c}:meta       hash  n_docs, total_len, version
+      kwidx:{c}:len        hash  chunk_id -> doc length
+      kwidx:{c}:terms      hash  chunk_id -> JSON {term: tf} (needed for removal)
+      kwidx:{c}:t:{term}   hash  chunk_id -> tf (postings)
+    """
+
+    PREFIX = "kwidx"
+    BACKFILL_LOCK_SECONDS = 600
+    BACKFILL_WAIT_SECONDS = 120
+
+    def __init__(self, client=None):
+        self.redis = client or get_sync_redis()
+
+    def _key(self, collection: str, *parts: str) -> str:
+        return ":".join((self.PREFIX, collection) + parts)
+
+    def exists(self, collection: str) -> bool:
+        return bool(self.redis.exists(self._key(collection, "meta")))
+
+    def version(self, collection: str) -> int:
+        return int(self.redis.hget(self._key(collection, "meta"), "version") or 0)
+
+    @contextmanager
+    def backfill_lock(self, collection: str):
+        """Cross-worker lock so only one process backfills a collection; yields whether it was acquired."""
+        lock = self.redis.lock(f"lock:{self.PREFIX}:backfill:{collection}", timeout=self.BACKFILL_LOCK_SECONDS, blocking_timeout=self.BACKFILL_WAIT_SECONDS)
+        try:
+            acquired = lock.acquire()
+        except Exception as e:
+            logger.warning(f"⚠️ [KeywordIndex:redis] Backfill lock unavailable for '{collection}': {e}")
+            acquired = False
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                try:
+                    lock.release()
+                except LockError:
+                    pass
+
+    def _unindex(self, pipe, collection: str, chunk_id: str, terms: Dict[str, int]):
+        doc_len = sum(terms.values())
+        for term in terms:
+            pipe.hdel(self._key(collection, "t", term), chunk_id)
+        pipe.hdel(self._key(collection, "len"), chunk_id)
+        pipe.hdel(self._key(collection, "terms"), chunk_id)
+        pipe.hincrby(self._key(collection, "meta"), "n_docs", -1)
+        pipe.hincrby(self._key(collection, "meta"), "total_len", -doc_len)
+
+    def add(self, collection: str, ids: List[str], texts: List[str]):
+        meta_key = self._key(collection, "meta")
+        terms_key = self._key(collection, "terms")
+        docs = []
+        for chunk_id, text in zip(ids, texts):
+            terms: Dict[str, int] = {}
+            for tok in tokenize(text):
+                terms[tok] = terms.get(tok, 0) + 1
+            docs.append((chunk_id, terms))
+
+        # WATCH terms: a concurrent add / remove of the same chunks retries this
+        # read-modify-write, so n_docs / total_len are never double-counted.
+        def write(pipe):
+            existing = pipe.hmget(terms_key, ids) if ids else []
+            pipe.multi()
+            for (chunk_id, terms), old in zip(docs, existing):
+                if old:
+                    self._unindex(pipe, collection, chunk_id, json.loads(old))
+                doc_len = sum(terms.values())
+                for term, tf in terms.items():
+                    pipe.hset(self._key(collection, "t", term), chunk_id, tf)
+                pipe.hset(self._key(collection, "len"), chunk_id, doc_len)
+                pipe.hset(terms_key, chunk_id, json.dumps(terms, separators=(",", ":")))
+                pipe.hincrby(meta_key, "n_docs", 1)
+                pipe.hincrby(meta_key, "total_len", doc_len)
+            pipe.hincrby(meta_key, "version", 1)
+
+        self.redis.transaction(write, terms_key)
+        logger.info(f"🔤 [KeywordIndex:redis] '{collection}' +{len(ids)} chunks")
+
+    def remove(self, collection: str, ids: List[str]):
+        if not ids or not self.exists(collection):
+            return
+        terms_key = self._key(collection, "terms")
+
+        def write(pipe):
+            existing = pipe.hmget(terms_key, ids)
+            pipe.multi()
+            for chunk_id, old in zip(ids, existing):
+                if old:
+                    self._unindex(pipe, collection, chunk_id, json.loads(old))
+            pipe.hincrby(self._key(collection, "meta"), "version", 1)
+
+        self.redis.transaction(write, terms_key)
+        logger.info(f"🔤 [KeywordIndex:redis] '{collection}' -{len(ids)} chunks")
+
+    def drop(self, collection: str):
+        keys = list(self.redis.scan_iter(match=f"{self._key(collection)}:*", count=1000))
+        for i in range(0, len(keys), 500):
+            self.redis.unlink(*keys[i:i + 500])
+        logger.info(f"🔤 [KeywordIndex:redis] Dropped index for '{collection}' ({len(keys)} keys)")
+
+    def search(self, collection: str, query: str, k: int = 100) -> List[Tuple[str, float]]:
+        terms = list(set(tokenize(query)))
+        if not terms:
+            return []
+
+        # Round-trip 1: collection stats + postings for every query term
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hmget(self._key(collection, "meta"), ["n_docs", "total_len"])
+        for term in terms:
+            pipe.hgetall(self._key(collection, "t", term))
+        results = pipe.execute()
+
+        n_docs, total_len = (int(v or 0) for v in results[0])
+        if n_docs <= 0:
+            return []
+        postings = [p for p in results[1:] if p]
+        if not postings:
+            return []
+
+        # Round-trip 2: lengths for candidate chunks only
+        candidates = list({cid for plist in postings for cid in plist})
+        lengths = dict(zip(candidates, self.redis.hmget(self._key(collection, "len"), candidates)))
+
+        avg_len = total_len / n_docs
+        scores: Dict[str, float] = {}
+        for plist in postings:
+            idf = bm25_idf(n_docs, len(plist))
+            for chunk_id, tf in plist.items():
+                doc_len = int(lengths.get(chunk_id) or 0)
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + bm25_term_score(int(tf), doc_len, avg_len, idf)
+
+        return sorted(scores.items(), key=lambda x: x[1], reverse=True)[:k]
+
+
+_keyword_index = None
+
+
+def get_keyword_index():
+    """Return the configured keyword index backend (Redis by default, local disk as fallback)."""
+    global _keyword_index
+    if _keyword_index is None:
+        if settings.KEYWORD_INDEX_BACKEND == "redis":
+            try:
+                index = RedisKeywordIndex()
+                index.redis.ping()
+                _keyword_index = index
+                logger.info("✅ Keyword index backend: Redis (shared across workers)")
+            except Exception as e:
+                logger.warning(f"⚠️ Redis keyword index unavailable ({e}). Falling back to local snapshots.")
+        if _keyword_index is None:
+            _keyword_index = LocalKeywordIndex()
+    return _keyword_index
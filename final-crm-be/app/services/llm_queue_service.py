@@ -1,170 +1,407 @@
 """
-LLM Queue Service (Dynamic Per-Chat Workers)
-Architecture: One Async Task per Active Chat backed by Redis.
+LLM Queue Service (Redis Sorted-Set Scheduler)
+Architecture: One scheduler per process claiming due chats from a shared Redis ZSET.
 Prevents race conditions and "Double Posting" by debouncing user input.
-Includes Supervisor for crash recovery.
+
+WHY THIS CHANGED:
+The previous design spawned one asyncio task per active chat, each polling
+`hgetall` and sleeping, with crash recovery via `scan_iter("queue:ctx:*")`.
+Thousands of concurrent chats meant thousands of coroutines and Redis polls,
+and every uvicorn worker could end up running its own copy of a chat worker.
+
+HOW IT WORKS:
+- queue:ctx:{chat_id}  HASH  latest msg_id / priority / ticket_id / run_at
+                             (+ enqueued_at of the first message, for tracing)
+- queue:due            ZSET  chat_id scored by run_at (debounce deadline)
+- queue:lease          ZSET  claimed chat_id scored by lease expiry
+- queue:claimed:{id}   HASH  copy of the claimed context (for lease recovery)
+
+enqueue() writes the context and (re)sets the ZSET score to now + debounce,
+so every new message pushes the deadline back — same debounce as before.
+A Lua script claims due chats atomically (ZREM due + move ctx to claimed +
+ZADD lease), so each turn runs on exactly one process. The claim is also the
+admission step: it takes chats by priority lane and only as many per org as
+the process's AIExecutionLimiter has room for; the rest stay on queue:due
+(overflow "shed" drops low / medium turns waiting longer than
+AI_EXEC_MAX_QUEUE_WAIT). The context is removed
+at claim time: a message typed while the AI is generating starts a new turn.
+Leases are renewed while the AI runs; an expired lease (process died) puts the
+chat back on queue:due unless a newer turn is already pending.
 """
 import asyncio
-import json
 import time
+import uuid
 import logging
-from typing import Any
+from typing import Any, Dict, Optional, Set
 
 # Import the centralized Redis service
 from app.services.redis_service import get_redis
 
 # Import the AI Processor
 from app.services.dynamic_ai_service_v2 import process_dynamic_ai_response_v2
+from app.services.ai_execution_limiter import get_ai_execution_limiter, OVERFLOW_SHED, Slot
 
-# Import configuration for creating fresh Supabase clients
 from app.config.settings import settings
-from supabase import create_client
+from app.services.supabase_client_service import get_shared_supabase
+from app.services.tracing_service import pipeline_trace, span
 
 logger = logging.getLogger(__name__)
 
+DUE_KEY = "queue:due"
+LEASE_KEY = "queue:lease"
+CTX_PREFIX = "queue:ctx:"
+CLAIMED_PREFIX = "queue:claimed:"
+
+# KEYS: due, lease | ARGV: now, lease_until, limit, ctx_prefix, claimed_prefix, token,
+#                         scan, default_org_cap, [org, remaining_slots]...
+# Admission happens here: due chats are taken by lane (urgent > high > medium > low,
+# due order inside a lane) and chats of orgs with no free slot are left on queue:due,
+# so one org's backlog never occupies worker slots it can't use.
+_CLAIM_LUA = """
+local caps = {}
+for i = 9, #ARGV, 2 do
+    caps[ARGV[i]] = tonumber(ARGV[i + 1])
+end
+local default_cap = tonumber(ARGV[8])
+local lane_rank = {urgent = 1, high = 2, medium = 3, low = 4}
+local lanes = {{}, {}, {}, {}}
+
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[7]))
+for _, id in ipairs(ids) do
+    local meta = redis.call('HMGET', ARGV[4] .. id, 'org_id', 'priority', 'msg_id')
+    if not meta[3] then
+        redis.call('ZREM', KEYS[1], id)
+    else
+        local rank = lane_rank[string.lower(meta[2] or '')] or 4
+        table.insert(lanes[rank], {id, meta[1] or ''})
+    end
+end
+
+local out = {}
+local limit = tonumber(ARGV[3])
+for _, lane in ipairs(lanes) do
+    for _, entry in ipairs(lane) do
+        if #out >= limit then
+            return out
+        end
+        local id, org = entry[1], entry[2]
+        local cap = caps[org] or default_cap
+        if cap > 0 then
+            caps[org] = cap - 1
+            redis.call('ZREM', KEYS[1], id)
+            local ctx_key = ARGV[4] .. id
+            local ctx = redis.call('HGETALL', ctx_key)
+            local claimed_key = ARGV[5] .. id
+            redis.call('DEL', claimed_key)
+            redis.call('HSET', claimed_key, unpack(ctx))
+            redis.call('HSET', claimed_key, 'token', ARGV[6])
+            redis.call('HINCRBY', claimed_key, 'attempts', 1)
+            redis.call('DEL', ctx_key)
+            redis.call('ZADD', KEYS[2], ARGV[2], id)
+            table.insert(out, {id, ctx})
+        end
+    end
+end
+return out
+"""
+
+# KEYS: due | ARGV: cutoff, ctx_prefix, limit
+# Overflow "shed": drops low / medium turns that have been due since before cutoff
+_SHED_LUA = """
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[3]))
+local out = {}
+for _, id in ipairs(ids) do
+    local priority = string.lower(redis.call('HGET', ARGV[2] .. id, 'priority') or '')
+    if priority ~= 'urgent' and priority ~= 'high' then
+        redis.call('ZREM', KEYS[1], id)
+        redis.call('DEL', ARGV[2] .. id)
+        table.insert(out, {id, priority})
+    end
+end
+return out
+"""
+
+# KEYS: lease, claimed_key | ARGV: chat_id, token, lease_until ('' = release)
+_LEASE_LUA = """
+if redis.call('HGET', KEYS[2], 'token') ~= ARGV[2] then
+    return 0
+end
+if ARGV[3] == '' then
+    redis.call('ZREM', KEYS[1], ARGV[1])
+    redis.call('DEL', KEYS[2])
+else
+    redis.call('ZADD', KEYS[1], 'XX', ARGV[3], ARGV[1])
+end
+return 1
+"""
+
+# KEYS: lease, due | ARGV: now, ctx_prefix, claimed_prefix, max_attempts
+_RECLAIM_LUA = """
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, 100)
+local requeued = 0
+for _, id in ipairs(ids) do
+    redis.call('ZREM', KEYS[1], id)
+    local claimed_key = ARGV[3] .. id
+    local ctx_key = ARGV[2] .. id
+    local attempts = tonumber(redis.call('HGET', claimed_key, 'attempts') or '0')
+    if redis.call('EXISTS', claimed_key) == 1 and redis.call('EXISTS', ctx_key) == 0
+        and attempts < tonumber(ARGV[4]) then
+        redis.call('RENAME', claimed_key, ctx_key)
+        redis.call('HDEL', ctx_key, 'token')
+        redis.call('HSET', ctx_key, 'run_at', ARGV[1])
+        redis.call('ZADD', KEYS[2], ARGV[1], id)
+        requeued = requeued + 1
+    else
+        redis.call('DEL', claimed_key)
+    end
+end
+return requeued
+"""
+
+# KEYS: ctx_key, due | ARGV: chat_id, run_at, field, value, ...
+# Puts an overflowed turn back on queue:due unless a newer turn is already pending
+_DEFER_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+redis.call('HSET', KEYS[1], unpack(ARGV, 3))
+redis.call('HSET', KEYS[1], 'run_at', ARGV[2])
+redis.call('ZADD', KEYS[2], ARGV[2], ARGV[1])
+return 1
+"""
+
+
 class LLMQueueService:
+    MAX_ATTEMPTS = 2  # a turn whose process died mid-generation is retried once
+
     def __init__(self):
         # CONFIG: How long to wait for "silence" before replying (Debounce)
-        self.debounce_window = 5.0 
+        self.debounce_window = settings.LLM_QUEUE_DEBOUNCE_SECONDS
+        self.pool_size = settings.LLM_QUEUE_WORKERS
+        self.lease_seconds = settings.LLM_QUEUE_LEASE_SECONDS
+        self.poll_interval = settings.LLM_QUEUE_POLL_INTERVAL
+        self.claim_scan = settings.LLM_QUEUE_CLAIM_SCAN
         self.redis = get_redis()
-        self.is_running = True # Flag to control supervisor loop
+        self.is_running = True # Flag to control scheduler loop
+
+        self._claim = self.redis.register_script(_CLAIM_LUA)
+        self._lease = self.redis.register_script(_LEASE_LUA)
+        self._reclaim = self.redis.register_script(_RECLAIM_LUA)
+        self._defer = self.redis.register_script(_DEFER_LUA)
+        self._shed = self.redis.register_script(_SHED_LUA)
+        self.limiter = get_ai_execution_limiter()
+
+        self._active: Set[asyncio.Task] = set()
+        self._wake: Optional[asyncio.Event] = None
+        self.stats: Dict[str, int] = {"enqueued": 0, "claimed": 0, "completed": 0, "failed": 0, "requeued": 0}
+
+    def _notify(self):
+        # Local enqueues wake the scheduler early; other processes are picked up on the next poll
+        if self._wake is not None:
+            self._wake.set()
 
     async def start_worker(self):
         """
-        [NEW] Supervisor Loop & Crash Recovery.
-        Called by main.py on startup.
-        1. Scans Redis for 'orphaned' chats (pending tasks from before restart).
-        2. Spawns workers for them.
-        3. Idles to keep the background task alive.
+        Scheduler loop. Called by main.py on startup.
+        1. Migrates contexts left by the old per-chat workers onto queue:due.
+        2. Re-queues chats whose lease expired (process died mid-turn).
+        3. Claims due chats up to the free worker / admission slots and runs them.
         """
-        logger.info("🚀 LLM Queue Supervisor: Starting & Scanning for orphans...")
-        
-        try:
-            # RECOVERY: Find chats that have a pending context but no active worker
-            # (This happens if the server crashed while a user was waiting)
-            async for key in self.redis.scan_iter(match="queue:ctx:*"):
-                # key format: "queue:ctx:{chat_id}"
-                chat_id = key.split(":")[-1]
-                
-                # Check if a worker is already active (unlikely on fresh boot, but good check)
-                worker_key = f"worker:active:{chat_id}"
-                is_active = await self.redis.get(worker_key)
-                
-                if not is_active:
-                    logger.info(f"❤️‍🩹 Recovering orphaned chat session: {chat_id}")
-                    # Respawn the worker
-                    asyncio.create_task(self._chat_worker_lifecycle(chat_id))
-                    
-        except Exception as e:
-            logger.error(f"⚠️ Queue Recovery Warning: {e}")
+        logger.info(f"🚀 LLM Queue Scheduler: Starting ({self.pool_size} workers, {self.debounce_window}s debounce)")
+        self._wake = asyncio.Event()
 
-        logger.info("✅ LLM Queue Supervisor: Running")
+        await self._adopt_orphans()
+        last_reclaim = 0.0
+
+        logger.info("✅ LLM Queue Scheduler: Running")
 
-        # Keep the task alive (as expected by main.py)
         while self.is_running:
             try:
-                await asyncio.sleep(5)
+                now = time.time()
+                if now - last_reclaim >= self.lease_seconds / 2:
+                    last_reclaim = now
+                    requeued = await self._reclaim(keys=[LEASE_KEY, DUE_KEY], args=[now, CTX_PREFIX, CLAIMED_PREFIX, self.MAX_ATTEMPTS])
+                    if requeued:
+                        self.stats["requeued"] += requeued
+                        logger.info(f"❤️‍🩹 Re-queued {requeued} chat(s) with expired leases")
+
+                if self.limiter.overflow_policy == OVERFLOW_SHED:
+                    await self._shed_overdue(now)
+
+                global_free, org_free = self.limiter.headroom()
+                free = min(self.pool_size - len(self._active), global_free)
+                if free > 0:
+                    token = uuid.uuid4().hex
+                    args = [
+                        now, now + self.lease_seconds, free, CTX_PREFIX, CLAIMED_PREFIX, token,
+                        self.claim_scan, self.limiter.per_org_limit,
+                    ]
+                    for org, remaining in org_free.items():
+                        args.extend([org, remaining])
+                    claimed = await self._claim(keys=[DUE_KEY, LEASE_KEY], args=args)
+                    for chat_id, flat in claimed:
+                        ctx = dict(zip(flat[::2], flat[1::2]))
+                        self.stats["claimed"] += 1
+                        slot = self.limiter.try_acquire(
+                            ctx.get("org_id"), ctx.get("priority"),
+                            queued_for=time.time() - float(ctx.get("run_at") or now),
+                        )
+                        task = asyncio.create_task(self._run_claimed(chat_id, ctx, token, slot))
+                        self._active.add(task)
+                        task.add_done_callback(self._on_done)
+                    if len(claimed) == free:
+                        continue  # more may be due right now
+
+                # Whatever is still due now is waiting for a slot: released slots wake us (_on_done)
+                await self._sleep_until_next(now)
+
             except asyncio.CancelledError:
-                logger.info("🛑 LLM Queue Supervisor Stopping...")
+                logger.info("🛑 LLM Queue Scheduler Stopping...")
                 break
+            except Exception as e:
+                logger.error(f"⚠️ LLM Queue Scheduler Error: {e}")
+                await asyncio.sleep(1)
+
+    def _on_done(self, task: asyncio.Task):
+        self._active.discard(task)
+        self._notify()  # a slot freed up
+
+    async def _sleep_until_next(self, now: float):
+        """
+        Sleep until the next future deadline, capped by the poll interval (other processes'
+        enqueues). Chats already due were left unclaimed for lack of a slot, so they wait
+        for a release instead of spinning the loop.
+        """
+        timeout = self.poll_interval
+        if len(self._active) < self.pool_size:
+            head = await self.redis.zrangebyscore(DUE_KEY, f"({now}", "+inf", start=0, num=1, withscores=True)
+            if head:
+                timeout = max(0.0, min(timeout, head[0][1] - now))
+        self._wake.clear()
+        try:
+            await asyncio.wait_for(self._wake.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
 
-    async def enqueue(self, chat_id: str, message_id: str, supabase_client: Any, priority: str = "low", ticket_id: str = None):
+    async def _adopt_orphans(self):
+        """One-off startup migration: contexts written by the per-chat worker design have no ZSET entry."""
+        try:
+            adopted = 0
+            async for key in self.redis.scan_iter(match=f"{CTX_PREFIX}*"):
+                chat_id = key[len(CTX_PREFIX):]
+                run_at = await self.redis.hget(key, "run_at")
+                if run_at is not None:
+                    adopted += await self.redis.zadd(DUE_KEY, {chat_id: float(run_at)}, nx=True)
+            if adopted:
+                logger.info(f"❤️‍🩹 Recovered {adopted} orphaned chat session(s)")
+        except Exception as e:
+            logger.error(f"⚠️ Queue Recovery Warning: {e}")
+
+    async def enqueue(self, chat_id: str, message_id: str, supabase_client: Any, priority: str = "low", ticket_id: str = None, organization_id: str = None):
         """
         Add a request to the Redis queue.
-        1. Updates the 'Target Execution Time' for this chat in Redis.
-        2. Spawns a dedicated background worker if one isn't already running.
+        Stores the latest context and (re)sets the chat's deadline on queue:due,
+        which "resets the timer" if the chat was already waiting.
         """
-        # Calculate when the AI should trigger (Now + 10s)
         target_time = time.time() + self.debounce_window
-        
-        # 1. Store State in Redis (Persistent Atomic Storage)
-        # We use HSET so we can update the 'msg_id' and 'run_at' atomically.
-        # This effectively "resets the timer" for the worker.
+
         data = {
             "run_at": target_time,
             "msg_id": message_id,
             "priority": priority,
-            "ticket_id": ticket_id or "" 
+            "ticket_id": ticket_id or "",
+            "org_id": organization_id or "",
+            "attempts": 0
         }
-        await self.redis.hset(f"queue:ctx:{chat_id}", mapping=data)
-        
-        # 2. Check if a worker is ALREADY alive for this chat
-        # We check a simple flag key.
-        worker_key = f"worker:active:{chat_id}"
-        is_active = await self.redis.get(worker_key)
-        
-        if not is_active:
-            # 3. SPAWN THE WORKER (Fire and Forget)
-            # This creates a background task that runs independently of this request.
-            logger.info(f"🚀 Spawning New Worker for Chat {chat_id}")
-            asyncio.create_task(self._chat_worker_lifecycle(chat_id))
-        else:
-            # If active, the worker will automatically see the updated 'run_at' time 
-            # in the next loop cycle and sleep longer.
-            logger.info(f"🔄 Worker exists for {chat_id}. Extended timer to {self.debounce_window}s.")
-
-    async def _chat_worker_lifecycle(self, chat_id: str):
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.hset(f"{CTX_PREFIX}{chat_id}", mapping=data)
+        # First message of the turn: the trace's debounce span starts here
+        pipe.hsetnx(f"{CTX_PREFIX}{chat_id}", "enqueued_at", time.time())
+        pipe.zadd(DUE_KEY, {chat_id: target_time})
+        await pipe.execute()
+
+        self.stats["enqueued"] += 1
+        self._notify()
+        logger.info(f"🔄 Chat {chat_id} scheduled in {self.debounce_window}s.")
+
+    async def _shed_overdue(self, now: float):
+        """Overflow "shed": drop low / medium turns left on queue:due longer than AI_EXEC_MAX_QUEUE_WAIT."""
+        shed = await self._shed(
+            keys=[DUE_KEY], args=[now - self.limiter.max_queue_wait, CTX_PREFIX, self.claim_scan]
+        )
+        for chat_id, priority in shed:
+            self.limiter.overflow_action(priority)
+            logger.warning(f"🚫 AI turn shed under load [{chat_id}] (priority={priority})")
+
+    async def _run_claimed(self, chat_id: str, ctx: dict, token: str, slot: Optional[Slot] = None):
         """
-        The Dedicated Worker Lifecycle.
-        Cycle: Check Redis Time -> Sleep Difference -> Execute -> Terminate.
+        Execute one claimed turn while keeping its lease alive, then release it.
+        The scheduler normally admits the turn before claiming it (slot); without one
+        it waits in the limiter like any other caller.
         """
-        worker_key = f"worker:active:{chat_id}"
-        context_key = f"queue:ctx:{chat_id}"
-        
-        # Mark worker as active (Expires in 60s as a safety net against zombies)
-        await self.redis.setex(worker_key, 60, "1")
+        claimed_key = f"{CLAIMED_PREFIX}{chat_id}"
+        logger.info(f"⚡ Timer Finished for Chat {chat_id}. Executing AI.")
 
-        try:
+        async def renew():
             while True:
-                # 1. Fetch the latest Context & Target Time
-                ctx = await self.redis.hgetall(context_key)
-                if not ctx:
-                    logger.debug(f"Context empty/finished for {chat_id}, worker exiting.")
-                    break
-                
-                run_at = float(ctx["run_at"])
-                now = time.time()
-                remaining = run_at - now
-
-                # 2. THE OPTIMIZATION: "Calculated Sleep"
-                # If we still have time to wait, we sleep exactly that amount (capped).
-                if remaining > 0.1:
-                    # Sleep, but cap at 5s to allow for heartbeat/shutdown checks
-                    sleep_duration = min(remaining, 5.0) 
-                    await asyncio.sleep(sleep_duration)
-                    
-                    # Heartbeat: Keep the worker key alive while we wait
-                    await self.redis.expire(worker_key, 60)
-                    continue
-                
-                # 3. TIME IS UP! EXECUTE AI.
-                logger.info(f"⚡ Timer Finished for Chat {chat_id}. Executing AI.")
-                
-                # Cleanup Redis State BEFORE execution.
-                # This ensures that if the user types *while* the AI is generating,
-                # enqueue() will see no active worker and spawn a NEW one for the next turn.
-                await self.redis.delete(context_key)
-                await self.redis.delete(worker_key)
-                
-                # Run the Heavy AI Logic
-                await self._execute_ai_logic(chat_id, ctx)
-                
-                # 4. TERMINATE
-                logger.info(f"💀 Worker for {chat_id} terminating gracefully.")
-                break
+                await asyncio.sleep(self.lease_seconds / 3)
+                await self._lease(keys=[LEASE_KEY, claimed_key], args=[chat_id, token, time.time() + self.lease_seconds])
+
+        heartbeat = asyncio.create_task(renew())
+        claimed_at = time.time()
+        try:
+            async with pipeline_trace(
+                "ai_reply", origin_wall=float(ctx.get("enqueued_at") or claimed_at),
+                chat_id=chat_id, priority=ctx.get("priority", ""), attempt=int(ctx.get("attempts") or 0) + 1
+            ) as trace:
+                if trace:
+                    run_at = trace.perf_from_wall(float(ctx.get("run_at") or claimed_at))
+                    trace.add_span("queue.debounce", trace.origin, run_at)
+                    trace.add_span("queue.claim_lag", run_at, trace.perf_from_wall(claimed_at))
 
+                # Global + per-org admission, served by priority lane
+                if slot is None:
+                    with span("queue.admission", lane=ctx.get("priority", "")):
+                        slot = await self.limiter.acquire(ctx.get("org_id"), ctx.get("priority"))
+                if slot is None:
+                    await self._overflow(chat_id, ctx)
+                    return
+                try:
+                    await self._execute_ai_logic(chat_id, ctx)
+                    self.stats["completed"] += 1
+                finally:
+                    self.limiter.release(slot)
         except Exception as e:
+            self.stats["failed"] += 1
             logger.error(f"🔥 Worker Crash [{chat_id}]: {e}")
-            # Ensure cleanup so a new worker can spawn later
-            await self.redis.delete(worker_key)
+        finally:
+            heartbeat.cancel()
+            try:
+                await self._lease(keys=[LEASE_KEY, claimed_key], args=[chat_id, token, ""])
+            except Exception as e:
+                logger.warning(f"⚠️ Lease release failed [{chat_id}]: {e}")
+
+    async def _overflow(self, chat_id: str, ctx: dict):
+        """No slot within AI_EXEC_MAX_QUEUE_WAIT: shed the turn or push it back onto queue:due."""
+        if self.limiter.overflow_action(ctx.get("priority")) == OVERFLOW_SHED:
+            logger.warning(f"🚫 AI turn shed under load [{chat_id}] (priority={ctx.get('priority')})")
+            return
+
+        fields = {k: v for k, v in ctx.items() if k not in ("run_at", "token")}
+        args = [chat_id, time.time() + settings.AI_EXEC_OVERFLOW_DELAY]
+        for key, value in fields.items():
+            args.extend([key, value])
+        deferred = await self._defer(keys=[f"{CTX_PREFIX}{chat_id}", DUE_KEY], args=args)
+        logger.info(
+            f"⏳ AI turn delayed {settings.AI_EXEC_OVERFLOW_DELAY}s under load [{chat_id}]"
+            if deferred else f"⏭️ AI turn superseded by a newer message while delayed [{chat_id}]"
+        )
 
     async def _execute_ai_logic(self, chat_id: str, ctx: dict):
-        """Wrapper to safely run the AI service with a fresh DB connection"""
+        """Wrapper to safely run the AI service on the shared (pooled) Supabase client"""
         try:
-            # Create FRESH Supabase client for the background task.
-            # We cannot reuse the webhook's client because that request context is closed.
-            supabase = create_client(settings.SUPABASE_URL, settings.SUPABASE_SERVICE_KEY)
-            
+            supabase = get_shared_supabase()
+
             await process_dynamic_ai_response_v2(
                 chat_id=chat_id,
                 msg_id=ctx["msg_id"],
@@ -175,8 +412,17 @@ class LLMQueueService:
         except Exception as e:
             logger.error(f"❌ AI Execution Failed [{chat_id}]: {e}")
 
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            "workers": self.pool_size,
+            "active": len(self._active),
+            "debounce_seconds": self.debounce_window,
+            "admission": self.limiter.get_stats(),
+        }
+
 # Singleton Instance
 llm_queue_service = LLMQueueService()
 
 def get_llm_queue():
-    return llm_queue_service
\ No newline at end of file
+    return llm_queue_service
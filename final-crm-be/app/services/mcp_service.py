@@ -1,7 +1,13 @@
 import logging
+import asyncio
+import time
 import httpx
 import json
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Tuple
+
+from app.config import settings
+from app.services.redis_service import get_redis
+from app.services.http_client_service import mcp_client
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -9,6 +15,15 @@ logger = logging.getLogger(__name__)
 
 class MCPService:
 
+    def __init__(self):
+        # Schema cache: (agent_id, server_url) -> {"tools", "etag", "fetched_at", "generation"}
+        self._schema_cache: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        # Active server list per agent: agent_id -> {"servers", "fetched_at", "generation"}
+        self._servers_cache: Dict[str, Dict[str, Any]] = {}
+        # Concurrent misses for the same key await one fetch
+        self._inflight: Dict[Tuple[str, str], asyncio.Future] = {}
+        self.cache_stats: Dict[str, int] = {"hits": 0, "misses": 0, "revalidated": 0, "coalesced": 0, "stale_served": 0}
+
     # =========================================================
     # 1. CORE HTTP CLIENT
     # =========================================================
@@ -20,28 +35,34 @@ class MCPService:
         payload: Optional[Dict] = None,
         api_key: Optional[str] = None,
         timeout: float = 10.0,
+        extra_headers: Optional[Dict[str, str]] = None,
     ) -> Dict[str, Any]:
         full_url = f"{base_url.rstrip('/')}{endpoint}"
         headers = {"Content-Type": "application/json"}
         if api_key:
             headers["X-API-Key"] = api_key
+        if extra_headers:
+            headers.update(extra_headers)
 
         logger.info(f"🌐 [MCP] {method} {full_url}")
 
         try:
-            async with httpx.AsyncClient(timeout=timeout) as client:
+            async with mcp_client() as client:
                 if method.upper() == "GET":
-                    resp = await client.get(full_url, headers=headers)
+                    resp = await client.get(full_url, headers=headers, timeout=timeout)
                 else:
-                    resp = await client.post(full_url, json=payload or {}, headers=headers)
+                    resp = await client.post(full_url, json=payload or {}, headers=headers, timeout=timeout)
 
             logger.info(f"📥 [MCP] {resp.status_code}")
 
+            if resp.status_code == 304:
+                return {"success": True, "not_modified": True, "etag": resp.headers.get("ETag")}
+
             if resp.status_code != 200:
                 logger.error(f"❌ [MCP] ERROR: {resp.text}")
                 return {"success": False, "error": f"HTTP {resp.status_code}: {resp.text}"}
 
-            return {"success": True, "data": resp.json()}
+            return {"success": True, "data": resp.json(), "etag": resp.headers.get("ETag")}
 
         except httpx.TimeoutException:
             logger.error(f"⏱️ [MCP] TIMEOUT: {full_url}")
@@ -53,7 +74,8 @@ class MCPService:
     # =========================================================
     # 2. SERVER DISCOVERY
     # =========================================================
-    async def _get_active_servers(self, supabase, agent_id: str) -> List[Dict]:
+    async def _get_active_servers(self, supabase, agent_id: str) -> Optional[List[Dict]]:
+        """Enabled MCP servers of the agent, or None if the lookup failed (never cache that)."""
         try:
             res = (
                 supabase.table("agent_integrations")
@@ -80,91 +102,208 @@ class MCPService:
             return servers
         except Exception as e:
             logger.error(f"[MCP] Failed to fetch servers for agent {agent_id}: {e}")
+            return None
+
+    async def _get_generation(self, agent_id: str) -> int:
+        """Cache generation for an agent, shared across workers via Redis (bumped by invalidate_agent)"""
+        try:
+            return int(await get_redis().get(f"mcp:schema_gen:{agent_id}") or 0)
+        except Exception as e:
+            logger.warning(f"[MCP] Cache generation unavailable, using local cache only: {e}")
+            return 0
+
+    async def invalidate_agent(self, agent_id: str):
+        """Drop cached servers + schemas for an agent (called when its MCP integration is edited)"""
+        self._servers_cache.pop(agent_id, None)
+        for key in [k for k in self._schema_cache if k[0] == agent_id]:
+            self._schema_cache.pop(key, None)
+        try:
+            await get_redis().incr(f"mcp:schema_gen:{agent_id}")
+        except Exception as e:
+            logger.warning(f"[MCP] Failed to broadcast cache invalidation for {agent_id}: {e}")
+        logger.info(f"🧹 [MCP] Schema cache invalidated for Agent {agent_id}")
+
+    def get_cache_stats(self) -> Dict[str, Any]:
+        return {**self.cache_stats, "cached_schemas": len(self._schema_cache), "cached_agents": len(self._servers_cache)}
+
+    def _is_fresh(self, entry: Optional[Dict[str, Any]], generation: int) -> bool:
+        return (
+            entry is not None
+            and entry["generation"] == generation
+            and time.monotonic() - entry["fetched_at"] < settings.MCP_SCHEMA_CACHE_TTL
+        )
+
+    async def _get_active_servers_cached(self, supabase, agent_id: str, generation: int, force_refresh: bool = False) -> List[Dict]:
+        entry = self._servers_cache.get(agent_id)
+        if not force_refresh and self._is_fresh(entry, generation):
+            return entry["servers"]
+
+        servers = await self._get_active_servers(supabase, agent_id)
+        if servers is None:
+            # Lookup failed: keep serving the last known list (if any) and retry on the next call
+            if entry is not None:
+                self.cache_stats["stale_served"] += 1
+                return entry["servers"]
             return []
+        self._servers_cache[agent_id] = {"servers": servers, "fetched_at": time.monotonic(), "generation": generation}
+        return servers
 
     # =========================================================
     # 3. SCHEMA → OPENAI TOOLS
     # =========================================================
-    async def get_all_tools_schema(self, supabase, agent_id: str) -> List[Dict[str, Any]]:
-        servers = await self._get_active_servers(supabase, agent_id)
-        tools = []
+    async def get_all_tools_schema(self, supabase, agent_id: str, force_refresh: bool = False) -> List[Dict[str, Any]]:
+        """
+        OpenAI tool list for every active MCP server of the agent.
+        Per-server schemas are cached for MCP_SCHEMA_CACHE_TTL and then revalidated
+        with If-None-Match; force_refresh bypasses the cache (explicit re-initialisation).
+        """
+        generation = await self._get_generation(agent_id)
+        servers = await self._get_active_servers_cached(supabase, agent_id, generation, force_refresh)
 
         logger.info(f"🔌 [MCP] Discovering schema for Agent {agent_id}")
 
-        for server in servers:
-            server_name = server.get("name", "db").replace(" ", "_").lower()
-            schema_resp = await self._rest_request("GET", server["url"], "/mcp/schema", api_key=server["api_key"])
+        per_server = await asyncio.gather(*[
+            self._get_server_tools(agent_id, server, generation, force_refresh) for server in servers
+        ], return_exceptions=True)
 
-            if not schema_resp.get("success"):
-                logger.error(f"[MCP] Schema fetch failed for {server_name}: {schema_resp.get('error')}")
+        tools = []
+        for server, server_tools in zip(servers, per_server):
+            if isinstance(server_tools, Exception):
+                logger.error(f"[MCP] Schema discovery failed for {server.get('name')}: {server_tools}")
                 continue
+            tools.extend(server_tools)
+
+        logger.info(f"✅ [MCP] Mapped {len(tools)} tables to OpenAI tools.")
+        return tools
+
+    async def _get_server_tools(self, agent_id: str, server: Dict, generation: int, force_refresh: bool = False) -> List[Dict[str, Any]]:
+        key = (agent_id, server["url"])
+        entry = self._schema_cache.get(key)
+        if not force_refresh and self._is_fresh(entry, generation):
+            self.cache_stats["hits"] += 1
+            return entry["tools"]
+
+        # Coalesce: a burst of messages for the same agent triggers one fetch
+        loop = asyncio.get_running_loop()
+        pending = self._inflight.get(key)
+        if pending is not None and pending.get_loop() is loop:
+            self.cache_stats["coalesced"] += 1
+            return await asyncio.shield(pending)
+
+        future = loop.create_future()
+        self._inflight[key] = future
+        try:
+            tools = await self._fetch_server_tools(key, server, entry if entry and entry["generation"] == generation else None, generation)
+            future.set_result(tools)
+            return tools
+        except BaseException as e:
+            # Includes cancellation of the leader (e.g. a branch timeout): followers must not hang
+            future.set_exception(e if isinstance(e, Exception) else ConnectionError("MCP schema fetch was cancelled"))
+            raise
+        finally:
+            if self._inflight.get(key) is future:
+                self._inflight.pop(key, None)
+            # Nobody else awaited it: mark any exception as retrieved
+            if future.done() and not future.cancelled():
+                future.exception()
+
+    async def _fetch_server_tools(self, key: Tuple[str, str], server: Dict, entry: Optional[Dict[str, Any]], generation: int) -> List[Dict[str, Any]]:
+        server_name = (server.get("name") or "db").replace(" ", "_").lower()
+        extra_headers = {"If-None-Match": entry["etag"]} if entry and entry.get("etag") else None
+
+        schema_resp = await self._rest_request(
+            "GET", server["url"], "/mcp/schema", api_key=server["api_key"], extra_headers=extra_headers
+        )
+
+        if schema_resp.get("not_modified") and entry:
+            self.cache_stats["revalidated"] += 1
+            entry["fetched_at"] = time.monotonic()
+            return entry["tools"]
+
+        if not schema_resp.get("success") or schema_resp.get("not_modified"):
+            logger.error(f"[MCP] Schema fetch failed for {server_name}: {schema_resp.get('error')}")
+            if entry:
+                # Server hiccup: keep answering with the last known schema
+                self.cache_stats["stale_served"] += 1
+                return entry["tools"]
+            return []
 
-            data = schema_resp["data"]
-            resources = data.get("resources", [])
-            operators = data.get("supported_operators", ["=", "!=", ">", "<", ">=", "<=", "LIKE", "IN", "IS NULL", "IS NOT NULL"])
+        self.cache_stats["misses"] += 1
+        tools = self._map_schema_to_tools(server_name, schema_resp["data"])
+        self._schema_cache[key] = {
+            "tools": tools,
+            "etag": schema_resp.get("etag"),
+            "fetched_at": time.monotonic(),
+            "generation": generation,
+        }
+        return tools
+
+    def _map_schema_to_tools(self, server_name: str, data: Dict[str, Any]) -> List[Dict[str, Any]]:
+        tools = []
+        resources = data.get("resources", [])
+        operators = data.get("supported_operators", ["=", "!=", ">", "<", ">=", "<=", "LIKE", "IN", "IS NULL", "IS NOT NULL"])
 
-            for w in data.get("warnings", []):
-                logger.warning(f"[MCP] Schema warning: {w}")
+        for w in data.get("warnings", []):
+            logger.warning(f"[MCP] Schema warning: {w}")
 
-            if not resources:
-                logger.warning(f"[MCP] No resources returned for '{server_name}'")
+        if not resources:
+            logger.warning(f"[MCP] No resources returned for '{server_name}'")
+            return tools
+
+        for res in resources:
+            res_name = res.get("name")
+            if not res_name:
                 continue
 
-            for res in resources:
-                res_name = res.get("name")
-                if not res_name:
-                    continue
-
-                # Description comes from Palapa (TABLE_COMMENT or auto-generated)
-                description = res.get("description", f"Table '{res_name}'.")
-
-                # Append column info so AI knows exact names and types
-                fields_info = []
-                for f in res.get("fields", []):
-                    raw = f.get("raw_type") or f.get("type", "")
-                    pk  = " [PK]" if f.get("primary_key") else ""
-                    fields_info.append(f"{f['name']} ({raw}{pk})")
-                if fields_info:
-                    description += f" Columns: {', '.join(fields_info)}."
-
-                tools.append({
-                    "type": "function",
-                    "function": {
-                        "name": f"{server_name}__{res_name}",
-                        "description": description,
-                        "parameters": {
-                            "type": "object",
-                            "properties": {
-                                "fields": {
-                                    "type": "array",
-                                    "items": {"type": "string"},
-                                    "description": "Columns to return. Leave empty to return all.",
-                                },
-                                "filters": {
+            # Description comes from Palapa (TABLE_COMMENT or auto-generated)
+            description = res.get("description", f"Table '{res_name}'.")
+
+            # Append column info so AI knows exact names and types
+            fields_info = []
+            for f in res.get("fields", []):
+                raw = f.get("raw_type") or f.get("type", "")
+                pk  = " [PK]" if f.get("primary_key") else ""
+                fields_info.append(f"{f['name']} ({raw}{pk})")
+            if fields_info:
+                description += f" Columns: {', '.join(fields_info)}."
+
+            tools.append({
+                "type": "function",
+                "function": {
+                    "name": f"{server_name}__{res_name}",
+                    "description": description,
+                    "parameters": {
+                        "type": "object",
+                        "properties": {
+                            "fields": {
+                                "type": "array",
+                                "items": {"type": "string"},
+                                "description": "Columns to return. Leave empty to return all.",
+                            },
+                            "filters": {
+                                "type": "object",
+                                "description": f"Filter conditions. Key = column name. Value = {{\"op\": \"=\", \"value\": ...}}. Supported operators: {', '.join(operators)}.",
+                            },
+                            "limit": {
+                                "type": "integer",
+                                "description": "Number of rows to return. Default 100, max 1000.",
+                            },
+                            "order_by": {
+                                "type": "array",
+                                "items": {
                                     "type": "object",
-                                    "description": f"Filter conditions. Key = column name. Value = {{\"op\": \"=\", \"value\": ...}}. Supported operators: {', '.join(operators)}.",
-                                },
-                                "limit": {
-                                    "type": "integer",
-                                    "description": "Number of rows to return. Default 100, max 1000.",
-                                },
-                                "order_by": {
-                                    "type": "array",
-                                    "items": {
-                                        "type": "object",
-                                        "properties": {
-                                            "field":     {"type": "string"},
-                                            "direction": {"type": "string", "enum": ["asc", "desc"]},
-                                        },
+                                    "properties": {
+                                        "field":     {"type": "string"},
+                                        "direction": {"type": "string", "enum": ["asc", "desc"]},
                                     },
-                                    "description": "Sort order. Example: [{\"field\": \"created_at\", \"direction\": \"desc\"}].",
                                 },
+                                "description": "Sort order. Example: [{\"field\": \"created_at\", \"direction\": \"desc\"}].",
                             },
                         },
                     },
-                })
+                },
+            })
 
-        logger.info(f"✅ [MCP] Mapped {len(tools)} tables to OpenAI tools.")
         return tools
 
     # =========================================================
@@ -181,10 +320,10 @@ class MCPService:
             return {"status": "error", "output": f"Invalid tool name: '{tool_call_name}'"}
 
         target_server_name, resource_name = tool_call_name.split("__", 1)
-        servers = await self._get_active_servers(supabase, agent_id)
+        servers = await self._get_active_servers_cached(supabase, agent_id, await self._get_generation(agent_id))
 
         server = next(
-            (s for s in servers if s.get("name", "").replace(" ", "_").lower() == target_server_name),
+            (s for s in servers if (s.get("name") or "").replace(" ", "_").lower() == target_server_name),
             None,
         )
         if not server:
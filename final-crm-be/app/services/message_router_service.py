@@ -4,6 +4,7 @@ from typing import Optional, Dict, Any, Tuple
 from datetime import datetime, timedelta
 from app.config import settings
 from app.services.redis_service import acquire_lock
+from app.services.chat_window_service import record_message, invalidate_window
 from uuid import uuid4
 
 logger = logging.getLogger(__name__)
@@ -402,6 +403,7 @@ class MessageRouterService:
                         update_data["content"] = message_content
                         
                     self.supabase.table("messages").update(update_data).eq("id", message_id).execute()
+                    await invalidate_window(chat_id)
 
                 else:
                     # INSERT NEW (Only if it doesn't exist)                    
@@ -421,7 +423,9 @@ class MessageRouterService:
                         "chat_id": chat_id, "sender_type": "customer", "sender_id": customer_id,
                         "content": message_content, "metadata": final_meta
                     }).execute()
-                    if m_res.data: message_id = m_res.data[0]["id"]
+                    if m_res.data:
+                        message_id = m_res.data[0]["id"]
+                        await record_message(chat_id, m_res.data[0])
             
             else:
                 # NEW CHAT
@@ -452,7 +456,9 @@ class MessageRouterService:
                         "chat_id": chat_id, "sender_type": "customer", "sender_id": customer_id,
                         "content": message_content, "metadata": final_meta
                     }).execute()
-                    if m_res.data: message_id = m_res.data[0]["id"]
+                    if m_res.data:
+                        message_id = m_res.data[0]["id"]
+                        await record_message(chat_id, m_res.data[0])
 
             await self.update_customer_metadata(customer_id, channel, organization_id, customer_metadata)
 
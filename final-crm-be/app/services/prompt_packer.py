@@ -0,0 +1,169 @@
+"""
+Prompt Packer - Token-Budgeted RAG + History Packing for the Agent Prompt
+
+WHY THIS EXISTS:
+process_message received historyLimit raw messages and the full healed RAG
+context, and nothing capped the total. Long pasted messages and big table
+chunks pushed prompts to many thousands of tokens (latency + cost).
+
+SOLUTION:
+One budget per agent (advanced_config.promptTokenBudget, else
+AI_PROMPT_TOKEN_BUDGET), counted with tiktoken:
+1. Fixed cost first: system prompt (without RAG), the current customer
+   message and the tool schemas are always sent. History + RAG still get at
+   least AI_PROMPT_MIN_CONTEXT_TOKENS, so an agent with a large tool list
+   goes over budget (with a warning) rather than losing all its context.
+2. History (newest first) may use up to (1 - AI_PROMPT_RAG_SHARE) of what is
+   left. Any single old message longer than AI_PROMPT_MAX_MESSAGE_TOKENS is
+   cut to that length; once the next message doesn't fit, older ones drop.
+3. RAG blocks get everything history left over, best rerank rank first; a
+   block that doesn't fit is truncated if a useful amount still fits, else
+   dropped. Kept blocks stay in document order.
+
+The returned report (tokens before / after / saved, what was dropped or cut)
+ends up in the AI message metadata as "prompt_packing".
+"""
+import json
+import logging
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+import tiktoken
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Joins RAG blocks into the context string placed in the system prompt
+CONTEXT_SEPARATOR = "\n\n###\n\n"
+TRUNCATION_MARKER = " …[truncated]"
+MIN_USEFUL_BLOCK_TOKENS = 64
+
+_encoder = None
+
+
+def _get_encoder():
+    global _encoder
+    if _encoder is None:
+        _encoder = tiktoken.get_encoding("cl100k_base")
+    return _encoder
+
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    try:
+        return len(_get_encoder().encode(text, disallowed_special=()))
+    except Exception:
+        # Tokenizer unavailable (no BPE file offline): ~4 chars per token
+        return len(text) // 4 + 1
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    if max_tokens <= 0:
+        return ""
+    try:
+        enc = _get_encoder()
+        tokens = enc.encode(text, disallowed_special=())
+        if len(tokens) <= max_tokens:
+            return text
+        return enc.decode(tokens[:max_tokens]).rstrip() + TRUNCATION_MARKER
+    except Exception:
+        limit = max_tokens * 4
+        return text if len(text) <= limit else text[:limit].rstrip() + TRUNCATION_MARKER
+
+
+@dataclass
+class PackedPrompt:
+    rag_blocks: List[Dict[str, Any]]
+    history: List[Dict[str, Any]]
+    report: Dict[str, Any] = field(default_factory=dict)
+
+
+def resolve_budget(advanced: Dict[str, Any]) -> int:
+    try:
+        return int(advanced.get("promptTokenBudget") or settings.AI_PROMPT_TOKEN_BUDGET)
+    except (TypeError, ValueError):
+        return settings.AI_PROMPT_TOKEN_BUDGET
+
+
+def pack_prompt(
+    base_system_prompt: str,
+    customer_message: str,
+    rag_blocks: List[Dict[str, Any]],
+    history: List[Dict[str, Any]],
+    budget: int,
+    tools: Optional[List[Dict]] = None,
+) -> PackedPrompt:
+    """
+    history is oldest-first (as passed to process_message) and is returned the
+    same way; rag_blocks are {"text", "rank"} in document order.
+    """
+    fixed = count_tokens(base_system_prompt) + count_tokens(customer_message)
+    if tools:
+        fixed += count_tokens(json.dumps(tools, ensure_ascii=False))
+
+    rag_costs = [count_tokens(b.get("text", "")) for b in rag_blocks]
+    hist_costs = [count_tokens(m.get("content") or "") for m in history]
+    before = fixed + sum(rag_costs) + sum(hist_costs)
+
+    reserve = settings.AI_PROMPT_MIN_CONTEXT_TOKENS
+    remaining = max(budget - fixed, reserve)
+    if budget - fixed < reserve:
+        logger.warning(
+            f"⚠️ Prompt fixed cost ({fixed} tokens: system prompt, message, tools) leaves "
+            f"{max(0, budget - fixed)} of budget {budget}; reserving {reserve} for history + RAG"
+        )
+
+    # --- History: newest first, capped share ---
+    hist_cap = int(remaining * (1 - settings.AI_PROMPT_RAG_SHARE))
+    max_msg = settings.AI_PROMPT_MAX_MESSAGE_TOKENS
+    kept_history: List[Dict[str, Any]] = []
+    hist_used = 0
+    hist_truncated = 0
+    for msg, cost in zip(reversed(history), reversed(hist_costs)):
+        cut = cost > max_msg
+        if cut:
+            msg = {**msg, "content": truncate_tokens(msg.get("content") or "", max_msg)}
+            cost = count_tokens(msg["content"])
+        if hist_used + cost > hist_cap:
+            break
+        kept_history.append(msg)
+        hist_used += cost
+        hist_truncated += cut
+    kept_history.reverse()
+
+    # --- RAG: best rank first, whatever history left ---
+    rag_cap = remaining - hist_used
+    rag_used = 0
+    kept_idx: Dict[int, str] = {}
+    rag_truncated = 0
+    for i in sorted(range(len(rag_blocks)), key=lambda i: rag_blocks[i].get("rank", i)):
+        text, cost = rag_blocks[i].get("text", ""), rag_costs[i]
+        room = rag_cap - rag_used
+        if cost <= room:
+            kept_idx[i] = text
+            rag_used += cost
+        elif room >= MIN_USEFUL_BLOCK_TOKENS:
+            text = truncate_tokens(text, room - count_tokens(TRUNCATION_MARKER))
+            kept_idx[i] = text
+            rag_used += count_tokens(text)
+            rag_truncated += 1
+        # else: dropped; a smaller, lower-ranked block may still fit
+    kept_rag = [{**rag_blocks[i], "text": kept_idx[i]} for i in sorted(kept_idx)]
+
+    after = fixed + rag_used + hist_used
+    report = {
+        "budget": budget,
+        "fixed_tokens": fixed,
+        "tokens_before": before,
+        "tokens_after": after,
+        "tokens_saved": max(0, before - after),
+        "history_dropped": len(history) - len(kept_history),
+        "history_truncated": hist_truncated,
+        "rag_blocks_dropped": len(rag_blocks) - len(kept_rag),
+        "rag_blocks_truncated": rag_truncated,
+    }
+    if report["tokens_saved"]:
+        logger.info(f"✂️ Prompt packed {before} → {after} tokens (budget {budget})")
+    return PackedPrompt(rag_blocks=kept_rag, history=kept_history, report=report)
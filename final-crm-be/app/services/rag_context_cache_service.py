@@ -0,0 +1,129 @@
+"""
+RAG Context Cache Service - Versioned Answer-Context Cache per Agent
+
+WHY THIS EXISTS:
+Inside the debounce window, and across customers asking the same thing,
+query_context returned byte-identical context for identical reformulated
+queries — after paying for BM25, vector search, reranking and healing again.
+
+SOLUTION:
+- Cache the final context (ranked blocks, serialised as JSON) in Redis with a TTL.
+- Key = (agent_id, normalised query, n_results, collection version).
+- Every write path (add_documents / delete_document / delete_collection)
+  INCRs the collection version, so stale entries are simply never read again
+  and expire on their own. No scan-and-delete invalidation.
+
+The version counter is never deleted (not even when the collection is), so a
+re-created collection can't collide with entries from its previous life.
+"""
+import hashlib
+import logging
+import threading
+from typing import Dict, Optional, Tuple
+
+from app.config import settings
+from app.services.redis_service import get_sync_redis
+from app.services.embedding_cache_service import normalize_query
+
+logger = logging.getLogger(__name__)
+
+
+class RAGContextCache:
+    VERSION_PREFIX = "ragver"
+    ENTRY_PREFIX = "ragctx"
+
+    def __init__(self, ttl: int = 1800):
+        self.ttl = ttl
+        self._redis = None
+        self._lock = threading.Lock()
+        self.stats: Dict[str, int] = {"hits": 0, "misses": 0, "stores": 0, "bumps": 0, "redis_errors": 0}
+
+    @property
+    def redis(self):
+        if self._redis is None:
+            self._redis = get_sync_redis()
+        return self._redis
+
+    def _count(self, field: str, n: int = 1):
+        with self._lock:
+            self.stats[field] += n
+
+    def _version_key(self, collection: str) -> str:
+        return f"{self.VERSION_PREFIX}:{collection}"
+
+    def _entry_key(self, agent_id: str, query: str, n_results: int, version: int) -> str:
+        digest = hashlib.sha256(normalize_query(query).encode("utf-8")).hexdigest()
+        return f"{self.ENTRY_PREFIX}:{agent_id}:v{version}:n{n_results}:{digest}"
+
+    # --- Versioning ---
+    def version(self, collection: str) -> int:
+        return int(self.redis.get(self._version_key(collection)) or 0)
+
+    def bump(self, collection: str):
+        """Invalidate every cached context for this collection (called by all write paths)."""
+        try:
+            new_version = self.redis.incr(self._version_key(collection))
+            self._count("bumps")
+            logger.debug(f"[RAGContextCache] '{collection}' → v{new_version}")
+        except Exception as e:
+            logger.warning(f"⚠️ [RAGContextCache] Version bump failed for '{collection}': {e}")
+            self._count("redis_errors")
+
+    # --- Lookup / store ---
+    def get(self, agent_id: str, query: str, n_results: int) -> Tuple[Optional[str], Optional[int]]:
+        """
+        Return (context, version). context is None on a miss; version is what
+        the caller must pass to set() so a write racing the retrieval isn't cached
+        under the new version.
+        """
+        try:
+            version = self.version(agent_id)
+            cached = self.redis.get(self._entry_key(agent_id, query, n_results, version))
+        except Exception as e:
+            logger.warning(f"⚠️ [RAGContextCache] Redis read failed: {e}")
+            self._count("redis_errors")
+            return None, None
+
+        if cached is None:
+            self._count("misses")
+            return None, version
+        self._count("hits")
+        return cached, version
+
+    def set(self, agent_id: str, query: str, n_results: int, version: Optional[int], context: str):
+        if version is None:
+            return
+        try:
+            self.redis.set(self._entry_key(agent_id, query, n_results, version), context, ex=self.ttl)
+            self._count("stores")
+        except Exception as e:
+            logger.warning(f"⚠️ [RAGContextCache] Redis write failed: {e}")
+            self._count("redis_errors")
+
+    def get_stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return {
+                **self.stats,
+                "ttl": self.ttl,
+                "hit_rate": round(self.stats["hits"] / lookups, 4) if lookups else 0.0,
+            }
+
+
+_rag_context_cache = None
+
+
+def get_rag_context_cache() -> Optional[RAGContextCache]:
+    """Shared context cache (None when RAG_CONTEXT_CACHE_ENABLED is off)."""
+    global _rag_context_cache
+    if _rag_context_cache is None and settings.RAG_CONTEXT_CACHE_ENABLED:
+        _rag_context_cache = RAGContextCache(ttl=settings.RAG_CONTEXT_CACHE_TTL)
+    return _rag_context_cache
+
+
+def bump_collection_version(collection: str):
+    """
+    Move the collection version after a knowledge write. It also keys the FAQ
+    reply cache, so it moves even when the context cache itself is disabled.
+    """
+    (get_rag_context_cache() or RAGContextCache()).bump(collection)
@@ -1,5 +1,6 @@
 import logging
 import redis.asyncio as redis
+import redis as sync_redis
 # [FIX] Import exceptions from the main redis package, not asyncio
 from redis import exceptions as redis_exceptions
 from contextlib import asynccontextmanager
@@ -19,10 +20,25 @@ _pool = redis.ConnectionPool(
     max_connections=100
 )
 
+# Sync pool for code that runs outside the event loop (worker threads, Chroma embedding functions)
+_sync_pool = sync_redis.ConnectionPool(
+    host=settings.REDIS_HOST,
+    port=settings.REDIS_PORT,
+    db=settings.REDIS_DB,
+    password=settings.REDIS_PASSWORD,
+    decode_responses=True,
+    max_connections=50,
+    socket_connect_timeout=5
+)
+
 def get_redis() -> redis.Redis:
     """Get a Redis client from the pool."""
     return redis.Redis(connection_pool=_pool)
 
+def get_sync_redis() -> sync_redis.Redis:
+    """Get a blocking Redis client from the thread-safe sync pool."""
+    return sync_redis.Redis(connection_pool=_sync_pool)
+
 @asynccontextmanager
 async def acquire_lock(lock_name: str, expire: int = 60, wait_time: int = 10) -> AsyncGenerator[bool, None]:
     """
@@ -0,0 +1,359 @@
+"""
+Reranker Service - Cross-Encoder Scoring Engines
+
+Scores (query, passage) pairs with cross-encoder/ms-marco-MiniLM-L-6-v2 for
+Layer 3 of CRMChromaServiceV2.query_context.
+
+ENGINES (RERANKER_BACKEND):
+- "torch": full-precision PyTorch model on CPU (original behaviour).
+- "onnx": same model exported to ONNX and int8 dynamically quantized, run
+  through ONNX Runtime with a tuned intra-op thread count. Export and
+  quantization happen once and are cached under RERANKER_MODEL_PATH/onnx.
+  Parity with torch (within RERANKER_ONNX_PARITY_TOLERANCE, same ranking)
+  is covered by tests/test_reranker_parity.py. The same check can also run
+  on load (RERANKER_ONNX_PARITY_CHECK, off by default: it costs startup time
+  on every worker) and falls back to torch if scores drift.
+
+MICRO-BATCHING (RERANKER_BATCH_ENABLED):
+When many chats hit the RAG stage together, each coroutine used to run its
+own small tokenizer+model pass. RerankerBatcher collects (query, passage)
+pairs from concurrent requests for up to RERANKER_MAX_WAIT_MS (or until
+RERANKER_MAX_BATCH_SIZE pairs), runs them as one length-sorted padded batch
+on a dedicated executor thread and hands each caller back its own scores.
+"""
+import os
+import time
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+from transformers import AutoTokenizer, AutoModelForSequenceClassification
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+MODEL_NAME = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+MAX_LENGTH = 512
+
+# Fixed calibration pairs for the torch ↔ onnx parity check
+PARITY_PAIRS = [
+    ["jam buka toko", "Toko kami buka setiap hari pukul 08:00 - 21:00 WIB."],
+    ["jam buka toko", "Harga paket premium adalah Rp 150.000 per bulan."],
+    ["harga kode 01", "Kode 01: Kopi susu gula aren - Rp 18.000"],
+    ["refund policy", "Refunds are processed within 7 business days after approval."],
+    ["refund policy", "Our office is located at Jl. Sudirman No. 10, Jakarta."],
+    ["alamat kantor", "Our office is located at Jl. Sudirman No. 10, Jakarta."],
+]
+
+
+def load_torch_reranker() -> Tuple[AutoModelForSequenceClassification, AutoTokenizer]:
+    """Load the cross-encoder from RERANKER_MODEL_PATH, downloading + saving it on first run."""
+    model_path = settings.RERANKER_MODEL_PATH
+
+    if os.path.exists(os.path.join(model_path, "config.json")):
+        logger.info(f"🔄 Loading reranker from {model_path}...")
+        source = model_path
+    else:
+        logger.info(f"🔄 Downloading reranker (source: {MODEL_NAME})...")
+        source = MODEL_NAME
+
+    tokenizer = AutoTokenizer.from_pretrained(source)
+    model = AutoModelForSequenceClassification.from_pretrained(source)
+
+    if source == MODEL_NAME:
+        try:
+            os.makedirs(model_path, exist_ok=True)
+            tokenizer.save_pretrained(model_path)
+            model.save_pretrained(model_path)
+            logger.info(f"💾 Model saved to: {model_path}")
+        except Exception as save_err:
+            logger.warning(f"⚠️ Could not save model to {model_path}: {save_err}")
+
+    # Device Setup Force to use cpu
+    model = model.to(torch.device("cpu"))
+    model.eval()
+    return model, tokenizer
+
+
+class TorchRerankerEngine:
+    name = "torch"
+
+    def __init__(self, model, tokenizer):
+        self.model = model
+        self.tokenizer = tokenizer
+
+    def score(self, pairs: List[List[str]], batch_size: int = 16) -> List[float]:
+        scores: List[float] = []
+        for i in range(0, len(pairs), batch_size):
+            batch = pairs[i:i + batch_size]
+            with torch.no_grad():
+                inputs = self.tokenizer(batch, padding=True, truncation=True, return_tensors='pt', max_length=MAX_LENGTH)
+                logits = self.model(**inputs).logits.squeeze(-1)
+                scores.extend(torch.sigmoid(logits).reshape(-1).tolist())
+        return scores
+
+
+class OnnxRerankerEngine:
+    name = "onnx-int8"
+
+    def __init__(self, session, tokenizer):
+        self.session = session
+        self.tokenizer = tokenizer
+        self.input_names = [i.name for i in session.get_inputs()]
+
+    def score(self, pairs: List[List[str]], batch_size: int = 16) -> List[float]:
+        scores: List[float] = []
+        for i in range(0, len(pairs), batch_size):
+            batch = pairs[i:i + batch_size]
+            inputs = self.tokenizer(batch, padding=True, truncation=True, return_tensors='np', max_length=MAX_LENGTH)
+            feed = {name: inputs[name].astype(np.int64) for name in self.input_names}
+            logits = self.session.run(None, feed)[0].reshape(-1)
+            scores.extend((1.0 / (1.0 + np.exp(-logits))).tolist())
+        return scores
+
+
+class _LogitsOnly(torch.nn.Module):
+    """Export wrapper: fixed positional inputs, logits output."""
+
+    def __init__(self, model, input_names: List[str]):
+        super().__init__()
+        self.model = model
+        self.input_names = input_names
+
+    def forward(self, *args):
+        return self.model(**dict(zip(self.input_names, args))).logits
+
+
+def _export_quantized_onnx(model, tokenizer, onnx_dir: str) -> str:
+    """Export fp32 ONNX once, then int8 dynamic-quantize it. Returns the int8 model path."""
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    fp32_path = os.path.join(onnx_dir, "model.onnx")
+    int8_path = os.path.join(onnx_dir, "model.int8.onnx")
+    if os.path.exists(int8_path):
+        return int8_path
+
+    os.makedirs(onnx_dir, exist_ok=True)
+    logger.info(f"🔄 Exporting reranker to ONNX ({onnx_dir})...")
+
+    dummy = tokenizer([PARITY_PAIRS[0]], padding=True, truncation=True, return_tensors='pt', max_length=MAX_LENGTH)
+    input_names = [n for n in ("input_ids", "attention_mask", "token_type_ids") if n in dummy]
+    dynamic_axes = {n: {0: "batch", 1: "sequence"} for n in input_names}
+    dynamic_axes["logits"] = {0: "batch"}
+
+    with torch.no_grad():
+        torch.onnx.export(
+            _LogitsOnly(model, input_names),
+            tuple(dummy[n] for n in input_names),
+            fp32_path,
+            input_names=input_names,
+            output_names=["logits"],
+            dynamic_axes=dynamic_axes,
+            opset_version=17,
+            dynamo=False,
+        )
+
+    quantize_dynamic(fp32_path, int8_path, weight_type=QuantType.QInt8)
+    logger.info(f"💾 Quantized reranker saved to: {int8_path}")
+    return int8_path
+
+
+def build_onnx_engine(model, tokenizer) -> OnnxRerankerEngine:
+    import onnxruntime as ort
+
+    int8_path = _export_quantized_onnx(model, tokenizer, os.path.join(settings.RERANKER_MODEL_PATH, "onnx"))
+
+    opts = ort.SessionOptions()
+    opts.intra_op_num_threads = settings.RERANKER_ONNX_THREADS
+    opts.inter_op_num_threads = 1
+    opts.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+    session = ort.InferenceSession(int8_path, sess_options=opts, providers=["CPUExecutionProvider"])
+    return OnnxRerankerEngine(session, tokenizer)
+
+
+def check_parity(reference, candidate, tolerance: float) -> Tuple[bool, float]:
+    """Compare engine scores on PARITY_PAIRS. Returns (ok, max_abs_diff)."""
+    ref = np.array(reference.score(PARITY_PAIRS))
+    cand = np.array(candidate.score(PARITY_PAIRS))
+    max_diff = float(np.max(np.abs(ref - cand)))
+    same_order = list(np.argsort(-ref)) == list(np.argsort(-cand))
+    return (max_diff <= tolerance and same_order), max_diff
+
+
+_engine = None
+_engine_lock = threading.Lock()
+# perf_counter of the last failed load: retried only after RERANKER_LOAD_RETRY_SECONDS
+_load_failed_at: Optional[float] = None
+
+
+def _load_backoff_active() -> bool:
+    return _load_failed_at is not None and time.perf_counter() - _load_failed_at < settings.RERANKER_LOAD_RETRY_SECONDS
+
+
+def get_reranker_engine() -> Optional[object]:
+    """
+    Lazy-load the configured reranker engine. Returns None if nothing could be loaded
+    (without retrying the load until RERANKER_LOAD_RETRY_SECONDS have passed).
+    Blocking: async callers go through run_in_stage.
+    """
+    global _engine, _load_failed_at
+    if _engine is not None:
+        return _engine
+    if _load_backoff_active():
+        return None
+
+    with _engine_lock:
+        if _engine is not None:
+            return _engine
+        if _load_backoff_active():
+            return None
+
+        try:
+            model, tokenizer = load_torch_reranker()
+        except Exception as e:
+            _load_failed_at = time.perf_counter()
+            logger.error(f"❌ Failed to load reranker (retry in {settings.RERANKER_LOAD_RETRY_SECONDS:.0f}s): {e}")
+            return None
+        _load_failed_at = None
+
+        engine = TorchRerankerEngine(model, tokenizer)
+
+        if settings.RERANKER_BACKEND == "onnx":
+            try:
+                onnx_engine = build_onnx_engine(model, tokenizer)
+                if not settings.RERANKER_ONNX_PARITY_CHECK:
+                    engine = onnx_engine
+                    logger.info(f"✅ ONNX int8 reranker loaded (threads={settings.RERANKER_ONNX_THREADS})")
+                else:
+                    ok, max_diff = check_parity(engine, onnx_engine, settings.RERANKER_ONNX_PARITY_TOLERANCE)
+                    if ok:
+                        engine = onnx_engine
+                        logger.info(f"✅ ONNX int8 reranker passed parity (max Δ={max_diff:.4f}, threads={settings.RERANKER_ONNX_THREADS})")
+                    else:
+                        logger.warning(f"⚠️ ONNX reranker parity failed (max Δ={max_diff:.4f}). Falling back to torch.")
+            except Exception as e:
+                logger.warning(f"⚠️ ONNX reranker unavailable ({e}). Falling back to torch.")
+
+        _engine = engine
+        logger.info(f"✅ Reranker loaded: {engine.name} (Forced CPU)")
+        return _engine
+
+
+class RerankerBatcher:
+    """Cross-request dynamic batching in front of a reranker engine."""
+
+    def __init__(self, engine, max_batch_size: int, max_wait_ms: float):
+        self.engine = engine
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="reranker")
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self.stats: Dict[str, int] = {"requests": 0, "pairs": 0, "batches": 0, "max_batch_pairs": 0}
+
+    def _score_sorted(self, pairs: List[List[str]]) -> List[float]:
+        # Sort by passage length so each padded sub-batch wastes as little as possible
+        order = sorted(range(len(pairs)), key=lambda i: len(pairs[i][1]))
+        sorted_scores = self.engine.score([pairs[i] for i in order], batch_size=self.max_batch_size)
+        scores = [0.0] * len(pairs)
+        for pos, i in enumerate(order):
+            scores[i] = sorted_scores[pos]
+        return scores
+
+    async def score(self, pairs: List[List[str]]) -> List[float]:
+        if not pairs:
+            return []
+
+        loop = asyncio.get_running_loop()
+        if self._loop is not None and self._loop is not loop and self._loop.is_running():
+            # Called from a foreign loop (e.g. a worker thread): score directly, unbatched
+            return await loop.run_in_executor(self._executor, self._score_sorted, pairs)
+
+        if self._task is None or self._task.done() or self._loop is not loop:
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._task = loop.create_task(self._collector())
+
+        fut = loop.create_future()
+        await self._queue.put((pairs, fut))
+        return await fut
+
+    async def _collector(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            n_pairs = len(batch[0][0])
+            deadline = loop.time() + self.max_wait
+
+            while n_pairs < self.max_batch_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                batch.append(item)
+                n_pairs += len(item[0])
+
+            await self._run(batch, loop)
+
+    async def _run(self, batch: List[Tuple[List[List[str]], asyncio.Future]], loop):
+        all_pairs = [p for pairs, _ in batch for p in pairs]
+        self.stats["requests"] += len(batch)
+        self.stats["pairs"] += len(all_pairs)
+        self.stats["batches"] += 1
+        self.stats["max_batch_pairs"] = max(self.stats["max_batch_pairs"], len(all_pairs))
+
+        try:
+            scores = await loop.run_in_executor(self._executor, self._score_sorted, all_pairs)
+        except Exception as e:
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+
+        offset = 0
+        for pairs, fut in batch:
+            if not fut.done():
+                fut.set_result(scores[offset:offset + len(pairs)])
+            offset += len(pairs)
+
+    def get_stats(self) -> Dict[str, Any]:
+        batches = self.stats["batches"] or 1
+        return {
+            **self.stats,
+            "engine": self.engine.name,
+            "avg_requests_per_batch": round(self.stats["requests"] / batches, 2),
+            "avg_pairs_per_batch": round(self.stats["pairs"] / batches, 2),
+        }
+
+
+_batcher = None
+
+
+def get_reranker_batcher() -> Optional[RerankerBatcher]:
+    """Shared micro-batcher for the loaded engine (None if batching is off or no engine loaded)."""
+    global _batcher
+    if _batcher is None and settings.RERANKER_BATCH_ENABLED:
+        engine = get_reranker_engine()
+        if engine is not None:
+            _batcher = RerankerBatcher(
+                engine,
+                max_batch_size=settings.RERANKER_MAX_BATCH_SIZE,
+                max_wait_ms=settings.RERANKER_MAX_WAIT_MS,
+            )
+    return _batcher
+
+
+def peek_reranker_batcher() -> Optional[RerankerBatcher]:
+    """The batcher if one was already created (never loads the model; for stats)."""
+    return _batcher
@@ -0,0 +1,115 @@
+"""
+Stage Executors - Bounded Thread Pools for Blocking Pipeline Stages
+
+WHY THIS EXISTS:
+query_context is async, but ChromaDB's HttpClient, the Redis keyword index,
+the embedding proxy (requests.post) and the reranker forward pass are all
+blocking. Run inline, one chat's retrieval stalled webhooks and websockets
+for every other tenant on the same uvicorn worker.
+
+SOLUTION:
+Each blocking stage gets its own bounded ThreadPoolExecutor. The pool size
+is the stage's concurrency limit (excess work queues instead of piling
+threads), and every stage keeps its own latency / queue-wait / in-flight
+counters for the /health/pipeline endpoint.
+
+USAGE:
+    collection = await run_in_stage("chroma", self.get_or_create_collection, agent_id)
+"""
+import time
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class StageExecutor:
+    def __init__(self, name: str, max_workers: int):
+        self.name = name
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"stage-{name}")
+        self._lock = threading.Lock()
+        self.stats: Dict[str, float] = {
+            "calls": 0,
+            "errors": 0,
+            "in_flight": 0,
+            "max_in_flight": 0,
+            "total_ms": 0.0,
+            "max_ms": 0.0,
+            "total_wait_ms": 0.0,
+            "max_wait_ms": 0.0,
+        }
+
+    def _timed(self, submitted_at: float, fn: Callable, args, kwargs):
+        started = time.perf_counter()
+        wait_ms = (started - submitted_at) * 1000
+        with self._lock:
+            self.stats["in_flight"] += 1
+            self.stats["max_in_flight"] = max(self.stats["max_in_flight"], self.stats["in_flight"])
+            self.stats["total_wait_ms"] += wait_ms
+            self.stats["max_wait_ms"] = max(self.stats["max_wait_ms"], wait_ms)
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            with self._lock:
+                self.stats["errors"] += 1
+            raise
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            with self._lock:
+                self.stats["in_flight"] -= 1
+                self.stats["calls"] += 1
+                self.stats["total_ms"] += elapsed_ms
+                self.stats["max_ms"] = max(self.stats["max_ms"], elapsed_ms)
+
+    async def run(self, fn: Callable, *args, **kwargs) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._timed, time.perf_counter(), fn, args, kwargs)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            calls = self.stats["calls"] or 1
+            return {
+                "max_workers": self.max_workers,
+                **{k: round(v, 2) if isinstance(v, float) else v for k, v in self.stats.items()},
+                "avg_ms": round(self.stats["total_ms"] / calls, 2),
+                "avg_wait_ms": round(self.stats["total_wait_ms"] / calls, 2),
+            }
+
+
+_stages: Dict[str, StageExecutor] = {}
+_stages_lock = threading.Lock()
+
+
+def _stage_limits() -> Dict[str, int]:
+    return {
+        "chroma": settings.RAG_CHROMA_CONCURRENCY,
+        "embedding": settings.RAG_EMBEDDING_CONCURRENCY,
+        "keyword": settings.RAG_KEYWORD_CONCURRENCY,
+        "rerank": settings.RAG_RERANK_CONCURRENCY,
+    }
+
+
+def get_stage_executor(name: str) -> StageExecutor:
+    stage = _stages.get(name)
+    if stage is None:
+        with _stages_lock:
+            stage = _stages.get(name)
+            if stage is None:
+                stage = StageExecutor(name, _stage_limits().get(name, 4))
+                _stages[name] = stage
+    return stage
+
+
+async def run_in_stage(name: str, fn: Callable, *args, **kwargs) -> Any:
+    """Run a blocking callable on the named stage's bounded executor."""
+    return await get_stage_executor(name).run(fn, *args, **kwargs)
+
+
+def get_stage_stats() -> Dict[str, Dict[str, Any]]:
+    return {name: stage.get_stats() for name, stage in _stages.items()}
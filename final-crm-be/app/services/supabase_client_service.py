@@ -0,0 +1,118 @@
+"""
+Supabase Client Service - Process-Wide Pooled Service-Role Client
+
+WHY THIS EXISTS:
+The AI queue (`_execute_ai_logic`) and the webhook / chat API dependencies
+called `create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)` on every execution
+and every request. Each call built fresh httpx sessions, so every DB round
+trip on those hot paths started with a cold TCP + TLS handshake.
+
+SOLUTION:
+- One service-role client per process, created in main.lifespan.
+- Its PostgREST session is an httpx.Client with explicit pool limits and
+  keep-alive (HTTP/2), so table() calls reuse warm connections.
+- httpx.Client is thread-safe and every table() call builds its own request
+  builder, so the client is shared freely between tasks and asyncio.to_thread
+  calls. It never signs in, so its auth headers never change.
+- Code paths running before startup (scripts, tests) get the same client
+  lazily on first use.
+
+NOTE: the pooled httpx client is given to PostgREST only. supabase-py points a
+shared `ClientOptions.httpx_client` at whichever sub-client used it last
+(base_url is overwritten), so storage / functions keep their own sessions.
+"""
+import logging
+import threading
+from typing import Any, Dict, Optional
+
+import httpx
+from postgrest import SyncPostgrestClient
+from supabase import Client, create_client
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class SupabaseClientProvider:
+    def __init__(self):
+        self._client: Optional[Client] = None
+        self._http: Optional[httpx.Client] = None
+        self._lock = threading.Lock()
+        self.stats: Dict[str, int] = {"created": 0, "handed_out": 0}
+
+    def start(self) -> Client:
+        with self._lock:
+            if self._client is not None:
+                return self._client
+
+            self._http = httpx.Client(
+                limits=httpx.Limits(
+                    max_connections=settings.SUPABASE_POOL_MAX_CONNECTIONS,
+                    max_keepalive_connections=settings.SUPABASE_POOL_MAX_KEEPALIVE,
+                    keepalive_expiry=settings.SUPABASE_POOL_KEEPALIVE_SECONDS,
+                ),
+                timeout=settings.SUPABASE_POOL_TIMEOUT,
+                http2=True,
+                follow_redirects=True,
+            )
+            client = create_client(settings.SUPABASE_URL, settings.SUPABASE_SERVICE_KEY)
+            # Same construction as Client.postgrest, but on the pooled session
+            client._postgrest = SyncPostgrestClient(
+                client.rest_url,
+                headers=client.options.headers,
+                schema=client.options.schema,
+                http_client=self._http,
+            )
+            self._client = client
+            self.stats["created"] += 1
+
+        logger.info(
+            f"🗄️ Shared Supabase client ready (max {settings.SUPABASE_POOL_MAX_CONNECTIONS} conns, "
+            f"{settings.SUPABASE_POOL_MAX_KEEPALIVE} keep-alive)"
+        )
+        return client
+
+    def close(self):
+        with self._lock:
+            if self._http is not None:
+                self._http.close()
+            self._http = None
+            self._client = None
+        logger.info("🗄️ Shared Supabase client closed")
+
+    def get_client(self) -> Client:
+        client = self._client or self.start()
+        self.stats["handed_out"] += 1
+        return client
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats: Dict[str, Any] = {
+            **self.stats,
+            "limits": {
+                "max_connections": settings.SUPABASE_POOL_MAX_CONNECTIONS,
+                "max_keepalive": settings.SUPABASE_POOL_MAX_KEEPALIVE,
+                "keepalive_seconds": settings.SUPABASE_POOL_KEEPALIVE_SECONDS,
+            },
+            "pool": None,
+        }
+        if self._http is not None:
+            try:
+                connections = self._http._transport._pool.connections
+                idle = sum(1 for c in connections if c.is_idle())
+                stats["pool"] = {"active": len(connections) - idle, "idle": idle}
+            except AttributeError:
+                pass
+        return stats
+
+
+_provider = SupabaseClientProvider()
+
+
+def get_supabase_provider() -> SupabaseClientProvider:
+    return _provider
+
+
+def get_shared_supabase() -> Client:
+    """Process-wide service-role Supabase client (pooled PostgREST connections)."""
+    return _provider.get_client()
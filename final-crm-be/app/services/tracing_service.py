@@ -0,0 +1,288 @@
+"""
+Tracing Service - Per-Stage Spans for the AI Reply Pipeline
+
+WHY THIS EXISTS:
+timings_ms only covered the top-level stages inside process_and_respond, so
+there was no way to see where the seconds went between enqueue and the
+WhatsApp callback: debounce, admission, retrieval layers, individual LLM
+turns and tool calls, the insert and the outbound callback were invisible.
+
+SOLUTION:
+- One PipelineTrace per AI reply, carried in a ContextVar, so every coroutine
+  and task spawned from the reply (asyncio copies the context) adds its spans
+  to it without threading a parameter through every service.
+      with span("rag.rerank", candidates=50): ...
+  span() is a no-op when no trace is active (scripts, other callers).
+- The trace starts in the queue worker (origin = first enqueue, so debounce
+  shows up as a span) or in process_and_respond for direct calls.
+- Work that outlives the reply (the outbound callback task) hold()s the trace;
+  it completes when the last holder releases it. On completion it:
+    * runs on_complete hooks (the AI service rewrites the message's
+      metadata.trace with the final spans), and
+    * is exported through OpenTelemetry (OTLP/HTTP, OTEL_TRACES_ENABLED) as a
+      root span plus one child per stage, with the original timestamps.
+- The span tree is stored compactly on the AI message as metadata.trace:
+    {"trace_id", "total_ms", "spans": [{"id", "parent", "name", "start_ms", "ms", ...attrs}]}
+"""
+import time
+import uuid
+import asyncio
+import logging
+import threading
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+from app.config import settings
+
+try:
+    from opentelemetry import trace as otel_trace
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+except ImportError:  # exporter is optional; spans still land in message metadata
+    otel_trace = None
+
+logger = logging.getLogger(__name__)
+
+_current_trace: ContextVar[Optional["PipelineTrace"]] = ContextVar("pipeline_trace", default=None)
+_current_span: ContextVar[Optional[int]] = ContextVar("pipeline_span", default=None)
+
+_provider = None
+_tracer = None
+# Strong refs for on_complete hooks scheduled as tasks
+_hook_tasks: Set[asyncio.Task] = set()
+
+
+@dataclass
+class Span:
+    id: int
+    name: str
+    parent: Optional[int]
+    start: float
+    end: Optional[float] = None
+    attrs: Dict[str, Any] = field(default_factory=dict)
+
+
+class PipelineTrace:
+    MAX_SPANS = 256
+
+    def __init__(self, name: str, origin_wall: Optional[float] = None, **attrs):
+        self.trace_id = uuid.uuid4().hex
+        self.name = name
+        self.attrs = attrs
+        # perf_counter for durations, anchored to wall time for export / retro spans
+        self._perf0 = time.perf_counter()
+        self._wall0 = time.time()
+        self.origin = self.perf_from_wall(origin_wall) if origin_wall else self._perf0
+        self.ended: Optional[float] = None
+        self.spans: List[Span] = []
+        self.dropped = 0
+        self._pending = 1
+        self._hooks: List[Callable[["PipelineTrace"], Awaitable[Any]]] = []
+        self._lock = threading.Lock()
+
+    def perf_from_wall(self, ts: float) -> float:
+        return self._perf0 + (float(ts) - self._wall0)
+
+    def _wall_ns(self, perf: float) -> int:
+        return int((self._wall0 + (perf - self._perf0)) * 1e9)
+
+    # --- Recording ---
+    def open_span(self, name: str, parent: Optional[int], attrs: Dict[str, Any], start: Optional[float] = None) -> Optional[Span]:
+        with self._lock:
+            if len(self.spans) >= self.MAX_SPANS:
+                self.dropped += 1
+                return None
+            s = Span(id=len(self.spans), name=name, parent=parent, start=start or time.perf_counter(), attrs=attrs)
+            self.spans.append(s)
+            return s
+
+    def add_span(self, name: str, start: float, end: float, **attrs) -> Optional[Span]:
+        """Record an already-finished interval (perf_counter times), e.g. the debounce wait."""
+        s = self.open_span(name, _current_span.get(), attrs, start=start)
+        if s is not None:
+            s.end = max(start, end)
+        return s
+
+    # --- Lifetime ---
+    def hold(self):
+        with self._lock:
+            self._pending += 1
+
+    def release(self):
+        with self._lock:
+            self._pending -= 1
+            done = self._pending == 0
+        if done:
+            self._complete()
+
+    def on_complete(self, hook: Callable[["PipelineTrace"], Awaitable[Any]]):
+        self._hooks.append(hook)
+
+    def _complete(self):
+        self.ended = time.perf_counter()
+        _export(self)
+        for hook in self._hooks:
+            try:
+                task = asyncio.get_running_loop().create_task(hook(self))
+                _hook_tasks.add(task)
+                task.add_done_callback(_hook_tasks.discard)
+            except Exception as e:
+                logger.debug(f"[Tracing] on_complete hook skipped: {e}")
+
+    # --- Output ---
+    def summary(self) -> Dict[str, Any]:
+        """Finished spans, offsets relative to the trace origin (ms)."""
+        end = self.ended or time.perf_counter()
+        spans = []
+        with self._lock:
+            for s in self.spans:
+                if s.end is None:
+                    continue
+                spans.append({
+                    "id": s.id,
+                    "parent": s.parent,
+                    "name": s.name,
+                    "start_ms": round((s.start - self.origin) * 1000, 1),
+                    "ms": round((s.end - s.start) * 1000, 1),
+                    **s.attrs,
+                })
+        out = {"trace_id": self.trace_id, "total_ms": round((end - self.origin) * 1000, 1), "spans": spans}
+        if self.dropped:
+            out["dropped_spans"] = self.dropped
+        return out
+
+
+def current_trace() -> Optional[PipelineTrace]:
+    return _current_trace.get()
+
+
+@asynccontextmanager
+async def pipeline_trace(name: str, origin_wall: Optional[float] = None, **attrs):
+    """
+    Open a trace for one AI reply (or join the one already active, e.g. the
+    queue worker's). Yields the trace, or None when AI_TRACING_ENABLED is off.
+    """
+    existing = _current_trace.get()
+    if existing is not None or not settings.AI_TRACING_ENABLED:
+        yield existing
+        return
+
+    trace = PipelineTrace(name, origin_wall=origin_wall, **attrs)
+    token = _current_trace.set(trace)
+    span_token = _current_span.set(None)
+    try:
+        yield trace
+    finally:
+        _current_span.reset(span_token)
+        _current_trace.reset(token)
+        trace.release()
+
+
+@contextmanager
+def span(name: str, **attrs):
+    """Time the enclosed block as a child of the current span (no-op without a trace)."""
+    trace = _current_trace.get()
+    s = trace.open_span(name, _current_span.get(), attrs) if trace else None
+    if s is None:
+        yield None
+        return
+    token = _current_span.set(s.id)
+    try:
+        yield s
+    except BaseException as e:
+        s.attrs["error"] = type(e).__name__
+        raise
+    finally:
+        _current_span.reset(token)
+        s.end = time.perf_counter()
+
+
+def record_span(name: str, start: float, end: Optional[float] = None, **attrs):
+    """Record a finished interval (perf_counter) on the current trace, e.g. a lock wait."""
+    trace = _current_trace.get()
+    if trace:
+        trace.add_span(name, start, end or time.perf_counter(), **attrs)
+
+
+async def traced(name: str, awaitable: Awaitable, **attrs):
+    """`await traced("rag.bm25", coro)` — span around a single awaitable (handy inside gather)."""
+    with span(name, **attrs):
+        return await awaitable
+
+
+def create_traced_task(name: str, coro: Awaitable, **attrs) -> asyncio.Task:
+    """Fire-and-forget task that still reports into the current trace (which waits for it)."""
+    trace = _current_trace.get()
+    if trace:
+        trace.hold()
+
+    async def runner():
+        try:
+            with span(name, **attrs):
+                return await coro
+        finally:
+            if trace:
+                trace.release()
+
+    return asyncio.create_task(runner())
+
+
+# --- OpenTelemetry export ---
+def _otel_attrs(attrs: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: v for k, v in attrs.items() if isinstance(v, (str, bool, int, float)) and v is not None}
+
+
+def _export(trace: PipelineTrace):
+    if _tracer is None:
+        return
+    try:
+        root = _tracer.start_span(
+            trace.name,
+            start_time=trace._wall_ns(trace.origin),
+            attributes={"pipeline.trace_id": trace.trace_id, **_otel_attrs(trace.attrs)},
+        )
+        contexts = {None: otel_trace.set_span_in_context(root)}
+        for s in list(trace.spans):
+            if s.end is None:
+                continue
+            child = _tracer.start_span(
+                s.name,
+                context=contexts.get(s.parent, contexts[None]),
+                start_time=trace._wall_ns(s.start),
+                attributes=_otel_attrs(s.attrs),
+            )
+            contexts[s.id] = otel_trace.set_span_in_context(child)
+            child.end(end_time=trace._wall_ns(s.end))
+        root.end(end_time=trace._wall_ns(trace.ended or time.perf_counter()))
+    except Exception as e:
+        logger.warning(f"⚠️ [Tracing] OTLP export failed: {e}")
+
+
+def init_tracing():
+    """Set up the OTLP exporter (called from main.lifespan)."""
+    global _provider, _tracer
+    if not settings.OTEL_TRACES_ENABLED or _tracer is not None:
+        return
+    if otel_trace is None:
+        logger.warning("⚠️ OTEL_TRACES_ENABLED is set but opentelemetry-sdk / exporter is not installed")
+        return
+    _provider = TracerProvider(resource=Resource.create({"service.name": settings.OTEL_SERVICE_NAME}))
+    _provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter(endpoint=settings.OTEL_EXPORTER_OTLP_ENDPOINT)))
+    # Own provider, not the global one: nothing else in the process gets rerouted
+    _tracer = _provider.get_tracer("final-crm-be.ai-pipeline")
+    logger.info(f"🔭 OTLP trace export → {settings.OTEL_EXPORTER_OTLP_ENDPOINT}")
+
+
+def shutdown_tracing():
+    global _provider, _tracer
+    if _provider is not None:
+        try:
+            _provider.shutdown()
+        except Exception as e:
+            logger.warning(f"⚠️ [Tracing] Exporter shutdown failed: {e}")
+    _provider = None
+    _tracer = None
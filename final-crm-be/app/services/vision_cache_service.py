@@ -0,0 +1,182 @@
+"""
+Vision Cache Service - Vision Analysis Results by Image Content
+
+WHY THIS EXISTS:
+analyze_image sent the same picture to the proxy on every retry and every
+re-debounce of a chat, and again whenever customers forwarded the same
+product photo / QR code. Each of those is an up-to-60s vision call.
+
+SOLUTION:
+- Results are cached in Redis (TTL) under two keys, both scoped by
+  (vision prompt, model):
+    vision:u:{sha(media_url …)}   – same message / retry: no download needed
+    vision:c:{sha(image bytes …)} – forwarded copies with a new media_url
+- Concurrent analyses of the same image are coalesced: one in-process
+  future per key, plus a short Redis lock so the other uvicorn workers wait
+  for the leader's result instead of calling vision as well.
+- Empty results (failures, timeouts) are never cached.
+"""
+import asyncio
+import hashlib
+import logging
+import threading
+from typing import Awaitable, Callable, Dict, Optional
+
+import aiohttp
+
+from app.config import settings
+from app.services.redis_service import get_redis, acquire_lock
+from app.services.http_client_service import proxy_session
+
+logger = logging.getLogger(__name__)
+
+
+class VisionCache:
+    def __init__(self, ttl: int, hash_content: bool, max_bytes: int):
+        self.ttl = ttl
+        self.hash_content = hash_content
+        self.max_bytes = max_bytes
+        self.redis = get_redis()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._lock = threading.Lock()
+        self.stats: Dict[str, int] = {
+            "url_hits": 0, "content_hits": 0, "misses": 0, "coalesced": 0,
+            "stores": 0, "download_errors": 0, "redis_errors": 0,
+        }
+
+    def _count(self, field: str, n: int = 1):
+        with self._lock:
+            self.stats[field] += n
+
+    @staticmethod
+    def _key(kind: str, ident: str, prompt: str, model: str) -> str:
+        digest = hashlib.sha256(f"{model}\x00{prompt}\x00{ident}".encode("utf-8")).hexdigest()
+        return f"vision:{kind}:{digest}"
+
+    async def _get(self, key: str) -> Optional[str]:
+        try:
+            return await self.redis.get(key)
+        except Exception as e:
+            logger.warning(f"⚠️ [VisionCache] Redis read failed: {e}")
+            self._count("redis_errors")
+            return None
+
+    async def _set(self, keys, value: str):
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for key in keys:
+                pipe.set(key, value, ex=self.ttl)
+            await pipe.execute()
+            self._count("stores")
+        except Exception as e:
+            logger.warning(f"⚠️ [VisionCache] Redis write failed: {e}")
+            self._count("redis_errors")
+
+    async def _content_digest(self, image_url: str) -> Optional[str]:
+        """sha256 of the image bytes (None if the download fails or the image is too big)."""
+        try:
+            timeout = aiohttp.ClientTimeout(total=10)
+            async with proxy_session() as session:
+                async with session.get(image_url, timeout=timeout) as resp:
+                    if resp.status != 200:
+                        raise ValueError(f"HTTP {resp.status}")
+                    h = hashlib.sha256()
+                    size = 0
+                    async for chunk in resp.content.iter_chunked(65536):
+                        size += len(chunk)
+                        if size > self.max_bytes:
+                            raise ValueError("image exceeds VISION_CACHE_MAX_BYTES")
+                        h.update(chunk)
+                    return h.hexdigest()
+        except Exception as e:
+            logger.debug(f"[VisionCache] Content hash skipped for {image_url}: {e}")
+            self._count("download_errors")
+            return None
+
+    async def get_or_analyze(
+        self,
+        image_url: str,
+        prompt: str,
+        model: str,
+        analyze: Callable[[], Awaitable[str]],
+    ) -> str:
+        url_key = self._key("u", image_url, prompt, model)
+        cached = await self._get(url_key)
+        if cached is not None:
+            self._count("url_hits")
+            return cached
+
+        keys = [url_key]
+        if self.hash_content:
+            digest = await self._content_digest(image_url)
+            if digest:
+                content_key = self._key("c", digest, prompt, model)
+                cached = await self._get(content_key)
+                if cached is not None:
+                    self._count("content_hits")
+                    await self._set([url_key], cached)
+                    return cached
+                keys.insert(0, content_key)
+
+        lead_key = keys[0]
+        future = self._inflight.get(lead_key)
+        if future is not None:
+            self._count("coalesced")
+            return await asyncio.shield(future)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[lead_key] = future
+        try:
+            result = await self._analyze_once(lead_key, keys, analyze)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            # Followers fall back to an empty result, like a failed vision call
+            future.set_result("")
+            raise e
+        finally:
+            self._inflight.pop(lead_key, None)
+
+    async def _analyze_once(self, lead_key: str, keys, analyze: Callable[[], Awaitable[str]]) -> str:
+        """Cross-worker coalescing: whoever holds the lock analyses, the rest re-read the cache."""
+        wait = int(settings.AI_VISION_TIMEOUT)
+        async with acquire_lock(lead_key, expire=wait + 30, wait_time=wait):
+            # Whether we got the lock or gave up waiting, another worker may have finished meanwhile
+            cached = await self._get(lead_key)
+            if cached is not None:
+                self._count("coalesced")
+                if len(keys) > 1:
+                    await self._set(keys[1:], cached)
+                return cached
+
+            self._count("misses")
+            result = (await analyze() or "").strip()
+            if result:
+                await self._set(keys, result)
+            return result
+
+    def get_stats(self) -> Dict[str, float]:
+        with self._lock:
+            # Coalesced waiters skipped the vision call too
+            hits = self.stats["url_hits"] + self.stats["content_hits"] + self.stats["coalesced"]
+            lookups = hits + self.stats["misses"]
+            return {
+                **self.stats,
+                "ttl": self.ttl,
+                "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+_vision_cache: Optional[VisionCache] = None
+
+
+def get_vision_cache() -> Optional[VisionCache]:
+    """Shared vision result cache (None when VISION_CACHE_ENABLED is off)."""
+    global _vision_cache
+    if _vision_cache is None and settings.VISION_CACHE_ENABLED:
+        _vision_cache = VisionCache(
+            ttl=settings.VISION_CACHE_TTL,
+            hash_content=settings.VISION_CACHE_HASH_CONTENT,
+            max_bytes=settings.VISION_CACHE_MAX_BYTES,
+        )
+    return _vision_cache
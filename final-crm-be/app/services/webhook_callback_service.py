@@ -10,6 +10,7 @@ import re
 from typing import Dict, Any, Optional
 from datetime import datetime
 from app.config.settings import settings
+from app.services.chat_window_service import invalidate_window
 
 logger = logging.getLogger(__name__)
 
@@ -191,6 +192,7 @@ class WebhookCallbackService:
                     if latest_msg.data:
                         msg_id = latest_msg.data[0]["id"]
                         supabase.table("messages").update({"content": clean_content}).eq("id", msg_id).execute()
+                        await invalidate_window(chat["id"])
                 except Exception: pass
                 message_content = clean_content
 
@@ -282,6 +282,37 @@ class ConnectionManager:
 
         await self.broadcast_to_organization(notification, organization_id)  
 
+    async def broadcast_ai_message_delta(
+        self,
+        organization_id: str,
+        chat_id: str,
+        provisional_id: str,
+        delta: str,
+        seq: int,
+        done: bool = False,
+        discarded: bool = False
+    ):
+        """
+        Broadcast a streamed fragment of an AI reply that is still being generated.
+        The console appends `delta` to the bubble keyed by provisional_id; the
+        committed reply follows as a regular new_message whose metadata carries
+        the same provisional_id. `discarded` means no message will be committed.
+        """
+        notification = {
+            "type": "ai_message_delta",
+            "timestamp": datetime.utcnow().isoformat(),
+            "data": {
+                "chat_id": chat_id,
+                "provisional_id": provisional_id,
+                "delta": delta,
+                "seq": seq,
+                "done": done,
+                "discarded": discarded
+            }
+        }
+
+        await self.broadcast_to_organization(notification, organization_id)
+
     async def broadcast_chat_update(
         self,
         organization_id: str,
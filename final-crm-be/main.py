@@ -24,6 +24,9 @@ from app.api import documents, agents, chat, jobs_scheduler, organizations, file
 from app.services import get_agent_service
 from app.services.crm_chroma_service_v2 import get_crm_chroma_service_v2 
 from app.services.document_queue_service import get_document_worker
+from app.services.http_client_service import get_http_pool
+from app.services.supabase_client_service import get_supabase_provider
+from app.services.tracing_service import init_tracing, shutdown_tracing
 from app.services.websocket_service import start_redis_pubsub_listener, connection_manager # Initialize logger
 
 logging.basicConfig(
@@ -67,14 +70,27 @@ async def lifespan(app: FastAPI):
     agent_service = get_agent_service()
     await agent_service.initialize_agents()
 
-    # [NEW] Start LLM Queue Worker
+    # Pooled keep-alive HTTP clients (LLM proxy + MCP servers)
+    http_pool = get_http_pool()
+    await http_pool.start()
+
+    # Shared service-role Supabase client (webhooks, chat API, AI queue)
+    supabase_provider = get_supabase_provider()
+    if settings.is_supabase_configured:
+        supabase_provider.start()
+
+    # AI pipeline traces → OTLP collector (no-op unless OTEL_TRACES_ENABLED)
+    init_tracing()
+
+    # Start LLM Queue Scheduler (claims due chats from Redis, bounded worker pool)
     queue_service = get_llm_queue()
     asyncio.create_task(queue_service.start_worker())
 
-    # Preload reranker model (avoid 18s delay on first query)
+    # Preload reranker model (avoid 18s delay on first query).
+    # Off the event loop: the download / ONNX export must not stall the queue worker.
     chroma_service = get_crm_chroma_service_v2()
-    chroma_service.preload_pdf_models()  # ← FIRST (sets HF_HOME env vars)
-    chroma_service._get_reranker()       # ← SECOND (uses env vars already set)
+    await asyncio.to_thread(chroma_service.preload_pdf_models)  # ← FIRST (sets HF_HOME env vars)
+    await asyncio.to_thread(chroma_service._get_reranker)       # ← SECOND (uses env vars already set)
 
     # Start Document Processing Worker (Redis-based, runs in daemon thread)
     doc_worker = get_document_worker()
@@ -97,6 +113,9 @@ async def lifespan(app: FastAPI):
     doc_worker.stop()
     # Safely cancel the listener when the server shuts down
     redis_listener_task.cancel()
+    await http_pool.close()
+    supabase_provider.close()
+    shutdown_tracing()
 
 
 # Create FastAPI application
@@ -372,6 +391,61 @@ def root():
     }
 
 
+@app.get(
+    "/health/pipeline",
+    tags=["health"],
+    summary="AI Pipeline Metrics",
+    description="Per-stage executor, reranker batching and cache counters for the AI reply pipeline (this worker process only).",
+)
+def pipeline_health():
+    """
+    Pipeline metrics endpoint
+
+    Returns in-process counters for:
+    - Retrieval stages: calls, errors, in-flight, latency and queue wait per executor
+    - Reranker: engine name and micro-batching stats
+    - Query embedding cache: L1/L2 hits, misses and hit rate
+    - Chunk embedding store: content-hash reuse during ingestion
+    - RAG context cache: versioned query_context result hits / misses
+    - MCP schema cache: hits, ETag revalidations, coalesced misses
+    - HTTP pools: in-flight requests and connection utilisation (LLM proxy / MCP)
+    - LLM queue: claimed / completed / re-queued turns and busy worker slots
+    - Supabase pool: shared client hand-outs and PostgREST connection usage
+    - Chat window: rolling history hits / misses / seeds
+    """
+    from app.services.stage_executor import get_stage_stats
+    from app.services.reranker_service import peek_reranker_batcher
+    from app.services.embedding_cache_service import get_query_embedding_cache, get_chunk_embedding_store
+    from app.services.rag_context_cache_service import get_rag_context_cache
+    from app.services.mcp_service import get_mcp_service
+    from app.services.chat_window_service import get_chat_window
+    from app.services.vision_cache_service import get_vision_cache
+    from app.services.faq_cache_service import get_faq_cache
+
+    batcher = peek_reranker_batcher()
+    query_cache = get_query_embedding_cache()
+    chunk_store = get_chunk_embedding_store()
+    context_cache = get_rag_context_cache()
+    chat_window = get_chat_window()
+    vision_cache = get_vision_cache()
+    faq_cache = get_faq_cache()
+    return {
+        "pid": os.getpid(),
+        "retrieval_stages": get_stage_stats(),
+        "reranker": batcher.get_stats() if batcher else None,
+        "query_embedding_cache": query_cache.get_stats() if query_cache else None,
+        "chunk_embedding_store": chunk_store.get_stats() if chunk_store else None,
+        "rag_context_cache": context_cache.get_stats() if context_cache else None,
+        "mcp_schema_cache": get_mcp_service().get_cache_stats(),
+        "http_pools": get_http_pool().get_stats(),
+        "llm_queue": get_llm_queue().get_stats(),
+        "supabase_pool": get_supabase_provider().get_stats(),
+        "chat_window": chat_window.get_stats() if chat_window else None,
+        "vision_cache": vision_cache.get_stats() if vision_cache else None,
+        "faq_cache": faq_cache.get_stats() if faq_cache else None,
+    }
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(
@@ -0,0 +1,188 @@
+"""
+BM25 keyword index: incremental add / remove, scoring, and cross-process
+version detection for the local (snapshot + delta log) and Redis backends.
+"""
+import json
+
+import pytest
+
+kw = pytest.importorskip("app.services.keyword_index_service")
+
+
+def _docs():
+    return {
+        "a": "harga kopi susu 25 ribu",
+        "b": "jam buka toko 08.00 sampai 21.00",
+        "c": "menu kopi hitam dan kopi susu",
+    }
+
+
+# --- _CollectionIndex ---
+def test_add_builds_postings_and_lengths():
+    idx = kw._CollectionIndex()
+    for cid, text in _docs().items():
+        idx.add(cid, text)
+
+    assert set(idx.doc_terms) == {"a", "b", "c"}
+    assert idx.postings["kopi"] == {"a": 1, "c": 2}
+    assert idx.total_len == sum(idx.doc_len.values())
+
+
+def test_readd_replaces_previous_terms():
+    idx = kw._CollectionIndex()
+    idx.add("a", "kopi kopi susu")
+    idx.add("a", "teh manis")
+
+    assert "kopi" not in idx.postings
+    assert idx.doc_len["a"] == 2
+    assert idx.total_len == 2
+
+
+def test_remove_cleans_postings():
+    idx = kw._CollectionIndex()
+    for cid, text in _docs().items():
+        idx.add(cid, text)
+    idx.remove("a")
+    idx.remove("missing")
+
+    assert "a" not in idx.doc_terms
+    assert "harga" not in idx.postings
+    assert idx.postings["kopi"] == {"c": 2}
+    assert idx.total_len == sum(idx.doc_len.values())
+
+
+def test_search_ranks_by_bm25():
+    idx = kw._CollectionIndex()
+    for cid, text in _docs().items():
+        idx.add(cid, text)
+
+    results = idx.search("kopi", k=10)
+    assert [cid for cid, _ in results] == ["c", "a"]
+    assert idx.search("tidak ada", k=10) == []
+    assert len(idx.search("kopi jam", k=1)) == 1
+
+
+def test_short_codes_are_tokens():
+    idx = kw._CollectionIndex()
+    idx.add("a", "Paket 01 promo")
+    idx.add("b", "Paket 02 promo")
+    assert idx.search("01", k=5)[0][0] == "a"
+
+
+def test_apply_replays_records():
+    idx = kw._CollectionIndex()
+    idx.apply({"v": 1, "add": {"a": {"kopi": 2}, "b": {"teh": 1}}})
+    idx.apply({"v": 2, "remove": ["b"]})
+
+    assert idx.version == 2
+    assert set(idx.doc_terms) == {"a"}
+    assert idx.total_len == 2
+
+
+# --- LocalKeywordIndex ---
+@pytest.fixture
+def local_dir(tmp_path):
+    return str(tmp_path)
+
+
+def test_local_other_process_sees_new_version(local_dir):
+    writer = kw.LocalKeywordIndex(local_dir)
+    reader = kw.LocalKeywordIndex(local_dir)
+    docs = _docs()
+    writer.add("col", list(docs), list(docs.values()))
+    assert reader.search("col", "jam", 5)[0][0] == "b"
+
+    writer.add("col", ["d"], ["kopi kopi kopi"])
+    writer.remove("col", ["c"])
+    assert writer.version("col") == reader.version("col") == 3
+    assert [cid for cid, _ in reader.search("col", "kopi", 5)] == ["d", "a"]
+
+
+def test_local_writes_append_to_the_log(local_dir):
+    index = kw.LocalKeywordIndex(local_dir)
+    docs = _docs()
+    index.add("col", list(docs), list(docs.values()))
+    snapshot = open(index._path("col", "json")).read()
+
+    index.add("col", ["d"], ["teh tarik"])
+    index.remove("col", ["a"])
+
+    # Small writes leave the snapshot alone and only append delta records
+    assert open(index._path("col", "json")).read() == snapshot
+    lines = [json.loads(line) for line in open(index._path("col", "log"))]
+    assert lines[0] == {"base": 1}
+    assert lines[1] == {"add": {"d": {"teh": 1, "tarik": 1}}, "v": 2}
+    assert lines[2] == {"remove": ["a"], "v": 3}
+
+
+def test_local_compaction_folds_the_log(local_dir):
+    index = kw.LocalKeywordIndex(local_dir)
+    reader = kw.LocalKeywordIndex(local_dir)
+    index.add("col", ["seed"], ["awal"])
+    n = 2 * index.COMPACT_EVERY
+    for i in range(n):
+        index.add("col", [f"d{i}"], [f"produk {i}"])
+
+    # Header + at most COMPACT_EVERY - 1 records since the last snapshot
+    lines = open(index._path("col", "log")).read().splitlines()
+    assert len(lines) <= index.COMPACT_EVERY
+    assert json.loads(lines[0])["base"] > index.COMPACT_EVERY
+    assert len(reader.search("col", "produk", 1000)) == n
+
+
+def test_local_torn_tail_is_ignored(local_dir):
+    index = kw.LocalKeywordIndex(local_dir)
+    index.add("col", ["a", "b"], ["kopi", "teh"])
+    index.add("col", ["c"], ["susu"])
+    with open(index._path("col", "log"), "a") as f:
+        f.write('{"add": {"x": {"kop')
+
+    reader = kw.LocalKeywordIndex(local_dir)
+    assert reader.search("col", "susu", 5)[0][0] == "c"
+    assert "x" not in reader._loaded["col"].doc_terms
+
+
+def test_local_drop(local_dir):
+    index = kw.LocalKeywordIndex(local_dir)
+    index.add("col", ["a"], ["kopi"])
+    index.drop("col")
+    assert not index.exists("col")
+    assert index.search("col", "kopi", 5) == []
+
+
+# --- RedisKeywordIndex ---
+@pytest.fixture
+def redis_index():
+    fakeredis = pytest.importorskip("fakeredis")
+    return kw.RedisKeywordIndex(client=fakeredis.FakeRedis(decode_responses=True))
+
+
+def test_redis_add_remove_and_version(redis_index):
+    docs = _docs()
+    redis_index.add("col", list(docs), list(docs.values()))
+    assert redis_index.exists("col")
+    v1 = redis_index.version("col")
+    assert [cid for cid, _ in redis_index.search("col", "kopi", 5)] == ["c", "a"]
+
+    redis_index.add("col", ["a"], ["teh"])  # re-add replaces the old terms
+    redis_index.remove("col", ["c"])
+    assert redis_index.version("col") > v1
+    assert redis_index.search("col", "kopi", 5) == []
+
+    meta = redis_index.redis.hgetall(redis_index._key("col", "meta"))
+    assert int(meta["n_docs"]) == 2
+    lengths = redis_index.redis.hvals(redis_index._key("col", "len"))
+    assert int(meta["total_len"]) == sum(int(n) for n in lengths)
+
+
+def test_redis_matches_in_memory_scores(redis_index):
+    docs = _docs()
+    redis_index.add("col", list(docs), list(docs.values()))
+    idx = kw._CollectionIndex()
+    for cid, text in docs.items():
+        idx.add(cid, text)
+
+    expected = idx.search("kopi susu jam", 5)
+    got = redis_index.search("col", "kopi susu jam", 5)
+    assert [cid for cid, _ in got] == [cid for cid, _ in expected]
+    assert [s for _, s in got] == pytest.approx([s for _, s in expected])
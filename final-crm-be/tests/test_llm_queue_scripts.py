@@ -0,0 +1,182 @@
+"""
+LLM queue Lua scripts (claim with lane / per-org admission, lease, reclaim,
+shed) and the limiter headroom they are fed with. Runs against fakeredis
+(needs its Lua support, lupa).
+"""
+import time
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+pytest.importorskip("lupa")
+q = pytest.importorskip("app.services.llm_queue_service")
+limiter_mod = pytest.importorskip("app.services.ai_execution_limiter")
+
+DUE, LEASE, CTX, CLAIMED = q.DUE_KEY, q.LEASE_KEY, q.CTX_PREFIX, q.CLAIMED_PREFIX
+
+
+@pytest.fixture
+def r():
+    return fakeredis.FakeRedis(decode_responses=True)
+
+
+def due(r, chat_id, org="org-a", priority="low", at=None, **extra):
+    at = time.time() - 1 if at is None else at
+    r.hset(f"{CTX}{chat_id}", mapping={
+        "run_at": at, "msg_id": f"m-{chat_id}", "priority": priority,
+        "ticket_id": "", "org_id": org, "attempts": 0, **extra,
+    })
+    r.zadd(DUE, {chat_id: at})
+
+
+def claim(r, limit=10, default_cap=4, caps=None, token="tok", scan=500):
+    now = time.time()
+    args = [now, now + 60, limit, CTX, CLAIMED, token, scan, default_cap]
+    for org, remaining in (caps or {}).items():
+        args.extend([org, remaining])
+    out = r.register_script(q._CLAIM_LUA)(keys=[DUE, LEASE], args=args)
+    return [chat_id for chat_id, _ in out]
+
+
+# --- claim / admission ---
+def test_claim_moves_context_to_claimed_and_leases(r):
+    due(r, "c1")
+    assert claim(r) == ["c1"]
+
+    assert not r.exists(f"{CTX}c1")
+    assert r.zscore(DUE, "c1") is None
+    assert r.zscore(LEASE, "c1") is not None
+    claimed = r.hgetall(f"{CLAIMED}c1")
+    assert claimed["token"] == "tok"
+    assert claimed["attempts"] == "1"
+    assert claimed["msg_id"] == "m-c1"
+
+
+def test_claim_orders_by_lane_then_due_time(r):
+    now = time.time()
+    due(r, "low-old", priority="low", at=now - 30, org="o1")
+    due(r, "medium", priority="medium", at=now - 20, org="o2")
+    due(r, "urgent", priority="urgent", at=now - 10, org="o3")
+    due(r, "unknown", priority="whatever", at=now - 40, org="o4")
+    due(r, "high", priority="HIGH", at=now - 5, org="o5")
+
+    # Unknown priorities ride the low lane, in due order
+    assert claim(r, limit=5) == ["urgent", "high", "medium", "unknown", "low-old"]
+
+
+def test_claim_skips_orgs_at_their_cap(r):
+    for i in range(6):
+        due(r, f"a{i}", org="broadcast", at=time.time() - 10 + i)
+    due(r, "b0", org="other", at=time.time() - 1)
+
+    claimed = claim(r, limit=16, default_cap=4)
+    assert claimed == ["a0", "a1", "a2", "a3", "b0"]
+    # The rest of the broadcast waits on queue:due, not in a worker slot
+    assert set(r.zrange(DUE, 0, -1)) == {"a4", "a5"}
+
+
+def test_claim_uses_remaining_slots_of_running_orgs(r):
+    due(r, "a0", org="busy")
+    due(r, "a1", org="busy")
+    due(r, "b0", org="idle")
+    assert claim(r, caps={"busy": 0}) == ["b0"]
+    assert claim(r, caps={"busy": 1}) == ["a0"]
+
+
+def test_claim_respects_limit_and_deadlines(r):
+    due(r, "now1")
+    due(r, "now2")
+    due(r, "later", at=time.time() + 60)
+
+    assert len(claim(r, limit=1)) == 1
+    assert len(claim(r, limit=5)) == 1
+    assert r.zrange(DUE, 0, -1) == ["later"]
+
+
+def test_claim_drops_ids_without_context(r):
+    r.zadd(DUE, {"ghost": time.time() - 1})
+    due(r, "c1")
+    assert claim(r) == ["c1"]
+    assert r.zcard(DUE) == 0
+
+
+# --- lease / reclaim ---
+def test_lease_renew_and_release_need_the_token(r):
+    due(r, "c1")
+    claim(r, token="mine")
+    lease = r.register_script(q._LEASE_LUA)
+    key = f"{CLAIMED}c1"
+
+    assert lease(keys=[LEASE, key], args=["c1", "other", time.time() + 999]) == 0
+    assert lease(keys=[LEASE, key], args=["c1", "mine", 12345]) == 1
+    assert r.zscore(LEASE, "c1") == 12345
+    assert lease(keys=[LEASE, key], args=["c1", "mine", ""]) == 1
+    assert r.zscore(LEASE, "c1") is None
+    assert not r.exists(key)
+
+
+def reclaim(r, max_attempts=2):
+    return r.register_script(q._RECLAIM_LUA)(keys=[LEASE, DUE], args=[time.time(), CTX, CLAIMED, max_attempts])
+
+
+def test_reclaim_requeues_expired_lease(r):
+    due(r, "c1")
+    claim(r)
+    r.zadd(LEASE, {"c1": time.time() - 1})
+
+    assert reclaim(r) == 1
+    ctx = r.hgetall(f"{CTX}c1")
+    assert "token" not in ctx and ctx["msg_id"] == "m-c1"
+    assert r.zscore(DUE, "c1") is not None
+    assert not r.exists(f"{CLAIMED}c1")
+
+
+def test_reclaim_keeps_newer_pending_turn(r):
+    due(r, "c1")
+    claim(r)
+    r.zadd(LEASE, {"c1": time.time() - 1})
+    due(r, "c1", msg_id="newer")
+
+    assert reclaim(r) == 0
+    assert r.hget(f"{CTX}c1", "msg_id") == "newer"
+    assert not r.exists(f"{CLAIMED}c1")
+
+
+def test_reclaim_gives_up_after_max_attempts(r):
+    due(r, "c1")
+    claim(r)
+    r.hset(f"{CLAIMED}c1", "attempts", 2)
+    r.zadd(LEASE, {"c1": time.time() - 1})
+
+    assert reclaim(r, max_attempts=2) == 0
+    assert not r.exists(f"{CTX}c1")
+    assert r.zscore(DUE, "c1") is None
+
+
+# --- shed ---
+def test_shed_drops_only_overdue_low_and_medium(r):
+    now = time.time()
+    due(r, "old-low", priority="low", at=now - 100)
+    due(r, "old-medium", priority="medium", at=now - 100)
+    due(r, "old-high", priority="high", at=now - 100)
+    due(r, "fresh-low", priority="low", at=now - 1)
+
+    shed = r.register_script(q._SHED_LUA)(keys=[DUE], args=[now - 20, CTX, 500])
+    assert sorted(chat_id for chat_id, _ in shed) == ["old-low", "old-medium"]
+    assert set(r.zrange(DUE, 0, -1)) == {"old-high", "fresh-low"}
+    assert not r.exists(f"{CTX}old-low")
+
+
+# --- limiter headroom fed to the claim ---
+def test_limiter_headroom_and_try_acquire():
+    limiter = limiter_mod.AIExecutionLimiter(global_limit=3, per_org_limit=2, max_queue_wait=1, overflow_policy="delay")
+    first = limiter.try_acquire("a", "low", queued_for=2.0)
+    assert first is not None and first.wait_ms >= 2000
+    assert limiter.try_acquire("a", "urgent") is not None
+    assert limiter.try_acquire("a", "urgent") is None  # org cap
+    assert limiter.headroom() == (1, {"a": 0})
+
+    assert limiter.try_acquire("b", "low") is not None
+    assert limiter.try_acquire("c", "low") is None  # global cap
+    limiter.release(first)
+    assert limiter.headroom() == (1, {"a": 1, "b": 1})
@@ -0,0 +1,120 @@
+"""
+pack_prompt: budget split between history and RAG, per-message and per-block
+truncation, rank-first RAG selection, and the context reserve when the fixed
+cost (system prompt + tools) exceeds the budget.
+"""
+import pytest
+
+pp = pytest.importorskip("app.services.prompt_packer")
+from app.config import settings  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def packing_settings(monkeypatch):
+    monkeypatch.setattr(settings, "AI_PROMPT_RAG_SHARE", 0.5)
+    monkeypatch.setattr(settings, "AI_PROMPT_MAX_MESSAGE_TOKENS", 400)
+    monkeypatch.setattr(settings, "AI_PROMPT_MIN_CONTEXT_TOKENS", 0)
+
+
+def words(n: int, word: str = "kopi") -> str:
+    return " ".join([word] * n)
+
+
+def msg(text: str, role: str = "user"):
+    return {"role": role, "content": text}
+
+
+def test_everything_fits_untouched():
+    history = [msg("halo"), msg("ada yang bisa dibantu?", "assistant")]
+    rag = [{"text": "jam buka 08.00", "rank": 0}]
+    packed = pp.pack_prompt("system", "harga?", rag, history, budget=5000)
+
+    assert packed.history == history
+    assert packed.rag_blocks == rag
+    assert packed.report["tokens_saved"] == 0
+    assert packed.report["tokens_before"] == packed.report["tokens_after"]
+
+
+def test_history_keeps_newest_within_its_share():
+    history = [msg(f"{tag} " + words(100)) for tag in ("lama", "tengah", "baru")]
+    per_msg = max(pp.count_tokens(m["content"]) for m in history)
+    fixed = pp.count_tokens("s") + pp.count_tokens("q")
+    budget = fixed + 2 * (2 * per_msg + 10)  # history share fits two
+
+    packed = pp.pack_prompt("s", "q", [], history, budget=budget)
+    assert [m["content"].split()[0] for m in packed.history] == ["tengah", "baru"]
+    assert packed.report["history_dropped"] == 1
+
+
+def test_long_old_message_is_truncated(monkeypatch):
+    monkeypatch.setattr(settings, "AI_PROMPT_MAX_MESSAGE_TOKENS", 20)
+    packed = pp.pack_prompt("s", "q", [], [msg(words(500))], budget=5000)
+
+    (kept,) = packed.history
+    assert kept["content"].endswith(pp.TRUNCATION_MARKER)
+    assert pp.count_tokens(kept["content"]) <= 20 + pp.count_tokens(pp.TRUNCATION_MARKER)
+    assert packed.report["history_truncated"] == 1
+
+
+def test_rag_best_rank_first_then_document_order(monkeypatch):
+    monkeypatch.setattr(settings, "AI_PROMPT_RAG_SHARE", 1.0)
+    blocks = [
+        {"text": words(40, "satu"), "rank": 2},
+        {"text": words(40, "dua"), "rank": 0},
+        {"text": words(40, "tiga"), "rank": 1},
+    ]
+    per_block = pp.count_tokens(words(40, "dua"))
+    budget = pp.count_tokens("s") + pp.count_tokens("q") + 2 * per_block + 10
+
+    packed = pp.pack_prompt("s", "q", blocks, [], budget=budget)
+    # Ranks 0 and 1 survive, returned in their original (document) order
+    assert [b["text"].split()[0] for b in packed.rag_blocks] == ["dua", "tiga"]
+    assert packed.report["rag_blocks_dropped"] == 1
+
+
+def test_rag_block_truncated_when_useful_room_left(monkeypatch):
+    monkeypatch.setattr(settings, "AI_PROMPT_RAG_SHARE", 1.0)
+    room = pp.MIN_USEFUL_BLOCK_TOKENS + 50
+    budget = pp.count_tokens("s") + pp.count_tokens("q") + room
+
+    packed = pp.pack_prompt("s", "q", [{"text": words(1000), "rank": 0}], [], budget=budget)
+    (block,) = packed.rag_blocks
+    assert block["text"].endswith(pp.TRUNCATION_MARKER)
+    assert packed.report["rag_blocks_truncated"] == 1
+    assert packed.report["tokens_after"] <= budget
+
+
+def test_tiny_leftover_drops_block_instead_of_truncating(monkeypatch):
+    monkeypatch.setattr(settings, "AI_PROMPT_RAG_SHARE", 1.0)
+    budget = pp.count_tokens("s") + pp.count_tokens("q") + pp.MIN_USEFUL_BLOCK_TOKENS - 1
+
+    packed = pp.pack_prompt("s", "q", [{"text": words(1000), "rank": 0}], [], budget=budget)
+    assert packed.rag_blocks == []
+
+
+def test_tools_over_budget_keep_the_context_reserve(monkeypatch, caplog):
+    monkeypatch.setattr(settings, "AI_PROMPT_MIN_CONTEXT_TOKENS", 300)
+    tools = [{"type": "function", "function": {"name": f"t{i}", "description": words(200, "alat")}} for i in range(5)]
+    history = [msg(words(50, "riwayat"))]
+    rag = [{"text": words(50, "konteks"), "rank": 0}]
+
+    with caplog.at_level("WARNING"):
+        packed = pp.pack_prompt("s", "q", rag, history, budget=500, tools=tools)
+
+    assert packed.report["fixed_tokens"] > 500
+    assert packed.history == history
+    assert packed.rag_blocks == rag
+    assert "reserving 300" in caplog.text
+
+
+def test_without_reserve_over_budget_tools_drop_context():
+    tools = [{"type": "function", "function": {"name": "t", "description": words(800, "alat")}}]
+    packed = pp.pack_prompt("s", "q", [{"text": "konteks", "rank": 0}], [msg("riwayat")], budget=100, tools=tools)
+    assert packed.history == [] and packed.rag_blocks == []
+
+
+def test_resolve_budget_falls_back_to_setting(monkeypatch):
+    monkeypatch.setattr(settings, "AI_PROMPT_TOKEN_BUDGET", 1234)
+    assert pp.resolve_budget({"promptTokenBudget": 800}) == 800
+    assert pp.resolve_budget({}) == 1234
+    assert pp.resolve_budget({"promptTokenBudget": "abc"}) == 1234
@@ -0,0 +1,41 @@
+"""
+Torch ↔ ONNX int8 reranker parity.
+
+Scores PARITY_PAIRS with both engines and requires every score to be within
+RERANKER_ONNX_PARITY_TOLERANCE and the ranking to be identical. Skipped when
+torch / onnxruntime are not installed or the model is not cached under
+RERANKER_MODEL_PATH (the test never downloads it).
+"""
+import os
+
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("onnxruntime")
+np = pytest.importorskip("numpy")
+
+from app.config import settings  # noqa: E402
+
+reranker = pytest.importorskip("app.services.reranker_service")
+
+
+@pytest.fixture(scope="module")
+def engines():
+    if not os.path.exists(os.path.join(settings.RERANKER_MODEL_PATH, "config.json")):
+        pytest.skip(f"reranker model not cached under {settings.RERANKER_MODEL_PATH}")
+    model, tokenizer = reranker.load_torch_reranker()
+    return reranker.TorchRerankerEngine(model, tokenizer), reranker.build_onnx_engine(model, tokenizer)
+
+
+def test_scores_within_tolerance(engines):
+    torch_engine, onnx_engine = engines
+    ref = np.array(torch_engine.score(reranker.PARITY_PAIRS))
+    cand = np.array(onnx_engine.score(reranker.PARITY_PAIRS))
+    max_diff = float(np.max(np.abs(ref - cand)))
+    assert max_diff <= settings.RERANKER_ONNX_PARITY_TOLERANCE, f"max Δ={max_diff:.4f}"
+
+
+def test_ranking_preserved(engines):
+    torch_engine, onnx_engine = engines
+    ok, max_diff = reranker.check_parity(torch_engine, onnx_engine, settings.RERANKER_ONNX_PARITY_TOLERANCE)
+    assert ok, f"ranking or tolerance mismatch (max Δ={max_diff:.4f})"